@@ -0,0 +1,157 @@
+"""Renders animations: a camera moving along keyframes, and optionally
+Instances moving along keyframes of their own, written out as one numbered
+png per frame.
+
+The scene is built once.  Each frame only moves the camera and the animated
+Instances and rebuilds the scene's bounding volume hierarchy, so the shapes'
+own preprocessing (Box rotation matrices, mesh hierarchies) is shared by
+every frame.  Frames are rendered on a pool of worker processes forked with
+the scene, and frames whose png already exists are skipped, so an
+interrupted sequence can be resumed by running it again.
+"""
+import multiprocessing
+import os
+
+import numpy
+
+from main import RayTracerMain
+from parallel import yield_rendered_frames_in_parallel
+
+
+class KeyframeInterpolator(object):
+    """Linearly interpolates a value (a number or an array) between keyframes
+    given as (frame, value) pairs, holding the first and last values before
+    and after them
+    """
+
+    def __init__(self, keyframes):
+        keyframes = sorted(keyframes, key=lambda keyframe: keyframe[0])
+        self.frames = numpy.array([frame for frame, _ in keyframes], dtype=float)
+        self.values = [numpy.asarray(value, dtype=float) for _, value in keyframes]
+
+    def value_at(self, frame):
+        if frame <= self.frames[0]:
+            return self.values[0]
+        if frame >= self.frames[-1]:
+            return self.values[-1]
+        i = numpy.searchsorted(self.frames, frame, side='right') - 1
+        t = (frame - self.frames[i])/(self.frames[i + 1] - self.frames[i])
+        return (1 - t)*self.values[i] + t*self.values[i + 1]
+
+
+class CameraPath(object):
+    """Keyframes given as (frame, position, direction) tuples"""
+
+    def __init__(self, keyframes):
+        self.positions = KeyframeInterpolator(
+            [(frame, position) for frame, position, _ in keyframes]
+        )
+        self.directions = KeyframeInterpolator(
+            [(frame, direction) for frame, _, direction in keyframes]
+        )
+
+    def apply(self, scene, frame):
+        scene.position = self.positions.value_at(frame)
+        scene.direction = self.directions.value_at(frame)
+
+
+class TransformPath(object):
+    """Keyframes for an Instance given as (frame, translation, rotation) or
+    (frame, translation, rotation, scale) tuples.  Rotation vectors are
+    interpolated componentwise, which is exact for turning about a fixed
+    axis.
+    """
+
+    def __init__(self, keyframes):
+        keyframes = [tuple(keyframe) + (1,)*(4 - len(keyframe)) for keyframe in keyframes]
+        self.translations = KeyframeInterpolator(
+            [(keyframe[0], keyframe[1]) for keyframe in keyframes]
+        )
+        self.rotations = KeyframeInterpolator(
+            [(keyframe[0], keyframe[2]) for keyframe in keyframes]
+        )
+        self.scales = KeyframeInterpolator(
+            [(keyframe[0], keyframe[3]) for keyframe in keyframes]
+        )
+
+    def apply(self, instance, frame):
+        instance.set_transform(
+            self.translations.value_at(frame),
+            self.rotations.value_at(frame),
+            float(self.scales.value_at(frame))
+        )
+
+
+class SequenceRenderer(object):
+
+    def __init__(
+        self,
+        scene,
+        camera_path,
+        num_frames,
+        filename_pattern='frame_%04d.png',
+        screen_width=100,
+        screen_height=100,
+        instance_paths=None,
+        num_workers=None,
+        **render_options
+    ):
+        """instance_paths maps Instances in the scene to their TransformPaths.
+        num_workers frames are rendered at once, None using every CPU.  Any
+        other keyword arguments (e.g. wavefront) are passed on to each
+        frame's RayTracerMain, which always traces on a single process.
+        """
+        self.scene = scene
+        self.camera_path = camera_path
+        self.num_frames = num_frames
+        self.filename_pattern = filename_pattern
+        self.screen_width = screen_width
+        self.screen_height = screen_height
+        self.instance_paths = instance_paths or {}
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.render_options = render_options
+
+    def render(self):
+        """Render every frame that isn't on disk yet, returning the numbers of
+        the frames rendered
+        """
+        frames = [
+            frame for frame in xrange(self.num_frames)
+            if not os.path.exists(self.filename_for_frame(frame))
+        ]
+        if self.num_workers > 1:
+            rendered_frames = yield_rendered_frames_in_parallel(self, frames, self.num_workers)
+        else:
+            rendered_frames = (self.render_frame(frame) for frame in frames)
+
+        for num_rendered_frames, frame in enumerate(rendered_frames):
+            print 'frame %d done (%d of %d)' % (frame, num_rendered_frames + 1, len(frames))
+        return frames
+
+    def filename_for_frame(self, frame):
+        return self.filename_pattern % frame
+
+    def set_up_frame(self, frame):
+        self.camera_path.apply(self.scene, frame)
+        for instance, transform_path in self.instance_paths.iteritems():
+            transform_path.apply(instance, frame)
+        if self.instance_paths:
+            self.scene.build_acceleration_structure()
+
+    def render_frame(self, frame):
+        self.set_up_frame(frame)
+        program = RayTracerMain(
+            self.scene,
+            self.screen_width,
+            self.screen_height,
+            num_workers=1,
+            **self.render_options
+        )
+        program.trace_scene()
+        # written under another name first so that an interrupted frame is
+        # never mistaken for a finished one
+        filename = self.filename_for_frame(frame)
+        partial_filename = filename + '.partial'
+        program.export_png(partial_filename)
+        os.rename(partial_filename, filename)
+        return frame
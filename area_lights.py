@@ -0,0 +1,217 @@
+"""Area lights, which cast soft shadows.
+
+A point's shading from an area light is averaged over num_samples points on
+the light, one jittered within each cell (stratum) of a square grid so that
+they cover it evenly.  The first FIRST_STRATUM_SIZE samples are the ones in
+the grid's corners: when the shadow rays to those are all blocked or all
+clear, the rest are taken to be too, so only points near the edge of a
+shadow trace shadow rays to every sample.
+"""
+import numpy
+
+from shapes import LightSource
+from util import dot_rows
+from util import normalize_rows
+
+
+DEFAULT_NUM_SAMPLES = 16
+FIRST_STRATUM_SIZE = 4
+
+
+class _AreaLight(LightSource):
+
+    def __init__(self, position, extent, num_samples, intensity, falloff_distance):
+        """num_samples is rounded to a square number.  extent is how far the
+        light reaches from position.
+        """
+        LightSource.__init__(self, position, intensity, falloff_distance)
+        self.extent = extent
+        grid_size = max(1, int(round(numpy.sqrt(num_samples))))
+        self.num_samples = grid_size*grid_size
+        self.strata = _build_strata(grid_size)
+
+    def find_range(self, min_contribution):
+        light_range = LightSource.find_range(self, min_contribution)
+        if light_range is None:
+            return None
+        return light_range + self.extent
+
+    def build_sample_points(self, points, jitters):
+        """Given an (N, 3) array of points to light and an (N, num_samples,
+        2) array of uniform random numbers, return an (N, num_samples, 3)
+        array of sample points on the light for each point
+        """
+        raise NotImplementedError()
+
+    def _find_sample_coordinates(self, jitters):
+        """Jitter a sample within each stratum of the unit square"""
+        return self.strata + jitters/numpy.sqrt(self.num_samples)
+
+
+class RectangleLight(_AreaLight):
+
+    def __init__(
+        self,
+        position,
+        u_edge,
+        v_edge,
+        num_samples=DEFAULT_NUM_SAMPLES,
+        intensity=1,
+        falloff_distance=None
+    ):
+        """A parallelogram centered on position with edges u_edge and v_edge,
+        lighting both of its sides
+        """
+        self.u_edge = numpy.asarray(u_edge, dtype=float)
+        self.v_edge = numpy.asarray(v_edge, dtype=float)
+        half_diagonal = max(
+            numpy.linalg.norm(self.u_edge + self.v_edge),
+            numpy.linalg.norm(self.u_edge - self.v_edge)
+        )/2
+        _AreaLight.__init__(self, position, half_diagonal, num_samples, intensity, falloff_distance)
+
+    def build_sample_points(self, points, jitters):
+        coordinates = self._find_sample_coordinates(jitters) - 0.5
+        return (
+            self.position +
+            coordinates[..., 0, numpy.newaxis]*self.u_edge +
+            coordinates[..., 1, numpy.newaxis]*self.v_edge
+        )
+
+
+class SphereLight(_AreaLight):
+
+    def __init__(
+        self,
+        position,
+        radius,
+        num_samples=DEFAULT_NUM_SAMPLES,
+        intensity=1,
+        falloff_distance=None
+    ):
+        """A sphere, sampled over the disc through its center facing the
+        point it lights, which is what the point sees of it when it is not
+        too close
+        """
+        self.radius = radius
+        _AreaLight.__init__(self, position, radius, num_samples, intensity, falloff_distance)
+
+    def build_sample_points(self, points, jitters):
+        disc_coordinates = _map_square_to_disc(self._find_sample_coordinates(jitters))
+        axes = normalize_rows(self.position - points)
+        # any vector not parallel to an axis gives a basis for its disc
+        others = numpy.zeros_like(axes)
+        others[numpy.arange(len(axes)), numpy.argmin(numpy.abs(axes), axis=1)] = 1
+        first_tangents = normalize_rows(numpy.cross(axes, others))
+        second_tangents = numpy.cross(axes, first_tangents)
+        return self.position + self.radius*(
+            disc_coordinates[..., 0, numpy.newaxis]*first_tangents[:, numpy.newaxis] +
+            disc_coordinates[..., 1, numpy.newaxis]*second_tangents[:, numpy.newaxis]
+        )
+
+
+def build_light_samples(scene, points, surface_normals, light_indices, random_sample):
+    """Sample the area lights with the given indices into scene.light_sources
+    for an (N, 3) array of points and their surface normals, a light each.
+    random_sample(shape) should return uniform random numbers.
+
+    Returns arrays (pair_indices, sample_indices, paths, lambert_contributions)
+    with a row for each sample that faces its point: the row of the point and
+    light it samples, its index among the light's samples, the path from the
+    point to it and its share of the light's unshadowed lambert contribution.
+    """
+    pair_index_chunks = [numpy.empty(0, dtype=int)]
+    sample_index_chunks = [numpy.empty(0, dtype=int)]
+    path_chunks = [numpy.empty((0, 3), dtype=points.dtype)]
+    contribution_chunks = [numpy.empty(0, dtype=points.dtype)]
+    for light_index in numpy.unique(light_indices):
+        light_source = scene.light_sources[light_index]
+        num_samples = light_source.num_samples
+        pair_indices = numpy.flatnonzero(light_indices == light_index)
+        light_points = points[pair_indices]
+        sample_points = light_source.build_sample_points(
+            light_points,
+            random_sample((len(pair_indices), num_samples, 2))
+        )
+        paths = (sample_points - light_points[:, numpy.newaxis]).reshape(-1, 3).astype(points.dtype)
+        distances = numpy.sqrt(dot_rows(paths, paths))
+        cosines = dot_rows(numpy.repeat(surface_normals[pair_indices], num_samples, axis=0), paths)/distances
+        lambert_contributions = cosines*light_source.find_attenuation(distances)/num_samples
+
+        facing = numpy.flatnonzero(lambert_contributions > 0)
+        pair_index_chunks.append(numpy.repeat(pair_indices, num_samples)[facing])
+        sample_index_chunks.append(numpy.tile(numpy.arange(num_samples), len(pair_indices))[facing])
+        path_chunks.append(paths[facing])
+        contribution_chunks.append(lambert_contributions[facing].astype(points.dtype))
+    return (
+        numpy.concatenate(pair_index_chunks),
+        numpy.concatenate(sample_index_chunks),
+        numpy.concatenate(path_chunks),
+        numpy.concatenate(contribution_chunks)
+    )
+
+
+def find_occluded_samples(scene, ray_positions, paths, pair_indices, sample_indices, statistics=None):
+    """Given (N, 3) arrays of the points and paths of build_light_samples'
+    samples, and their pair and sample indices, return a boolean array of
+    whether each is in shadow.  Only the first stratum's shadow rays are
+    traced for pairs whose first stratum samples are all lit or all in
+    shadow.
+    """
+    occluded = numpy.zeros(len(paths), dtype=bool)
+    first = numpy.flatnonzero(sample_indices < FIRST_STRATUM_SIZE)
+    if statistics is not None:
+        statistics.count_rays('shadow', len(first))
+    occluded[first] = scene.find_occluded_segments(ray_positions[first], paths[first], max_distances=1)
+
+    num_pairs = pair_indices.max() + 1 if len(pair_indices) else 0
+    num_first = numpy.bincount(pair_indices[first], minlength=num_pairs)
+    num_first_occluded = numpy.bincount(
+        pair_indices[first],
+        occluded[first],
+        minlength=num_pairs
+    ).astype(int)
+    # pairs none of whose first stratum samples face their point are traced
+    # in full
+    decided = (num_first > 0) & ((num_first_occluded == 0) | (num_first_occluded == num_first))
+
+    rest = numpy.flatnonzero(sample_indices >= FIRST_STRATUM_SIZE)
+    assumed = rest[decided[pair_indices[rest]]]
+    occluded[assumed] = num_first_occluded[pair_indices[assumed]] > 0
+    traced = rest[~decided[pair_indices[rest]]]
+    if statistics is not None:
+        statistics.count_rays('shadow', len(traced))
+    occluded[traced] = scene.find_occluded_segments(ray_positions[traced], paths[traced], max_distances=1)
+    return occluded
+
+
+def _build_strata(grid_size):
+    """The lower corners of the cells of a grid_size x grid_size grid over
+    the unit square, the grid's corner cells first
+    """
+    us, vs = numpy.meshgrid(numpy.arange(grid_size), numpy.arange(grid_size), indexing='ij')
+    cells = numpy.column_stack([us.ravel(), vs.ravel()])
+    in_corner = numpy.all((cells == 0) | (cells == grid_size - 1), axis=1)
+    cells = cells[numpy.argsort(~in_corner, kind='mergesort')]
+    return cells.astype(float)/grid_size
+
+
+def _map_square_to_disc(coordinates):
+    """Shirley and Chiu's concentric map of the unit square onto the unit
+    disc, which keeps strata compact and sends the square's corners to the
+    disc's rim
+    """
+    a = 2*coordinates[..., 0] - 1
+    b = 2*coordinates[..., 1] - 1
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        radii = numpy.where(numpy.abs(a) > numpy.abs(b), a, b)
+        angles = numpy.where(
+            numpy.abs(a) > numpy.abs(b),
+            numpy.pi/4*b/a,
+            numpy.pi/2 - numpy.pi/4*a/b
+        )
+    angles = numpy.nan_to_num(angles)
+    return numpy.concatenate([
+        (radii*numpy.cos(angles))[..., numpy.newaxis],
+        (radii*numpy.sin(angles))[..., numpy.newaxis]
+    ], axis=-1)
@@ -0,0 +1,324 @@
+"""Render benchmarks over the scenes in test.py.
+
+Every combination of scene, number of extra random spheres, resolution and
+tracer mode is rendered in a fresh interpreter, so that its peak memory can be
+measured on its own, and the best of a few runs is kept.  The results are
+written to a json file, which a later run can be compared against:
+
+    python benchmark.py --output baseline.json
+    ...change things...
+    python benchmark.py --baseline baseline.json --threshold 0.1
+
+exits with status 1 if any case's throughput dropped by more than 10%.
+
+    python benchmark.py --check-workers 3
+
+instead renders every scene in each mode both serially and on 3 worker
+processes, and exits with status 1 if any of the images differ.
+
+    python benchmark.py --check-reuse
+
+likewise checks that renders following others that leave state behind (see
+REUSE_CHECKS) come out the same as fresh ones.
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import numpy
+
+import colors
+import test
+from main import RayTracerMain
+from scene import Scene
+from shapes import Sphere
+
+
+SCENE_NAMES = ['complex_scene', 'transparency_test', 'plane_test', 'rotate_box_test']
+# plus a scene that samples randomly, for --check-workers
+CHECKED_SCENE_NAMES = SCENE_NAMES + ['area_light_test']
+RANDOM_SPHERE_COLORS = [colors.RED, colors.GREEN, colors.BLUE, colors.CYAN, colors.MAGENTA, colors.YELLOW]
+
+
+def build_scene(scene_name, num_random_spheres, seed=0):
+    """The named scene from test.py with num_random_spheres small spheres
+    scattered in front of the camera
+    """
+    scene = getattr(test, scene_name)
+    if not num_random_spheres:
+        return scene
+
+    random_state = numpy.random.RandomState(seed)
+    direction = scene.direction/numpy.linalg.norm(scene.direction)
+    distances = random_state.uniform(5, 30, num_random_spheres)
+    # spread the spheres over roughly the camera's field of view
+    offsets = random_state.uniform(-0.3, 0.3, (num_random_spheres, 3))*distances[:, numpy.newaxis]
+    centers = scene.position + distances[:, numpy.newaxis]*direction + offsets
+    radii = random_state.uniform(0.05, 0.3, num_random_spheres)
+
+    random_spheres = [
+        Sphere(
+            center=center,
+            radius=radius,
+            color=RANDOM_SPHERE_COLORS[i % len(RANDOM_SPHERE_COLORS)],
+            specular=0.5 if i % 3 == 0 else 0
+        )
+        for i, (center, radius) in enumerate(zip(centers, radii))
+    ]
+    return Scene(
+        position=scene.position,
+        direction=scene.direction,
+        background_color=scene.background_color,
+        shapes=scene.shapes + random_spheres,
+        light_sources=scene.light_sources
+    )
+
+
+def run_case(case):
+    """Render one case in this process, returning its measurements"""
+    start_time = time.time()
+    scene = build_scene(case['scene'], case['num_random_spheres'], case['seed'])
+    scene_build_seconds = time.time() - start_time
+
+    width, height = case['resolution']
+    best_seconds = None
+    for _ in xrange(case['repeats']):
+        program = RayTracerMain(
+            scene,
+            width,
+            height,
+            wavefront=case['mode'] == 'wavefront',
+            num_workers=case['num_workers']
+        )
+        start_time = time.time()
+        program.trace_scene()
+        seconds = time.time() - start_time
+        best_seconds = seconds if best_seconds is None else min(best_seconds, seconds)
+
+    num_pixels = width*height
+    result = dict(case)
+    result.update(
+        scene_build_seconds=scene_build_seconds,
+        seconds=best_seconds,
+        seconds_per_pixel=best_seconds/num_pixels,
+        primary_rays_per_second=program.num_samples/best_seconds,
+        # kilobytes on linux, including any worker processes
+        peak_memory_kb=max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        )
+    )
+    return result
+
+
+def run_case_in_subprocess(case):
+    output = subprocess.check_output([sys.executable, __file__, '--run-case', json.dumps(case)])
+    # rendering logs its progress, the result is on the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def case_key(case):
+    return (
+        case['scene'],
+        case['num_random_spheres'],
+        tuple(case['resolution']),
+        case['mode'],
+        case['num_workers']
+    )
+
+
+def find_regressions(results, baseline_results, threshold):
+    """Return (result, baseline result) pairs whose throughput is more than
+    threshold (a fraction) below the baseline's
+    """
+    baseline_results_by_key = dict(
+        (case_key(result), result) for result in baseline_results
+    )
+    regressions = []
+    for result in results:
+        baseline_result = baseline_results_by_key.get(case_key(result))
+        if baseline_result is None:
+            continue
+        minimum_throughput = (1 - threshold)*baseline_result['primary_rays_per_second']
+        if result['primary_rays_per_second'] < minimum_throughput:
+            regressions.append((result, baseline_result))
+    return regressions
+
+
+def find_worker_mismatches(scene_names, resolutions, modes, num_workers):
+    """Return the (scene name, resolution, mode) cases whose image traced on
+    num_workers processes differs from the one traced serially
+    """
+    mismatches = []
+    for scene_name in scene_names:
+        for resolution in resolutions:
+            for mode in modes:
+                images = []
+                for case_num_workers in (1, num_workers):
+                    program = RayTracerMain(
+                        getattr(test, scene_name),
+                        resolution,
+                        resolution,
+                        wavefront=mode == 'wavefront',
+                        num_workers=case_num_workers
+                    )
+                    program.trace_scene()
+                    images.append(program.screen.screen)
+                if not numpy.array_equal(*images):
+                    mismatches.append((scene_name, resolution, mode))
+    return mismatches
+
+
+def render_image(program, trace=None):
+    """The screen of program after trace(program), trace_scene by default"""
+    program.maybe_log_progress = lambda num_done, num_total: None
+    (trace or RayTracerMain.trace_scene)(program)
+    return program.screen.screen.copy()
+
+
+def check_geometry_buffer_after_progressive(resolution):
+    """Whether a render with a geometry buffer after a progressive one, which
+    doesn't fill the buffer, matches a fresh render
+    """
+    scene = test.transparency_test
+    program = RayTracerMain(scene, resolution, resolution, geometry_buffer=True)
+    render_image(program, lambda program: program.trace_scene_progressively(lambda *args: None))
+    return numpy.array_equal(
+        render_image(program),
+        render_image(RayTracerMain(scene, resolution, resolution))
+    )
+
+
+def check_float64_after_float32(resolution):
+    """Whether a float64 render of a scene after a float32 one, which
+    converts the scene's shapes in place, matches the one before it
+    """
+    scene = test.complex_scene
+    image = render_image(RayTracerMain(scene, resolution, resolution))
+    render_image(RayTracerMain(scene, resolution, resolution, wavefront=True, precision=numpy.float32))
+    return numpy.array_equal(render_image(RayTracerMain(scene, resolution, resolution)), image)
+
+
+REUSE_CHECKS = [check_geometry_buffer_after_progressive, check_float64_after_float32]
+
+
+def find_reuse_mismatches(resolutions):
+    """Return the (check name, resolution) cases of REUSE_CHECKS that fail"""
+    return [
+        (check.__name__, resolution)
+        for check in REUSE_CHECKS
+        for resolution in resolutions
+        if not check(resolution)
+    ]
+
+
+def parse_list(type_):
+    return lambda value: [type_(item) for item in value.split(',')]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark rendering the test.py scenes')
+    parser.add_argument('--scenes', type=parse_list(str),
+                        help='comma separated names of scenes in test.py')
+    parser.add_argument('--resolutions', type=parse_list(int), default=[50, 100],
+                        help='comma separated square resolutions')
+    parser.add_argument('--random-spheres', type=parse_list(int), default=[0, 100],
+                        help='comma separated numbers of random spheres to add to each scene')
+    parser.add_argument('--modes', type=parse_list(str), default=['scalar', 'wavefront'])
+    parser.add_argument('--num-workers', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', help='json output of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='fail if throughput drops by more than this fraction of the baseline')
+    parser.add_argument('--check-workers', type=int, metavar='NUM_WORKERS',
+                        help='check that renders on this many processes match serial ones instead')
+    parser.add_argument('--check-reuse', action='store_true',
+                        help='check that renders after others match fresh ones instead')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.run_case:
+        print json.dumps(run_case(json.loads(args.run_case)))
+        return 0
+
+    if args.check_workers:
+        mismatches = find_worker_mismatches(
+            args.scenes or CHECKED_SCENE_NAMES,
+            args.resolutions,
+            args.modes,
+            args.check_workers
+        )
+        for scene_name, resolution, mode in mismatches:
+            print 'MISMATCH %s, %dx%d %s: %d workers differ from serial' % (
+                scene_name,
+                resolution,
+                resolution,
+                mode,
+                args.check_workers
+            )
+        return 1 if mismatches else 0
+
+    if args.check_reuse:
+        mismatches = find_reuse_mismatches(args.resolutions)
+        for check_name, resolution in mismatches:
+            print 'MISMATCH %s, %dx%d' % (check_name, resolution, resolution)
+        return 1 if mismatches else 0
+
+    results = []
+    for scene_name in args.scenes or SCENE_NAMES:
+        for num_random_spheres in args.random_spheres:
+            for resolution in args.resolutions:
+                for mode in args.modes:
+                    result = run_case_in_subprocess(dict(
+                        scene=scene_name,
+                        num_random_spheres=num_random_spheres,
+                        resolution=[resolution, resolution],
+                        mode=mode,
+                        num_workers=args.num_workers,
+                        repeats=args.repeats,
+                        seed=args.seed
+                    ))
+                    results.append(result)
+                    print '%s + %d spheres, %dx%d %s: %.3fs, %.0f rays/s, %.1f us/pixel, %d KB' % (
+                        scene_name,
+                        num_random_spheres,
+                        resolution,
+                        resolution,
+                        mode,
+                        result['seconds'],
+                        result['primary_rays_per_second'],
+                        1e6*result['seconds_per_pixel'],
+                        result['peak_memory_kb']
+                    )
+
+    with open(args.output, 'w') as output_file:
+        json.dump({'python_version': sys.version, 'results': results}, output_file, indent=2)
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as baseline_file:
+        baseline_results = json.load(baseline_file)['results']
+    regressions = find_regressions(results, baseline_results, args.threshold)
+    for result, baseline_result in regressions:
+        print 'REGRESSION %s + %d spheres, %dx%d %s: %.0f rays/s, baseline %.0f' % (
+            result['scene'],
+            result['num_random_spheres'],
+            result['resolution'][0],
+            result['resolution'][1],
+            result['mode'],
+            result['primary_rays_per_second'],
+            baseline_result['primary_rays_per_second']
+        )
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,499 @@
+import numpy
+
+
+# node bounds are padded slightly so that rays grazing a primitive's bounding
+# box aren't culled by floating point error
+BOUNDS_PADDING = 1e-7
+# and by this much more when the bounds are kept as float32
+FLOAT32_BOUNDS_PADDING = 1e-4
+
+# relative costs used by the surface area heuristic
+TRAVERSAL_COST = 1.0
+INTERSECTION_COST = 1.0
+
+
+class BoundingVolumeHierarchy(object):
+    """A binary tree of axis aligned bounding boxes over a set of primitives.
+
+    The hierarchy only knows each primitive's bounding box (given as (N, 3)
+    arrays of lower and upper bounds); what the primitives are and how to
+    intersect them is left to callbacks that are handed the indices of the
+    primitives in a leaf.  Splits are chosen with the surface area heuristic,
+    evaluated over num_bins bins of primitive centroids along each axis.
+    """
+
+    def __init__(self, lower_bounds, upper_bounds, max_leaf_size=4, num_bins=12):
+        self.max_leaf_size = max_leaf_size
+        self.num_bins = num_bins
+        # the precision of batched queries, see set_precision
+        self.dtype = numpy.dtype(float)
+
+        self.node_lower_bounds = []
+        self.node_upper_bounds = []
+        # (left, right) node indices for interior nodes, None for leaves
+        self.node_children = []
+        # primitive indices for leaves, None for interior nodes
+        self.node_primitive_indices = []
+
+        lower_bounds = numpy.asarray(lower_bounds, dtype=float).reshape(-1, 3)
+        upper_bounds = numpy.asarray(upper_bounds, dtype=float).reshape(-1, 3)
+        if len(lower_bounds):
+            self._build_node(
+                numpy.arange(len(lower_bounds)),
+                lower_bounds,
+                upper_bounds,
+                (lower_bounds + upper_bounds)/2
+            )
+
+        self.node_lower_bounds = numpy.array(self.node_lower_bounds).reshape(-1, 3) - BOUNDS_PADDING
+        self.node_upper_bounds = numpy.array(self.node_upper_bounds).reshape(-1, 3) + BOUNDS_PADDING
+        # plain float copies for single ray traversal, where numpy's per-call
+        # overhead would dominate
+        self.node_bounds_as_lists = zip(
+            self.node_lower_bounds.tolist(),
+            self.node_upper_bounds.tolist()
+        )
+
+    def set_precision(self, dtype):
+        """Keep the node bounds as dtype and run batched queries in it"""
+        dtype = numpy.dtype(dtype)
+        if dtype == self.dtype:
+            return
+        if self.dtype == numpy.float64:
+            # converted from these every time, so that converting back to
+            # float64 takes off the padding and rounding
+            self._float64_node_bounds = (self.node_lower_bounds, self.node_upper_bounds)
+        lower_bounds, upper_bounds = self._float64_node_bounds
+        padding = FLOAT32_BOUNDS_PADDING if dtype == numpy.float32 else 0
+        self.node_lower_bounds = (lower_bounds - padding).astype(dtype)
+        self.node_upper_bounds = (upper_bounds + padding).astype(dtype)
+        self.dtype = dtype
+
+    @property
+    def num_nodes(self):
+        return len(self.node_children)
+
+    def _build_node(self, primitive_indices, lower_bounds, upper_bounds, centroids):
+        node_index = self.num_nodes
+        node_lower_bound = lower_bounds[primitive_indices].min(axis=0)
+        node_upper_bound = upper_bounds[primitive_indices].max(axis=0)
+        self.node_lower_bounds.append(node_lower_bound)
+        self.node_upper_bounds.append(node_upper_bound)
+        self.node_children.append(None)
+        self.node_primitive_indices.append(None)
+
+        split = None
+        if len(primitive_indices) > self.max_leaf_size:
+            split = self._find_best_split(
+                primitive_indices,
+                lower_bounds,
+                upper_bounds,
+                centroids,
+                _surface_area(node_lower_bound, node_upper_bound)
+            )
+        if split is None:
+            self.node_primitive_indices[node_index] = primitive_indices
+            return node_index
+
+        left_indices, right_indices = split
+        left = self._build_node(left_indices, lower_bounds, upper_bounds, centroids)
+        right = self._build_node(right_indices, lower_bounds, upper_bounds, centroids)
+        self.node_children[node_index] = (left, right)
+        return node_index
+
+    def _find_best_split(
+        self,
+        primitive_indices,
+        lower_bounds,
+        upper_bounds,
+        centroids,
+        node_surface_area
+    ):
+        """Return the (left, right) primitive indices of the cheapest split by
+        the surface area heuristic, or None if not splitting is cheaper.
+        """
+        node_centroids = centroids[primitive_indices]
+        centroid_min = node_centroids.min(axis=0)
+        centroid_extent = node_centroids.max(axis=0) - centroid_min
+
+        num_primitives = len(primitive_indices)
+        best_cost = INTERSECTION_COST*num_primitives
+        best_split = None
+        for axis in xrange(3):
+            if centroid_extent[axis] <= 0:
+                continue
+            bin_indices = numpy.minimum(
+                (self.num_bins*(node_centroids[:, axis] - centroid_min[axis])/centroid_extent[axis]).astype(int),
+                self.num_bins - 1
+            )
+
+            bin_counts = numpy.bincount(bin_indices, minlength=self.num_bins)
+            bin_lower_bounds = numpy.full((self.num_bins, 3), numpy.inf)
+            bin_upper_bounds = numpy.full((self.num_bins, 3), -numpy.inf)
+            numpy.minimum.at(bin_lower_bounds, bin_indices, lower_bounds[primitive_indices])
+            numpy.maximum.at(bin_upper_bounds, bin_indices, upper_bounds[primitive_indices])
+
+            # costs of splitting after each of the first num_bins - 1 bins
+            left_counts = numpy.cumsum(bin_counts)[:-1]
+            right_counts = num_primitives - left_counts
+            left_areas = _surface_areas(
+                numpy.minimum.accumulate(bin_lower_bounds)[:-1],
+                numpy.maximum.accumulate(bin_upper_bounds)[:-1]
+            )
+            right_areas = _surface_areas(
+                numpy.minimum.accumulate(bin_lower_bounds[::-1])[::-1][1:],
+                numpy.maximum.accumulate(bin_upper_bounds[::-1])[::-1][1:]
+            )
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                costs = TRAVERSAL_COST + INTERSECTION_COST*(
+                    left_counts*left_areas + right_counts*right_areas
+                )/node_surface_area
+            costs[(left_counts == 0) | (right_counts == 0) | numpy.isnan(costs)] = numpy.inf
+
+            bin_to_split_after = numpy.argmin(costs)
+            if costs[bin_to_split_after] < best_cost:
+                best_cost = costs[bin_to_split_after]
+                goes_left = bin_indices <= bin_to_split_after
+                best_split = (primitive_indices[goes_left], primitive_indices[~goes_left])
+        return best_split
+
+    def _find_entry_distances(self, node_index, ray_positions, inverse_ray_dirs):
+        """Slab test of the node's box against (N, 3) arrays of rays, returning
+        the distance along each ray at which it enters the box (negative if it
+        starts inside) or inf if it misses the box entirely
+        """
+        with numpy.errstate(invalid='ignore'):
+            d_lower = (self.node_lower_bounds[node_index] - ray_positions)*inverse_ray_dirs
+            d_upper = (self.node_upper_bounds[node_index] - ray_positions)*inverse_ray_dirs
+        # fmin/fmax skip the nans from rays lying exactly in a face's plane
+        d_nears = numpy.fmin(d_lower, d_upper)
+        d_fars = numpy.fmax(d_lower, d_upper)
+        # reducing over the last axis one column at a time is much faster
+        # than numpy's reduce for an axis of length 3
+        d_near = numpy.fmax(numpy.fmax(d_nears[..., 0], d_nears[..., 1]), d_nears[..., 2])
+        d_far = numpy.fmin(numpy.fmin(d_fars[..., 0], d_fars[..., 1]), d_fars[..., 2])
+        return numpy.where((d_near <= d_far) & (d_far >= 0), d_near, numpy.inf)
+
+    def _find_entry_distance(self, node_index, ray_pos, ray_dir):
+        """Single ray version of _find_entry_distances, for rays given as lists
+        of floats
+        """
+        d_near = -numpy.inf
+        d_far = numpy.inf
+        lower_bound, upper_bound = self.node_bounds_as_lists[node_index]
+        for lower, upper, position, direction in zip(lower_bound, upper_bound, ray_pos, ray_dir):
+            if direction == 0:
+                if position < lower or position > upper:
+                    return numpy.inf
+                continue
+            d_lower = (lower - position)/direction
+            d_upper = (upper - position)/direction
+            if d_lower > d_upper:
+                d_lower, d_upper = d_upper, d_lower
+            d_near = max(d_near, d_lower)
+            d_far = min(d_far, d_upper)
+        if d_near > d_far or d_far < 0:
+            return numpy.inf
+        return d_near
+
+    def find_closest_hit(
+        self,
+        ray_pos,
+        ray_dir,
+        intersect_leaf,
+        max_distance=numpy.inf,
+        node_mask=None
+    ):
+        """Find the closest primitive hit by a single ray.
+
+        intersect_leaf(primitive_indices, max_distance) should return the
+        (distance, primitive index) of the closest of the given primitives hit
+        closer than max_distance, or (inf, None).  Distances are in units of
+        ray_dir.  Returns (inf, None) if nothing is hit closer than max_distance.
+
+        node_mask is a boolean array of the nodes to visit, e.g. the ones a
+        frustum around the ray overlaps, or None to visit them all.
+        """
+        if not self.num_nodes or (node_mask is not None and not node_mask[0]):
+            return numpy.inf, None
+        closest_distance, closest_primitive_index = max_distance, None
+
+        ray_pos = numpy.asarray(ray_pos, dtype=float).tolist()
+        ray_dir = numpy.asarray(ray_dir, dtype=float).tolist()
+        stack = [(0, self._find_entry_distance(0, ray_pos, ray_dir))]
+        while stack:
+            node_index, entry_distance = stack.pop()
+            # a box entered no closer than the closest hit so far (including
+            # one that's missed entirely) can't hold anything closer
+            if entry_distance >= closest_distance:
+                continue
+
+            primitive_indices = self.node_primitive_indices[node_index]
+            if primitive_indices is not None:
+                distance, primitive_index = intersect_leaf(primitive_indices, closest_distance)
+                if distance < closest_distance:
+                    closest_distance, closest_primitive_index = distance, primitive_index
+                continue
+
+            # visit the nearer child first by pushing it last
+            children = sorted(
+                (
+                    (child, self._find_entry_distance(child, ray_pos, ray_dir))
+                    for child in self.node_children[node_index]
+                    if node_mask is None or node_mask[child]
+                ),
+                key=lambda child_and_entry: -child_and_entry[1]
+            )
+            stack.extend(children)
+
+        if closest_primitive_index is None:
+            return numpy.inf, None
+        return closest_distance, closest_primitive_index
+
+    def find_any_hit(self, ray_pos, ray_dir, max_distance, is_leaf_hit):
+        """Determine whether a single ray hits any primitive closer than
+        max_distance, stopping at the first one found.
+
+        is_leaf_hit(primitive_indices, max_distance) should return whether any
+        of the given primitives are hit closer than max_distance.
+        """
+        if not self.num_nodes:
+            return False
+
+        ray_pos = numpy.asarray(ray_pos, dtype=float).tolist()
+        ray_dir = numpy.asarray(ray_dir, dtype=float).tolist()
+        stack = [0]
+        while stack:
+            node_index = stack.pop()
+            entry_distance = self._find_entry_distance(node_index, ray_pos, ray_dir)
+            if entry_distance > max_distance or entry_distance == numpy.inf:
+                continue
+
+            primitive_indices = self.node_primitive_indices[node_index]
+            if primitive_indices is None:
+                stack.extend(self.node_children[node_index])
+            elif is_leaf_hit(primitive_indices, max_distance):
+                return True
+        return False
+
+    def find_closest_hits(
+        self,
+        ray_positions,
+        ray_dirs,
+        intersect_leaf,
+        max_distances=None,
+        node_mask=None,
+        with_parts=False
+    ):
+        """Batched version of find_closest_hit for (N, 3) arrays of rays.  The
+        rays travel down the tree together, with each node only passing on the
+        rays that hit its box closer than their closest hit so far.
+
+        intersect_leaf(primitive_indices, ray_positions, ray_dirs, max_distances)
+        is called with the subset of rays that reach a leaf and should return
+        arrays of the distance to and index of the closest of the primitives
+        each ray hits (inf and -1 for misses).  with_parts has it return a
+        third array of which part of its primitive each ray hits, e.g. a
+        mesh's triangle, kept along with the closest hits.
+
+        Returns arrays (distances, primitive_indices), with inf and -1 for rays
+        that hit nothing closer than max_distances, and the parts' array (-1
+        for misses) as well for with_parts.
+        """
+        num_rays = len(ray_positions)
+        closest_distances = numpy.full(num_rays, numpy.inf, dtype=self.dtype)
+        if max_distances is not None:
+            closest_distances[:] = max_distances
+        closest_primitive_indices = numpy.full(num_rays, -1, dtype=int)
+        closest_part_indices = numpy.full(num_rays, -1, dtype=int) if with_parts else None
+        if not self.num_nodes or not num_rays or (node_mask is not None and not node_mask[0]):
+            return self._closest_hits_result(closest_distances, closest_primitive_indices, closest_part_indices)
+
+        with numpy.errstate(divide='ignore'):
+            inverse_ray_dirs = 1.0/numpy.asarray(ray_dirs, dtype=self.dtype)
+        ray_indices = numpy.arange(num_rays)
+        stack = [(0, ray_indices, self._find_entry_distances(0, ray_positions, inverse_ray_dirs))]
+        while stack:
+            node_index, ray_indices, entry_distances = stack.pop()
+            ray_indices = ray_indices[entry_distances < closest_distances[ray_indices]]
+            if not len(ray_indices):
+                continue
+
+            primitive_indices = self.node_primitive_indices[node_index]
+            if primitive_indices is None:
+                stack.extend(self._split_rays_between_children(
+                    node_index,
+                    ray_indices,
+                    ray_positions[ray_indices],
+                    inverse_ray_dirs[ray_indices],
+                    node_mask
+                ))
+                continue
+
+            leaf_hits = intersect_leaf(
+                primitive_indices,
+                ray_positions[ray_indices],
+                ray_dirs[ray_indices],
+                closest_distances[ray_indices]
+            )
+            distances, hit_primitive_indices = leaf_hits[:2]
+            closer = distances < closest_distances[ray_indices]
+            closest_distances[ray_indices[closer]] = distances[closer]
+            closest_primitive_indices[ray_indices[closer]] = hit_primitive_indices[closer]
+            if with_parts:
+                closest_part_indices[ray_indices[closer]] = leaf_hits[2][closer]
+
+        closest_distances[closest_primitive_indices < 0] = numpy.inf
+        return self._closest_hits_result(closest_distances, closest_primitive_indices, closest_part_indices)
+
+    def _closest_hits_result(self, distances, primitive_indices, part_indices):
+        if part_indices is None:
+            return distances, primitive_indices
+        return distances, primitive_indices, part_indices
+
+    def _split_rays_between_children(
+        self,
+        node_index,
+        ray_indices,
+        ray_positions,
+        inverse_ray_dirs,
+        node_mask=None
+    ):
+        """Return stack entries of (child, ray indices, entry distances) for the
+        node's children, in the order they should be pushed: the child that
+        most of the rays enter first comes last, so that it's visited first and
+        its hits can cull the other child.  Children left out of node_mask are
+        skipped.
+        """
+        left, right = self.node_children[node_index]
+        if node_mask is not None and not (node_mask[left] and node_mask[right]):
+            return [
+                (child, ray_indices, self._find_entry_distances(child, ray_positions, inverse_ray_dirs))
+                for child in (left, right)
+                if node_mask[child]
+            ]
+        left_entry_distances = self._find_entry_distances(left, ray_positions, inverse_ray_dirs)
+        right_entry_distances = self._find_entry_distances(right, ray_positions, inverse_ray_dirs)
+        children = [
+            (right, ray_indices, right_entry_distances),
+            (left, ray_indices, left_entry_distances),
+        ]
+        if 2*numpy.count_nonzero(left_entry_distances <= right_entry_distances) < len(ray_indices):
+            children.reverse()
+        return children
+
+    def find_any_hits(self, ray_positions, ray_dirs, max_distances, are_leaf_hits):
+        """Batched version of find_any_hit.  Rays drop out of the traversal as
+        soon as they hit something.
+
+        are_leaf_hits(primitive_indices, ray_positions, ray_dirs, max_distances)
+        is called with the subset of rays that reach a leaf and should return a
+        boolean array of whether each hits any of the primitives closer than
+        its max distance.
+        """
+        num_rays = len(ray_positions)
+        hits = numpy.zeros(num_rays, dtype=bool)
+        if not self.num_nodes or not num_rays:
+            return hits
+
+        max_distances = numpy.resize(max_distances, num_rays)
+        with numpy.errstate(divide='ignore'):
+            inverse_ray_dirs = 1.0/numpy.asarray(ray_dirs, dtype=self.dtype)
+        stack = [(0, numpy.arange(num_rays))]
+        while stack:
+            node_index, ray_indices = stack.pop()
+            ray_indices = ray_indices[~hits[ray_indices]]
+            entry_distances = self._find_entry_distances(
+                node_index,
+                ray_positions[ray_indices],
+                inverse_ray_dirs[ray_indices]
+            )
+            ray_indices = ray_indices[
+                (entry_distances <= max_distances[ray_indices])
+                & (entry_distances < numpy.inf)
+            ]
+            if not len(ray_indices):
+                continue
+
+            primitive_indices = self.node_primitive_indices[node_index]
+            if primitive_indices is None:
+                stack.extend(
+                    (child, ray_indices) for child in self.node_children[node_index]
+                )
+                continue
+
+            hits[ray_indices] = are_leaf_hits(
+                primitive_indices,
+                ray_positions[ray_indices],
+                ray_dirs[ray_indices],
+                max_distances[ray_indices]
+            )
+        return hits
+
+    def find_primitives_near_point(self, point):
+        """The indices of the primitives in every leaf whose box contains
+        point, for point queries against primitives that are regions of space
+        (e.g. the reach of a light).  Whether the primitives themselves
+        contain the point is left to the caller.
+        """
+        if not self.num_nodes:
+            return []
+        point = numpy.asarray(point, dtype=float).tolist()
+        primitive_indices = []
+        stack = [0]
+        while stack:
+            node_index = stack.pop()
+            lower_bound, upper_bound = self.node_bounds_as_lists[node_index]
+            if not all(
+                lower <= coordinate <= upper
+                for lower, coordinate, upper in zip(lower_bound, point, upper_bound)
+            ):
+                continue
+            if self.node_primitive_indices[node_index] is None:
+                stack.extend(self.node_children[node_index])
+            else:
+                primitive_indices.extend(self.node_primitive_indices[node_index])
+        return primitive_indices
+
+    def find_primitives_near_points(self, points):
+        """Batched version of find_primitives_near_point for an (N, 3) array
+        of points, returning arrays (point_indices, primitive_indices) of
+        every point and leaf primitive pair
+        """
+        point_index_chunks = [numpy.empty(0, dtype=int)]
+        primitive_index_chunks = [numpy.empty(0, dtype=int)]
+        if self.num_nodes and len(points):
+            stack = [(0, numpy.arange(len(points)))]
+            while stack:
+                node_index, point_indices = stack.pop()
+                node_points = points[point_indices]
+                point_indices = point_indices[numpy.all(
+                    (node_points >= self.node_lower_bounds[node_index]) &
+                    (node_points <= self.node_upper_bounds[node_index]),
+                    axis=1
+                )]
+                if not len(point_indices):
+                    continue
+
+                primitive_indices = self.node_primitive_indices[node_index]
+                if primitive_indices is None:
+                    stack.extend(
+                        (child, point_indices) for child in self.node_children[node_index]
+                    )
+                    continue
+                point_index_chunks.append(numpy.repeat(point_indices, len(primitive_indices)))
+                primitive_index_chunks.append(numpy.tile(primitive_indices, len(point_indices)))
+        return numpy.concatenate(point_index_chunks), numpy.concatenate(primitive_index_chunks)
+
+
+def _surface_area(lower_bound, upper_bound):
+    return _surface_areas(lower_bound[numpy.newaxis], upper_bound[numpy.newaxis])[0]
+
+
+def _surface_areas(lower_bounds, upper_bounds):
+    extents = numpy.maximum(upper_bounds - lower_bounds, 0)
+    return 2*(
+        extents[:, 0]*extents[:, 1] +
+        extents[:, 1]*extents[:, 2] +
+        extents[:, 2]*extents[:, 0]
+    )
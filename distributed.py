@@ -0,0 +1,249 @@
+"""Traces a RayTracerMain's tiles on worker processes connected over TCP,
+which can run on other machines as well as this one.
+
+A RenderCoordinator listens for workers, each started from a copy of this
+package with
+
+    python distributed.py HOST PORT
+
+For every render it sends each worker the pickled scene and render options
+once, then hands out tiles one at a time as the workers finish them, so
+faster workers trace more of the image.  Workers send back their tiles'
+pixel values, which the coordinator's RayTracerMain writes into its Screen.
+A tile that a worker takes longer than the timeout over, or whose worker
+disconnects, goes back in the queue for another worker, and the worker is
+dropped.
+
+Messages are pickled tuples, each preceded by its length.  Unpickling can run
+arbitrary code, so only connect workers to coordinators they can trust.
+"""
+import collections
+import cPickle as pickle
+import os
+import select
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+
+DEFAULT_TIMEOUT = 300
+# the byte length of the pickled message that follows
+MESSAGE_HEADER = struct.Struct('!Q')
+
+
+class RenderCoordinator(object):
+
+    def __init__(self, host='localhost', port=0, timeout=DEFAULT_TIMEOUT):
+        """Listen for workers on host and port, 0 picking a free port (see
+        address).  timeout is how many seconds a worker may take over a tile,
+        or over sending any message, before it is given up on.
+        """
+        self.timeout = timeout
+        self.listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listening_socket.bind((host, port))
+        self.listening_socket.listen(socket.SOMAXCONN)
+        self.address = self.listening_socket.getsockname()
+        self.workers = []
+        self.job_id = 0
+        self.job_message = None
+
+    def start_job(self, scene, screen_width, screen_height, render_options, collect_statistics):
+        """Set the render that tiles are traced for.  Each worker is sent the
+        job before its first tile of it.
+        """
+        self.job_id += 1
+        self.job_message = _encode((
+            'job',
+            self.job_id,
+            scene,
+            screen_width,
+            screen_height,
+            render_options,
+            collect_statistics
+        ))
+
+    def yield_traced_tiles(self, tiles):
+        """Trace tiles (as (min_x, max_x, min_y, max_y) tuples) on the
+        connected workers and any that connect meanwhile, yielding (xs, ys,
+        pixel_values, num_samples, statistics) for each tile as it finishes
+        """
+        pending_tiles = collections.deque(tiles)
+        num_remaining_tiles = len(pending_tiles)
+        while num_remaining_tiles:
+            self._hand_out_tiles(pending_tiles)
+            connections = [self.listening_socket] + [worker.connection for worker in self.workers]
+            readable, _, _ = select.select(connections, [], [], self._find_wait_seconds())
+
+            for connection in readable:
+                if connection is self.listening_socket:
+                    self._accept_worker()
+                    continue
+                worker = self._find_worker(connection)
+                try:
+                    _, tile, xs, ys, pixel_values, num_samples, statistics = _receive(connection)
+                except (EOFError, socket.error, pickle.UnpicklingError):
+                    self._drop_worker(worker, pending_tiles)
+                    continue
+                worker.tile = None
+                num_remaining_tiles -= 1
+                yield xs, ys, pixel_values, num_samples, statistics
+
+            now = time.time()
+            for worker in list(self.workers):
+                if worker.tile is not None and now > worker.deadline:
+                    self._drop_worker(worker, pending_tiles)
+
+    def close(self):
+        """Disconnect the workers, which then exit, and stop listening"""
+        for worker in self.workers:
+            worker.connection.close()
+        self.workers = []
+        self.listening_socket.close()
+
+    def _hand_out_tiles(self, pending_tiles):
+        for worker in list(self.workers):
+            if not pending_tiles:
+                return
+            if worker.tile is not None:
+                continue
+            tile = pending_tiles.popleft()
+            worker.tile = tile
+            try:
+                if worker.job_id != self.job_id:
+                    worker.connection.sendall(self.job_message)
+                    worker.job_id = self.job_id
+                worker.connection.sendall(_encode(('tile', tile)))
+            except socket.error:
+                self._drop_worker(worker, pending_tiles)
+                continue
+            worker.deadline = time.time() + self.timeout
+
+    def _find_wait_seconds(self):
+        """How long to wait for messages before checking for timed out tiles"""
+        deadlines = [worker.deadline for worker in self.workers if worker.tile is not None]
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.time())
+
+    def _accept_worker(self):
+        connection, _ = self.listening_socket.accept()
+        connection.settimeout(self.timeout)
+        self.workers.append(_Worker(connection))
+
+    def _find_worker(self, connection):
+        for worker in self.workers:
+            if worker.connection is connection:
+                return worker
+
+    def _drop_worker(self, worker, pending_tiles):
+        if worker.tile is not None:
+            pending_tiles.appendleft(worker.tile)
+        worker.connection.close()
+        self.workers.remove(worker)
+
+
+class _Worker(object):
+    """The coordinator's view of a connected worker"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        # the job the worker was last sent
+        self.job_id = None
+        # the tile it is tracing, if any, and when it has to be done by
+        self.tile = None
+        self.deadline = None
+
+
+def run_worker(host, port):
+    """Trace tiles for the coordinator at host and port until it disconnects"""
+    # imported here so that the coordinator side doesn't depend on the tracers
+    from instrumentation import RenderStatistics
+    from main import RayTracerMain
+
+    connection = socket.create_connection((host, port))
+    ray_tracer_main = None
+    try:
+        while True:
+            try:
+                message = _receive(connection)
+            except EOFError:
+                return
+            if message[0] == 'job':
+                _, _, scene, screen_width, screen_height, render_options, collect_statistics = message
+                # tiles go straight back to the coordinator, so the screen
+                # only needs to exist
+                ray_tracer_main = RayTracerMain(
+                    scene,
+                    screen_width,
+                    screen_height,
+                    num_workers=1,
+                    band_height=1,
+                    statistics=RenderStatistics(report=False) if collect_statistics else None,
+                    **render_options
+                )
+                ray_tracer_main.start_render()
+                continue
+
+            _, tile = message
+            xs, ys, pixel_colors, num_samples = ray_tracer_main.render_region(*tile)
+            _send(connection, (
+                'tile',
+                tile,
+                xs,
+                ys,
+                ray_tracer_main.screen.to_pixel_values(pixel_colors),
+                num_samples,
+                ray_tracer_main.take_statistics()
+            ))
+    finally:
+        connection.close()
+
+
+def start_local_workers(address, num_workers):
+    """Start num_workers worker processes on this machine, connecting to the
+    coordinator at address, and return their Popen objects
+    """
+    host, port = address
+    return [
+        subprocess.Popen([
+            sys.executable,
+            os.path.abspath(__file__),
+            host,
+            str(port)
+        ])
+        for _ in xrange(num_workers)
+    ]
+
+
+def _encode(message):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    return MESSAGE_HEADER.pack(len(data)) + data
+
+
+def _send(connection, message):
+    connection.sendall(_encode(message))
+
+
+def _receive(connection):
+    """Read a message, raising EOFError if the other end has disconnected"""
+    header = _receive_bytes(connection, MESSAGE_HEADER.size)
+    length, = MESSAGE_HEADER.unpack(header)
+    return pickle.loads(_receive_bytes(connection, length))
+
+
+def _receive_bytes(connection, num_bytes):
+    chunks = []
+    while num_bytes:
+        chunk = connection.recv(min(num_bytes, 1 << 20))
+        if not chunk:
+            raise EOFError('connection closed')
+        chunks.append(chunk)
+        num_bytes -= len(chunk)
+    return ''.join(chunks)
+
+
+if __name__ == '__main__':
+    run_worker(sys.argv[1], int(sys.argv[2]))
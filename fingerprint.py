@@ -0,0 +1,79 @@
+"""Content hashes of scenes, used to tell when cached render results are stale.
+
+Shape, texture and light attributes are hashed generically, whatever their
+class.  Attributes that are neither arrays, numbers, strings, shapes nor
+textures (e.g. a mesh's bounding volume hierarchy) are derived from the
+others and skipped.  Image textures are hashed by filename, not by the
+image's contents.
+"""
+import hashlib
+
+import numpy
+
+from shapes import Shape
+from textures import Texture
+
+
+# shape attributes that change how a surface is shaded but not where it is
+MATERIAL_ATTRIBUTES = frozenset([
+    'color',
+    'specular',
+    'transparency',
+    'index_of_refraction',
+    'checkered',
+    'texture',
+])
+
+
+def fingerprint_geometry(scene, ray_generator):
+    """Hash everything primary visibility depends on: the camera, the rays it
+    generates and the shapes' geometry, but not lights or materials
+    """
+    digest = hashlib.sha1()
+    _update(digest, [scene.position, scene.direction, ray_generator.__dict__])
+    _update(digest, scene.shapes, excluded_attributes=MATERIAL_ATTRIBUTES)
+    return digest.hexdigest()
+
+
+def fingerprint_render(scene, ray_generator, settings):
+    """Hash everything a rendered image depends on: the whole scene, the rays
+    the camera generates and a dict of any other render settings
+    """
+    digest = hashlib.sha1()
+    _update(digest, [
+        scene.position,
+        scene.direction,
+        scene.background_color,
+        scene.min_light_contribution,
+        ray_generator.__dict__,
+        settings
+    ])
+    _update(digest, scene.shapes)
+    _update(digest, [
+        [type(light_source).__name__, light_source.__dict__]
+        for light_source in scene.light_sources
+    ])
+    return digest.hexdigest()
+
+
+def _update(digest, value, excluded_attributes=frozenset()):
+    if isinstance(value, (Shape, Texture)):
+        digest.update(type(value).__name__)
+        for name in sorted(value.__dict__):
+            if name not in excluded_attributes:
+                digest.update(name)
+                _update(digest, value.__dict__[name], excluded_attributes)
+    elif isinstance(value, numpy.ndarray):
+        digest.update('%s%s' % (value.dtype, value.shape))
+        digest.update(numpy.ascontiguousarray(value).tostring())
+    elif isinstance(value, (list, tuple)):
+        digest.update('[%d' % len(value))
+        for item in value:
+            _update(digest, item, excluded_attributes)
+    elif isinstance(value, dict):
+        digest.update('{%d' % len(value))
+        for key in sorted(value):
+            digest.update(repr(key))
+            _update(digest, value[key], excluded_attributes)
+    elif isinstance(value, (bool, int, long, float, str, numpy.generic)) or value is None:
+        digest.update(repr(value))
@@ -0,0 +1,34 @@
+import numpy
+
+
+class Frustum(object):
+    """The pyramid swept out by rays from apex through a convex quadrilateral
+    of directions, like the primary rays through a tile of the screen.  Used
+    to cull shapes that none of a tile's primary rays can hit.
+    """
+
+    def __init__(self, apex, corner_rays):
+        """corner_rays is a (4, 3) array of the directions through the
+        quadrilateral's corners, in order around it
+        """
+        self.apex = numpy.asarray(apex, dtype=float)
+        self.corner_rays = numpy.asarray(corner_rays, dtype=float)
+        # each side is the plane through the apex and two neighboring corner
+        # rays, with its normal turned to face the inside
+        normals = numpy.cross(self.corner_rays, numpy.roll(self.corner_rays, -1, axis=0))
+        central_ray = self.corner_rays.sum(axis=0)
+        normals[normals.dot(central_ray) < 0] *= -1
+        self.side_normals = normals
+
+    def find_overlapping_boxes(self, lower_bounds, upper_bounds):
+        """Given (N, 3) arrays of the corners of axis aligned boxes, return a
+        boolean array of whether each might overlap the frustum.  A box is
+        only ruled out if it lies entirely outside one of the sides, so some
+        boxes near the frustum's edges are kept even though they miss it.
+        """
+        overlapping = numpy.ones(len(lower_bounds), dtype=bool)
+        for normal in self.side_normals:
+            # the corner of each box furthest inside this side
+            inner_corners = numpy.where(normal > 0, upper_bounds, lower_bounds)
+            overlapping &= (inner_corners - self.apex).dot(normal) >= 0
+        return overlapping
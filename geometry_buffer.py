@@ -0,0 +1,41 @@
+from util import allocate_array
+
+
+class GeometryBuffer(object):
+    """What each pixel's primary ray hit: the index of the shape (-1 for a
+    miss), the hit point, the surface normal there, the part of the shape hit
+    (see Shape.find_intersections_and_parts) and the ray itself.  None
+    of these depend on lights or materials, so once the buffer is filled,
+    renders that only change those can skip straight to shading.
+
+    fingerprint is the fingerprint_geometry of the scene the buffer was filled
+    for, or None while it is not filled.  Pixels are indexed by the ray
+    generator's (x, y) step numbers.
+    """
+
+    def __init__(self, width, height, shared=False, dtype=float):
+        self.shape_indices = allocate_array((width, height), int, shared)
+        self.points = allocate_array((width, height, 3), dtype, shared)
+        self.surface_normals = allocate_array((width, height, 3), dtype, shared)
+        self.part_indices = allocate_array((width, height), int, shared)
+        self.rays = allocate_array((width, height, 3), dtype, shared)
+        self.fingerprint = None
+
+    def store(self, xs, ys, rays, shape_indices, points, surface_normals, part_indices):
+        self.rays[xs, ys] = rays
+        self.shape_indices[xs, ys] = shape_indices
+        self.points[xs, ys] = points
+        self.surface_normals[xs, ys] = surface_normals
+        self.part_indices[xs, ys] = part_indices
+
+    def load(self, xs, ys):
+        """Return (rays, shape_indices, points, surface_normals, part_indices)
+        for the pixels
+        """
+        return (
+            self.rays[xs, ys],
+            self.shape_indices[xs, ys],
+            self.points[xs, ys],
+            self.surface_normals[xs, ys],
+            self.part_indices[xs, ys]
+        )
@@ -1,24 +1,54 @@
 import sys
 
-from ray_generator import RayGenerator
-from ray_tracer import RayTracer
-import test
+import numpy
+
+from main import RayTracerMain
+from scene_file import load_scene
 
 
 class IndividualRayTester(object):
-    """Traces the ray associated to a single pixel as a debugging aid"""
+    """Traces the rays associated to single pixels, or to a rectangle of
+    them, as a debugging aid
+    """
 
-    def __init__(self, scene, screen_width, screen_height):
-        self.scene = scene
-        self.ray_generator = RayGenerator(scene.direction, screen_width, screen_height)
-        self.ray_tracer = RayTracer(scene)
+    def __init__(self, scene, screen_width, screen_height, **render_options):
+        """Any keyword arguments (e.g. wavefront) are passed on to
+        RayTracerMain
+        """
+        self.ray_tracer_main = RayTracerMain(
+            scene,
+            screen_width,
+            screen_height,
+            num_workers=1,
+            band_height=1,
+            **render_options
+        )
+        self.ray_tracer_main.start_render()
 
     def get_color_for_pixel(self, pixel_x, pixel_y):
-        world_y = self.ray_generator.num_vertical_steps - pixel_y - 1
-        ray = self.ray_generator.create_ray_for_step_numbers(pixel_x, world_y)
-        return self.ray_tracer.find_pixel_color_for_ray(ray, self.scene.position)
+        return self.get_colors_for_region(pixel_x, pixel_x + 1, pixel_y, pixel_y + 1)[0, 0]
+
+    def get_colors_for_region(self, min_x, max_x, min_y, max_y):
+        """The colors of the pixels in the rectangle [min_x, max_x) x [min_y,
+        max_y), counted from the top left corner of the image, as a (rows,
+        columns, 3) array with the top row first
+        """
+        screen_height = self.ray_tracer_main.screen.height
+        world_min_y = screen_height - max_y
+        world_max_y = screen_height - min_y
+        xs, ys, pixel_colors, _ = self.ray_tracer_main.render_region(
+            min_x,
+            max_x,
+            world_min_y,
+            world_max_y
+        )
+        colors = numpy.empty((max_y - min_y, max_x - min_x, 3))
+        colors[world_max_y - ys - 1, xs - min_x] = pixel_colors
+        return colors
 
 
 if __name__ == '__main__':
-    tester = IndividualRayTester(test.plane_test, 300, 300)
-    print tester.get_color_for_pixel(int(sys.argv[1]), int(sys.argv[2]))
+    # e.g. python individual_ray_tester.py scenes/plane_test.json 300 300 150 40
+    scene_filename, screen_width, screen_height, pixel_x, pixel_y = sys.argv[1:6]
+    tester = IndividualRayTester(load_scene(scene_filename), int(screen_width), int(screen_height))
+    print tester.get_color_for_pixel(int(pixel_x), int(pixel_y))
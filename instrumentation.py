@@ -0,0 +1,113 @@
+"""Optional statistics about a render: how many rays of each kind were traced,
+how many ray-shape intersection tests were run and hits found per shape type,
+how deep the rays went, and how long each stage took.
+
+RayTracer, WavefrontRayTracer and Scene each have a statistics attribute that
+is None unless a RenderStatistics is passed to RayTracerMain, and every hook
+checks it first, so instrumentation costs next to nothing when it is off.
+"""
+import collections
+import functools
+import time
+
+
+RAY_KINDS = ['primary', 'reflection', 'refraction', 'shadow', 'shadow_map']
+STAGES = ['generation', 'intersection', 'shading', 'output']
+
+
+class RenderStatistics(object):
+
+    def __init__(self, report=True):
+        """report prints a summary when the render finishes.  Functions added
+        with add_callback are called with this object at the same point.
+        """
+        self.report = report
+        self.callbacks = []
+        self.clear()
+
+    def clear(self):
+        self.ray_counts = collections.Counter()
+        # keyed by the shapes' class names
+        self.intersection_tests = collections.Counter()
+        self.hits = collections.Counter()
+        # number of rays traced at each bounce, 0 for primary rays
+        self.depth_histogram = collections.Counter()
+        self.stage_seconds = collections.Counter()
+
+    def count_rays(self, kind, num_rays=1):
+        self.ray_counts[kind] += num_rays
+
+    def count_intersection_tests(self, shape, num_tests=1):
+        self.intersection_tests[type(shape).__name__] += num_tests
+
+    def count_hits(self, shape, num_hits=1):
+        self.hits[type(shape).__name__] += num_hits
+
+    def record_depth(self, depth, num_rays=1):
+        self.depth_histogram[depth] += num_rays
+
+    def add_stage_time(self, stage, seconds):
+        self.stage_seconds[stage] += seconds
+
+    def merge(self, other):
+        """Add another RenderStatistics's counts (e.g. from a worker) to this one"""
+        self.ray_counts.update(other.ray_counts)
+        self.intersection_tests.update(other.intersection_tests)
+        self.hits.update(other.hits)
+        self.depth_histogram.update(other.depth_histogram)
+        self.stage_seconds.update(other.stage_seconds)
+
+    def take(self):
+        """Return a copy of the counts so far (without the callbacks, so that
+        it can be pickled) and clear them
+        """
+        taken = RenderStatistics(report=False)
+        taken.merge(self)
+        self.clear()
+        return taken
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def finish(self):
+        if self.report:
+            print self.format_report()
+        for callback in self.callbacks:
+            callback(self)
+
+    def format_report(self):
+        lines = ['rays:']
+        for kind in RAY_KINDS:
+            lines.append('  %-12s %d' % (kind, self.ray_counts[kind]))
+        lines.append('intersection tests / hits:')
+        for shape_type in sorted(self.intersection_tests):
+            lines.append('  %-12s %d / %d' % (
+                shape_type,
+                self.intersection_tests[shape_type],
+                self.hits[shape_type]
+            ))
+        lines.append('rays per bounce:')
+        for depth in sorted(self.depth_histogram):
+            lines.append('  %-12d %d' % (depth, self.depth_histogram[depth]))
+        lines.append('seconds:')
+        for stage in STAGES:
+            lines.append('  %-12s %.3f' % (stage, self.stage_seconds[stage]))
+        return '\n'.join(lines)
+
+
+def timed_stage(stage):
+    """Decorator for methods of objects with a statistics attribute, adding the
+    time spent in the method to stage when statistics is on
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def timed_method(self, *args, **kwargs):
+            if self.statistics is None:
+                return method(self, *args, **kwargs)
+            start_time = time.time()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.statistics.add_stage_time(stage, time.time() - start_time)
+        return timed_method
+    return decorator
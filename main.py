@@ -1,60 +1,743 @@
+import multiprocessing
+import time
+
 import numpy
 import png
 
+from fingerprint import fingerprint_geometry
+from fingerprint import fingerprint_render
+from frustum import Frustum
+from geometry_buffer import GeometryBuffer
+from instrumentation import timed_stage
+from parallel import yield_traced_tiles_in_parallel
 from ray_generator import RayGenerator
+from ray_tracer import DEFAULT_MIN_THROUGHPUT
 from ray_tracer import RayTracer
+from shadow_maps import DEFAULT_BIAS
+from shadow_maps import ShadowMaps
+from util import allocate_array
+from util import yield_tiles
+from wavefront_ray_tracer import WavefrontRayTracer
 
 
 ARRAY_ELEMENTS_PER_PIXEL = 3  # because of r,g,b
+MAX_PIXEL_INTENSITY = 255
+# how far, in pixels, tiles' frusta reach past their edges, so that rays on
+# the edges aren't culled by floating point error
+FRUSTUM_MARGIN = 0.01
 
 
 class RayTracerMain(object):
 
-    def __init__(self, scene, screen_width=100, screen_height=100):
+    def __init__(
+        self,
+        scene,
+        screen_width=100,
+        screen_height=100,
+        wavefront=False,
+        num_workers=1,
+        tile_size=32,
+        hdr=False,
+        band_height=None,
+        anti_aliasing=None,
+        statistics=None,
+        geometry_buffer=False,
+        depth=3,
+        min_throughput=DEFAULT_MIN_THROUGHPUT,
+        russian_roulette=False,
+        tile_cache=None,
+        shadow_map_resolution=None,
+        shadow_map_bias=DEFAULT_BIAS,
+        precision=numpy.float64,
+        coordinator=None,
+        region=None,
+        light_samples=None,
+        frustum_culling=None
+    ):
+        """num_workers > 1 splits the screen into tile_size x tile_size tiles
+        and traces them on that many processes.  None uses every CPU.
+
+        hdr keeps the pixel colors as unclamped float32s instead of bytes.
+        band_height holds only that many rows of the image in memory at a
+        time, in which case the image has to be rendered with
+        trace_scene_to_png, which streams each band to the file as it is
+        finished.
+
+        anti_aliasing is an AdaptiveSupersampler to sample each pixel with,
+        or None for a single primary ray through each pixel.
+
+        statistics is a RenderStatistics to collect ray counts and stage
+        timings in, or None to leave instrumentation off.
+
+        geometry_buffer keeps what each pixel's primary ray hit, so that
+        rendering again after changing only lights or materials skips the
+        primary intersections.  The buffer is refilled whenever the camera or
+        any shape's geometry has changed since the last render.  It cannot be
+        combined with anti_aliasing, which has no single primary ray per
+        pixel.
+
+        depth, min_throughput and russian_roulette limit how far reflections
+        and refractions are followed, see RayTracer.
+
+        tile_cache is a TileCache to load tiles rendered before with the same
+        scene and settings from, and to store newly rendered tiles in.  It
+        cannot be combined with geometry_buffer, which needs every tile
+        traced to fill it.
+
+        shadow_map_resolution renders a cube shadow map of that many texels
+        square per face for every light source at the start of each render,
+        and looks shadows up in them instead of tracing shadow rays.  This is
+        much faster with many lights but only approximate, so it is meant for
+        previews; None traces exact shadows.  shadow_map_bias is how far
+        behind the surface in a map a point has to be to be in its shadow,
+        see ShadowMaps.
+
+        precision is the floating point type rays, shapes, intersection
+        distances and colors are computed in.  numpy.float32 halves the memory
+        traffic of the wavefront tracer's batches at the cost of looser
+        tolerances, and converts the scene's shapes in place (see
+        Scene.set_precision), until a float64 RayTracerMain on the scene
+        converts them back.  It needs wavefront, since the single ray
+        tracer's per-ray work gains nothing from it.
+
+        coordinator is a RenderCoordinator to trace the tiles on its workers
+        instead of on this machine.  It cannot be combined with
+        geometry_buffer or tile_cache, which would have to be filled from the
+        workers' processes.
+
+        region is a (min_x, max_x, min_y, max_y) rectangle of pixels, counted
+        from the top left corner of the image, to trace instead of the whole
+        image.  The rest of the image is left black.
+
+        light_samples traces shadow rays to only that many of the lights
+        lighting each point, picked at random, see RayTracer.
+
+        frustum_culling traces primary rays in packets of a tile_size x
+        tile_size tile each (for wavefront, of each region traced in one
+        batch), testing them only against the shapes that the packet's
+        frustum overlaps.  The image is the same either way.  It defaults to
+        on for the wavefront tracer only, since the scalar one tests each ray
+        on its own and gains less than splitting off the primary hits costs.
+        """
+        precision = numpy.dtype(precision)
+        if precision != numpy.float64 and not wavefront:
+            raise ValueError('only the wavefront tracer can trace in %s' % precision)
+        if geometry_buffer and anti_aliasing:
+            raise ValueError('a geometry buffer cannot be used with anti-aliasing')
+        if geometry_buffer and tile_cache:
+            raise ValueError('a geometry buffer cannot be used with a tile cache')
+        if coordinator and (geometry_buffer or tile_cache):
+            raise ValueError('distributed rendering cannot use a geometry buffer or tile cache')
         self.scene = scene
+        if precision != numpy.float64 or scene.dtype != numpy.float64:
+            # converting even when the scene is already in this precision
+            # catches any shapes changed since, like Instances an animation
+            # has moved
+            scene.set_precision(precision)
+        self.precision = precision
         self.ray_generator = RayGenerator(
             self.scene.direction,
+            num_vertical_steps=screen_height,
+            num_horizontal_steps=screen_width,
+            dtype=precision
+        )
+        self.ray_tracer = RayTracer(
+            scene,
+            depth,
+            min_throughput,
+            russian_roulette,
+            light_samples=light_samples
+        )
+        self.wavefront_ray_tracer = None
+        if wavefront:
+            self.wavefront_ray_tracer = WavefrontRayTracer(
+                scene,
+                depth,
+                min_throughput,
+                russian_roulette,
+                light_samples=light_samples
+            )
+        self.russian_roulette = russian_roulette
+        self.light_samples = light_samples
+        self.frustum_culling = wavefront if frustum_culling is None else frustum_culling
+        # lets textures pick mipmap levels
+        self.ray_tracer.pixel_angle = self.ray_generator.find_pixel_angle()
+        if self.wavefront_ray_tracer:
+            self.wavefront_ray_tracer.pixel_angle = self.ray_tracer.pixel_angle
+        self.statistics = statistics
+        self.scene.statistics = statistics
+        self.ray_tracer.statistics = statistics
+        if self.wavefront_ray_tracer:
+            self.wavefront_ray_tracer.statistics = statistics
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.tile_size = tile_size
+        self.anti_aliasing = anti_aliasing
+        self.num_samples = 0
+        self.screen = Screen(
             screen_width,
-            screen_height
+            screen_height,
+            shared=self.num_workers > 1,
+            hdr=hdr,
+            num_rows=band_height
         )
-        self.ray_tracer = RayTracer(scene)
-        self.screen = Screen(screen_width, screen_height)
+        self.geometry_buffer = None
+        if geometry_buffer:
+            self.geometry_buffer = GeometryBuffer(
+                screen_width,
+                screen_height,
+                shared=self.num_workers > 1,
+                dtype=precision
+            )
+        self.reuse_geometry = False
+        self.tile_cache = tile_cache
+        self.shadow_map_resolution = shadow_map_resolution
+        self.shadow_map_bias = shadow_map_bias
+        self.coordinator = coordinator
+        self.region = region
 
     def trace_scene(self):
-        for (x, y), ray in self.ray_generator.yield_primary_rays():
+        if self.screen.num_rows < self.screen.height:
+            raise ValueError('the screen only holds a band of rows, use trace_scene_to_png')
+        self.start_render()
+        if self.region is not None:
+            self.screen.clear()
+        self.trace_rows(0, self.screen.height)
+        self.finish_render()
+
+    def trace_scene_progressively(self, callback, initial_block_size=8):
+        """Trace the scene in passes from coarse to fine, for previews.  The
+        first pass traces one pixel in every initial_block_size x
+        initial_block_size block and fills the block with its color, and each
+        pass after that halves the blocks, tracing only the pixels that
+        haven't been already, until every pixel has been traced.
+        callback(screen, block_size) is called after every pass.
+
+        The passes are traced on this process, without anti-aliasing, the
+        geometry buffer or the tile cache.
+        """
+        if self.screen.num_rows < self.screen.height:
+            raise ValueError('progressive rendering needs the whole screen in memory')
+        if self.anti_aliasing:
+            raise ValueError('progressive rendering cannot be used with anti-aliasing')
+        self.start_render()
+        if self.region is not None:
+            self.screen.clear()
+        if self.uses_random_numbers:
+            self.seed_random_numbers(0)
+
+        min_x, max_x, min_y, max_y = self.find_traced_rectangle(0, self.screen.height)
+        xs, ys = self.ray_generator.build_pixel_coordinates(min_x, max_x, min_y, max_y)
+        # pixels are ordered column by column, so this indexes them by their
+        # offsets from the rectangle's corner
+        num_rows = max_y - min_y
+        x_offsets, y_offsets = xs - min_x, ys - min_y
+        pixel_colors = numpy.zeros((len(xs), 3))
+        traced = numpy.zeros(len(xs), dtype=bool)
+
+        block_size = initial_block_size
+        while block_size >= 1:
+            block_x_offsets = x_offsets - x_offsets % block_size
+            block_y_offsets = y_offsets - y_offsets % block_size
+            # each block is traced at its corner pixel
+            block_corners = block_x_offsets*num_rows + block_y_offsets
+            untraced_corners = numpy.flatnonzero(
+                (block_corners == numpy.arange(len(xs))) & ~traced
+            )
+            rays = self.ray_generator.build_rays_through_screen_points(
+                xs[untraced_corners],
+                ys[untraced_corners]
+            )
+            pixel_colors[untraced_corners] = self.trace_primary_rays(rays)
+            traced[untraced_corners] = True
+            self.num_samples += len(untraced_corners)
+
+            self.write_pixels(xs, ys, pixel_colors[block_corners])
+            callback(self.screen, block_size)
+            block_size //= 2
+        self.finish_render(filled_geometry_buffer=False)
+
+    def trace_scene_to_png(self, filename):
+        """Trace the scene into a png file one band of rows at a time, writing
+        each band out as soon as it is finished
+        """
+        self.start_render()
+        write_png(filename, self.screen.width, self.screen.height, self.yield_traced_rows())
+        self.finish_render()
+
+    def start_render(self):
+        self.num_samples = 0
+        # rebuilt every render, since lights may have changed
+        self.scene.build_light_hierarchy()
+        if self.coordinator is not None:
+            self.coordinator.start_job(
+                self.scene,
+                self.screen.width,
+                self.screen.height,
+                self.build_worker_options(),
+                collect_statistics=self.statistics is not None
+            )
+        if self.shadow_map_resolution:
+            # rebuilt every render, since lights or shapes may have moved
+            shadow_maps = ShadowMaps(
+                self.scene,
+                self.shadow_map_resolution,
+                self.shadow_map_bias
+            )
+            self.ray_tracer.shadow_maps = shadow_maps
+            if self.wavefront_ray_tracer:
+                self.wavefront_ray_tracer.shadow_maps = shadow_maps
+        if self.tile_cache is not None:
+            self.render_fingerprint = fingerprint_render(
+                self.scene,
+                self.ray_generator,
+                self.build_render_settings()
+            )
+        if self.geometry_buffer is not None:
+            self.geometry_fingerprint = fingerprint_geometry(self.scene, self.ray_generator)
+            self.reuse_geometry = self.geometry_buffer.fingerprint == self.geometry_fingerprint
+            # the buffer is only complete once the render finishes
+            self.geometry_buffer.fingerprint = None
+        self.shape_indices_by_id = dict(
+            (id(shape), shape_index) for shape_index, shape in enumerate(self.scene.shapes)
+        )
+
+    def build_render_settings(self):
+        """Everything besides the scene and the camera that affects the image"""
+        return {
+            'wavefront': self.wavefront_ray_tracer is not None,
+            'depth': self.ray_tracer.depth,
+            'min_throughput': self.ray_tracer.min_throughput,
+            'russian_roulette': self.russian_roulette,
+            'light_samples': self.light_samples,
+            'hdr': self.screen.hdr,
+            'anti_aliasing': self.anti_aliasing and self.anti_aliasing.__dict__,
+            'precision': str(self.precision),
+            'shadow_maps': self.shadow_map_resolution and [
+                self.shadow_map_resolution,
+                self.shadow_map_bias
+            ],
+        }
+
+    def build_worker_options(self):
+        """RayTracerMain arguments for tracing this render's tiles in another
+        process
+        """
+        return {
+            'wavefront': self.wavefront_ray_tracer is not None,
+            'hdr': self.screen.hdr,
+            'anti_aliasing': self.anti_aliasing,
+            'depth': self.ray_tracer.depth,
+            'min_throughput': self.ray_tracer.min_throughput,
+            'russian_roulette': self.russian_roulette,
+            'shadow_map_resolution': self.shadow_map_resolution,
+            'shadow_map_bias': self.shadow_map_bias,
+            'precision': self.precision,
+            'light_samples': self.light_samples,
+            'frustum_culling': self.frustum_culling,
+        }
+
+    def finish_render(self, filled_geometry_buffer=True):
+        """filled_geometry_buffer is False for renders that trace around the
+        geometry buffer, which then only still holds this scene's hits if it
+        did before
+        """
+        if self.geometry_buffer is not None and (filled_geometry_buffer or self.reuse_geometry):
+            self.geometry_buffer.fingerprint = self.geometry_fingerprint
+        self.maybe_report_samples()
+        if self.statistics is not None:
+            self.statistics.finish()
+
+    def yield_traced_rows(self):
+        """Trace the screen one band of rows at a time from the top, yielding
+        the finished rows in screen order
+        """
+        num_rows = self.screen.num_rows
+        height = self.screen.height
+        for first_row in xrange(0, height, num_rows):
+            self.maybe_log_progress(first_row, height)
+            self.screen.move_to_rows(first_row)
+            if self.region is not None:
+                self.screen.clear()
+            # screen rows count down from the top of the world's y axis
+            last_row = min(first_row + num_rows, height)
+            self.trace_rows(height - last_row, height - first_row, log_progress=False)
+            for row in self.screen.yield_rows():
+                yield row
+
+    def find_traced_rectangle(self, min_y, max_y):
+        """The part of the rows [min_y, max_y) to trace, as (min_x, max_x,
+        min_y, max_y) in the ray generator's step numbers, which is all of
+        them unless there's a region
+        """
+        if self.region is None:
+            return 0, self.screen.width, min_y, max_y
+        region_min_x, region_max_x, region_min_y, region_max_y = self.region
+        # the region's rows count down from the top of the world's y axis
+        height = self.screen.height
+        return (
+            max(region_min_x, 0),
+            min(region_max_x, self.screen.width),
+            max(min_y, height - region_max_y),
+            min(max_y, height - region_min_y)
+        )
+
+    def trace_rows(self, min_y, max_y, log_progress=True):
+        min_x, max_x, min_y, max_y = self.find_traced_rectangle(min_y, max_y)
+        if min_x >= max_x or min_y >= max_y:
+            return
+        if self.coordinator is not None:
+            self.trace_rows_remotely(min_x, max_x, min_y, max_y, log_progress)
+        elif self.num_workers > 1:
+            self.trace_rows_in_parallel(min_x, max_x, min_y, max_y, log_progress)
+        elif self.anti_aliasing or self.tile_cache or self.uses_random_numbers:
+            # in the same tiles as the process pool, so that the sample budget
+            # is spread the same way and the image comes out the same, the
+            # cached tiles match and random numbers are seeded the same
+            tiles = list(yield_tiles(max_x, max_y, self.tile_size, first_y=min_y, first_x=min_x))
+            for num_traced_tiles, tile in enumerate(tiles):
+                if log_progress:
+                    self.maybe_log_progress(num_traced_tiles, len(tiles))
+                self.num_samples += self.trace_region(*tile)
+        elif self.wavefront_ray_tracer:
+            self.num_samples += self.trace_region(min_x, max_x, min_y, max_y)
+        else:
+            # one column at a time so that progress can be logged
+            for x in xrange(min_x, max_x):
+                if log_progress:
+                    self.maybe_log_progress(x - min_x, max_x - min_x)
+                self.num_samples += self.trace_region(x, x + 1, min_y, max_y)
+
+    def trace_rows_in_parallel(self, min_x, max_x, min_y, max_y, log_progress=True):
+        tiles = list(yield_tiles(max_x, max_y, self.tile_size, first_y=min_y, first_x=min_x))
+        traced_tiles = yield_traced_tiles_in_parallel(self, tiles, self.num_workers)
+        for num_traced_tiles, (num_samples, statistics) in enumerate(traced_tiles):
+            if log_progress:
+                self.maybe_log_progress(num_traced_tiles, len(tiles))
+            self.num_samples += num_samples
+            if statistics is not None:
+                self.statistics.merge(statistics)
+
+    def trace_rows_remotely(self, min_x, max_x, min_y, max_y, log_progress=True):
+        tiles = list(yield_tiles(max_x, max_y, self.tile_size, first_y=min_y, first_x=min_x))
+        traced_tiles = self.coordinator.yield_traced_tiles(tiles)
+        for num_traced_tiles, traced_tile in enumerate(traced_tiles):
+            xs, ys, pixel_values, num_samples, statistics = traced_tile
+            if log_progress:
+                self.maybe_log_progress(num_traced_tiles, len(tiles))
+            self.write_pixels(xs, ys, pixel_values)
+            self.num_samples += num_samples
+            if statistics is not None:
+                self.statistics.merge(statistics)
+
+    def trace_region(self, min_x, max_x, min_y, max_y):
+        """Trace the pixels in the half-open rectangle [min_x, max_x) x
+        [min_y, max_y) and write them to the screen, returning the number of
+        primary rays traced
+        """
+        if self.tile_cache is not None:
+            tile_key = self.tile_cache.build_key(self.render_fingerprint, min_x, max_x, min_y, max_y)
+            pixel_values = self.tile_cache.get(tile_key)
+            if pixel_values is not None:
+                xs, ys = self.ray_generator.build_pixel_coordinates(min_x, max_x, min_y, max_y)
+                self.write_pixels(xs, ys, pixel_values)
+                return 0
+
+        xs, ys, pixel_colors, num_samples = self.render_region(min_x, max_x, min_y, max_y)
+        self.write_pixels(xs, ys, pixel_colors)
+        if self.tile_cache is not None:
+            self.tile_cache.put(tile_key, self.screen.to_pixel_values(pixel_colors))
+        return num_samples
+
+    def render_region(self, min_x, max_x, min_y, max_y):
+        """Trace the pixels in the rectangle without writing them anywhere,
+        returning (xs, ys, pixel_colors, num_samples)
+        """
+        if self.uses_random_numbers:
+            # seeded by the region so that tiles traced on different worker
+            # processes don't share random numbers
+            self.seed_random_numbers(hash((min_x, min_y)) & 0xffffffff)
+        if self.anti_aliasing:
+            # anti-aliased regions are always single tiles
+            culling = self.cull_to_region(min_x, max_x, min_y, max_y) if self.frustum_culling else None
+            xs, ys, pixel_colors, num_samples = self.anti_aliasing.sample_region(
+                self.ray_generator,
+                lambda rays: self.trace_primary_rays(rays, culling=culling),
+                min_x,
+                max_x,
+                min_y,
+                max_y
+            )
+        else:
+            xs, ys, rays, primary_geometry = self.find_primary_rays_and_geometry(
+                min_x,
+                max_x,
+                min_y,
+                max_y
+            )
+            pixel_colors = self.trace_primary_rays(rays, primary_geometry)
+            num_samples = len(rays)
+        return xs, ys, pixel_colors, num_samples
+
+    def find_primary_rays_and_geometry(self, min_x, max_x, min_y, max_y):
+        """Returns (xs, ys, rays, primary_geometry), where primary_geometry is
+        (shape_indices, intersections, surface_normals, part_indices) from the
+        geometry buffer or traced in frustum culled packets, or None if
+        neither is used
+        """
+        if self.geometry_buffer is None:
+            xs, ys, rays = self.build_primary_rays(min_x, max_x, min_y, max_y)
+            if not self.frustum_culling:
+                return xs, ys, rays, None
+            return xs, ys, rays, self.find_primary_geometry_in_packets(rays, min_x, max_x, min_y, max_y)
+
+        if self.reuse_geometry:
+            xs, ys = self.ray_generator.build_pixel_coordinates(min_x, max_x, min_y, max_y)
+            rays, shape_indices, intersections, surface_normals, part_indices = self.geometry_buffer.load(xs, ys)
+            return xs, ys, rays, (shape_indices, intersections, surface_normals, part_indices)
+
+        xs, ys, rays = self.build_primary_rays(min_x, max_x, min_y, max_y)
+        if self.frustum_culling:
+            primary_geometry = self.find_primary_geometry_in_packets(rays, min_x, max_x, min_y, max_y)
+        else:
+            primary_geometry = self.find_primary_geometry(rays)
+        self.geometry_buffer.store(xs, ys, rays, *primary_geometry)
+        return xs, ys, rays, primary_geometry
+
+    def find_primary_geometry_in_packets(self, rays, min_x, max_x, min_y, max_y):
+        """find_primary_geometry for the primary rays of the rectangle (in
+        build_primary_rays' order), one tile_size x tile_size packet at a
+        time, each culled to its tile's frustum
+        """
+        if self.wavefront_ray_tracer:
+            # the rectangle is traced as a single packet, since splitting a
+            # batch up costs the traversal more than the tighter culling saves
+            return self.find_primary_geometry(rays, self.cull_to_region(min_x, max_x, min_y, max_y))
+
+        num_rows = max_y - min_y
+        packet_ray_indices = []
+        packet_geometry = []
+        for tile in yield_tiles(max_x, max_y, self.tile_size, first_y=min_y, first_x=min_x):
+            xs, ys = self.ray_generator.build_pixel_coordinates(*tile)
+            ray_indices = (xs - min_x)*num_rows + ys - min_y
+            packet_ray_indices.append(ray_indices)
+            packet_geometry.append(self.find_primary_geometry(rays[ray_indices], self.cull_to_region(*tile)))
+        order = numpy.argsort(numpy.concatenate(packet_ray_indices))
+        return tuple(numpy.concatenate(arrays)[order] for arrays in zip(*packet_geometry))
+
+    def cull_to_region(self, min_x, max_x, min_y, max_y):
+        """The scene's culling (see Scene.cull_to_frustum) for the frustum
+        around every primary ray through the pixels in the rectangle,
+        including anti-aliasing samples anywhere within them
+        """
+        # pixels span half a step either side of their primary rays
+        corner_xs = numpy.array([min_x, max_x, max_x, min_x]) - 0.5
+        corner_ys = numpy.array([min_y, min_y, max_y, max_y]) - 0.5
+        corner_xs += numpy.array([-1, 1, 1, -1])*FRUSTUM_MARGIN
+        corner_ys += numpy.array([-1, -1, 1, 1])*FRUSTUM_MARGIN
+        corner_rays = self.ray_generator.build_rays_through_screen_points(corner_xs, corner_ys)
+        return self.scene.cull_to_frustum(Frustum(self.scene.position, corner_rays))
+
+    def find_primary_geometry(self, rays, culling=None):
+        """Find what an (N, 3) array of primary rays hit, as (shape_indices,
+        intersections, surface_normals, part_indices).  culling is the scene's culling for a
+        frustum the rays all lie in, or None to test every shape.
+        """
+        if self.wavefront_ray_tracer:
+            positions = numpy.tile(self.scene.position, (len(rays), 1)).astype(self.precision)
+            return self.wavefront_ray_tracer.find_geometry(rays, positions, culling)
+
+        shape_indices = numpy.full(len(rays), -1, dtype=int)
+        intersections = numpy.zeros(rays.shape)
+        surface_normals = numpy.zeros(rays.shape)
+        part_indices = numpy.full(len(rays), -1, dtype=int)
+        for i, ray in enumerate(rays):
+            intersection, shape, part_index = self.ray_tracer.find_closest_intersection_and_shape(
+                ray,
+                self.scene.position,
+                culling
+            )
+            if shape:
+                shape_indices[i] = self.shape_indices_by_id[id(shape)]
+                intersections[i] = intersection
+                surface_normals[i] = shape.build_surface_normal_at_hit(intersection, ray, part_index)
+                if part_index is not None:
+                    part_indices[i] = part_index
+        return shape_indices, intersections, surface_normals, part_indices
+
+    @property
+    def uses_random_numbers(self):
+        return (
+            self.russian_roulette or
+            self.light_samples is not None or
+            numpy.any(self.scene.light_num_samples > 1)
+        )
+
+    def seed_random_numbers(self, seed):
+        self.ray_tracer.random.seed(seed)
+        if self.wavefront_ray_tracer:
+            self.wavefront_ray_tracer.random_state.seed(seed)
+
+    @timed_stage('generation')
+    def build_primary_rays(self, min_x, max_x, min_y, max_y):
+        return self.ray_generator.build_primary_rays(min_x, max_x, min_y, max_y)
+
+    @timed_stage('output')
+    def write_pixels(self, xs, ys, pixel_colors):
+        self.screen.write_pixels(xs, ys, pixel_colors)
+
+    def take_statistics(self):
+        """Return the statistics collected so far and start over, for worker
+        processes to send theirs back
+        """
+        if self.statistics is None:
+            return None
+        return self.statistics.take()
+
+    def trace_primary_rays(self, rays, primary_geometry=None, culling=None):
+        """Return the (N, 3) colors of an (N, 3) array of rays from the camera,
+        given what they hit (as returned by find_primary_geometry) if it is
+        already known.  Otherwise culling is the scene's culling for a frustum
+        the rays all lie in, or None to test them against every shape.
+        """
+        if primary_geometry is None and culling is not None:
+            primary_geometry = self.find_primary_geometry(rays, culling)
+        if self.statistics is None:
+            return self._trace_primary_rays(rays, primary_geometry)
+
+        self.statistics.count_rays('primary', len(rays))
+        intersection_seconds = self.statistics.stage_seconds['intersection']
+        start_time = time.time()
+        pixel_colors = self._trace_primary_rays(rays, primary_geometry)
+        # shading is everything but the intersection queries made meanwhile
+        self.statistics.add_stage_time(
+            'shading',
+            time.time() - start_time -
+            (self.statistics.stage_seconds['intersection'] - intersection_seconds)
+        )
+        return pixel_colors
+
+    def _trace_primary_rays(self, rays, primary_geometry=None):
+        if self.wavefront_ray_tracer:
+            positions = numpy.tile(self.scene.position, (len(rays), 1)).astype(self.precision)
+            return self.wavefront_ray_tracer.find_pixel_colors_for_rays(
+                rays,
+                positions,
+                primary_geometry
+            )
+
+        pixel_colors = numpy.empty(rays.shape)
+        if primary_geometry is not None:
+            if self.statistics is not None:
+                self.statistics.record_depth(0, len(rays))
+            shape_indices, intersections, surface_normals, part_indices = primary_geometry
+            for i, ray in enumerate(rays):
+                if shape_indices[i] < 0:
+                    pixel_colors[i] = self.scene.background_color
+                else:
+                    pixel_colors[i] = self.ray_tracer.shade_intersection(
+                        ray,
+                        self.scene.shapes[shape_indices[i]],
+                        intersections[i],
+                        surface_normals[i],
+                        part_index=part_indices[i]
+                    )
+            return pixel_colors
+
+        for i, ray in enumerate(rays):
             # TODO: create a ray class to encapsulate ray + position so this
             # class doesn't have to know about the scene
-            pixel_color = self.ray_tracer.find_pixel_color_for_ray(
+            pixel_colors[i] = self.ray_tracer.find_pixel_color_for_ray(
                 ray,
                 self.scene.position
             )
-            self.screen.write_pixel(x, y, pixel_color)
+        return pixel_colors
 
+    def maybe_log_progress(self, num_done, num_total):
+        if num_done % max(1, num_total/10) == 0:
+            print '%d percent' % round(100.0*num_done/num_total)
+
+    def maybe_report_samples(self):
+        if self.anti_aliasing:
+            num_pixels = self.screen.width*self.screen.height
+            print '%d samples, %.2f per pixel' % (
+                self.num_samples,
+                float(self.num_samples)/num_pixels
+            )
+
+    @timed_stage('output')
     def export_png(self, filename):
         self.screen.dump_to_png(filename)
 
 
 class Screen(object):
+    """Pixel colors, one byte per channel (or a float32 per channel for hdr).
+    num_rows < height holds only a band of that many rows, starting at screen
+    row first_row; move_to_rows moves the band down the image.
+    """
 
-    def __init__(self, width=100, height=100):
+    def __init__(self, width=100, height=100, shared=False, hdr=False, num_rows=None):
         self.width = width
         self.height = height
-        self.screen = numpy.empty(
-            [self.height, self.width*ARRAY_ELEMENTS_PER_PIXEL],
-            dtype=int
+        self.hdr = hdr
+        self.num_rows = min(num_rows or height, height)
+        self.first_row = 0
+        self.screen = allocate_array(
+            [self.num_rows, self.width*ARRAY_ELEMENTS_PER_PIXEL],
+            numpy.float32 if hdr else numpy.uint8,
+            shared=shared
         )
 
+    def move_to_rows(self, first_row):
+        self.first_row = first_row
+
+    def clear(self):
+        self.screen[:] = 0
+
     def write_pixel(self, x, y, color):
         # because computer graphics usually starts with increasing y moving
         # downward in the image, need to transform the world coordinates to
         # screen coordinates
-        screen_y = self.height - y - 1
+        screen_y = self.height - y - 1 - self.first_row
 
         min_x = ARRAY_ELEMENTS_PER_PIXEL * x
         max_x = ARRAY_ELEMENTS_PER_PIXEL * (x + 1)
-        self.screen[screen_y][min_x:max_x] = color
+        self.screen[screen_y][min_x:max_x] = self._clamp(color)
+
+    def write_pixels(self, xs, ys, colors):
+        """Batched version of write_pixel for arrays of coordinates and an
+        (N, 3) array of colors
+        """
+        screen_ys = self.height - ys - 1 - self.first_row
+        pixels = self.screen.reshape(self.num_rows, self.width, ARRAY_ELEMENTS_PER_PIXEL)
+        pixels[screen_ys, xs] = self._clamp(colors)
+
+    def _clamp(self, colors):
+        if self.hdr:
+            return colors
+        return numpy.clip(colors, 0, MAX_PIXEL_INTENSITY)
+
+    def to_pixel_values(self, colors):
+        """colors as they are stored in the screen"""
+        return numpy.asarray(self._clamp(colors)).astype(self.screen.dtype)
+
+    def yield_rows(self):
+        """Yield the band's rows (all of them, for a whole screen) as bytes"""
+        num_rows = min(self.num_rows, self.height - self.first_row)
+        for row in self.screen[:num_rows]:
+            if self.hdr:
+                row = numpy.clip(row, 0, MAX_PIXEL_INTENSITY).astype(numpy.uint8)
+            yield row
 
     def dump_to_png(self, filename):
-        png_writer = png.Writer(self.width, self.height)
-        with open(filename, 'wb') as png_file:
-            png_writer.write(png_file, self.screen)
+        if self.num_rows < self.height:
+            raise ValueError('the screen only holds a band of rows')
+        write_png(filename, self.width, self.height, self.yield_rows())
+
+
+def write_png(filename, width, height, rows):
+    """Write an 8 bit rgb png from an iterable of rows, which pypng consumes
+    and compresses as they come
+    """
+    png_writer = png.Writer(width, height, greyscale=False)
+    with open(filename, 'wb') as png_file:
+        png_writer.write(png_file, rows)
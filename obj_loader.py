@@ -0,0 +1,45 @@
+import array
+
+import numpy
+
+
+def load_obj(filename):
+    """Read the vertices and faces of a Wavefront OBJ file, one line at a time,
+    into compact arrays.  Returns (vertices, indices): a (V, 3) float array of
+    vertex positions and a (T, 3) int array of the vertex indices of each
+    triangle.  Polygons with more than three vertices are split into triangle
+    fans, and everything other than vertices and faces is ignored.
+    """
+    vertices = array.array('d')
+    indices = array.array('l')
+    num_vertices = 0
+    with open(filename) as obj_file:
+        for line in obj_file:
+            fields = line.split()
+            if not fields:
+                continue
+
+            if fields[0] == 'v':
+                vertices.extend(float(coordinate) for coordinate in fields[1:4])
+                num_vertices += 1
+            elif fields[0] == 'f':
+                face = [
+                    _parse_vertex_index(vertex, num_vertices) for vertex in fields[1:]
+                ]
+                for i in xrange(1, len(face) - 1):
+                    indices.extend((face[0], face[i], face[i + 1]))
+
+    return (
+        numpy.frombuffer(vertices, dtype=float).reshape(-1, 3),
+        numpy.frombuffer(indices, dtype=int).reshape(-1, 3)
+    )
+
+
+def _parse_vertex_index(face_vertex, num_vertices):
+    """Face vertices look like v, v/vt, v//vn or v/vt/vn, where v counts from 1,
+    or backwards from the most recent vertex if negative
+    """
+    vertex_index = int(face_vertex.split('/')[0])
+    if vertex_index < 0:
+        return num_vertices + vertex_index
+    return vertex_index - 1
@@ -0,0 +1,75 @@
+"""Traces tiles of a RayTracerMain's screen, or whole frames of an animation,
+on a pool of worker processes.
+
+The workers are forked with a copy of the RayTracerMain, whose Screen must be
+backed by shared memory: each worker writes its tiles straight into the
+parent's framebuffer, so only tile coordinates pass through the pool.
+Animation workers are forked with the SequenceRenderer and its scene, and
+write their frames to disk themselves, so only frame numbers pass through.
+"""
+import multiprocessing
+
+
+# set in each worker process by _initialize_worker
+_ray_tracer_main = None
+_sequence_renderer = None
+
+
+def yield_traced_tiles_in_parallel(ray_tracer_main, tiles, num_workers):
+    """Trace tiles (as (min_x, max_x, min_y, max_y) tuples) on num_workers
+    processes, yielding the number of primary rays traced for each tile and
+    the worker's RenderStatistics for it (None when instrumentation is off)
+    as it finishes
+    """
+    return _yield_results_in_parallel(
+        _trace_tile,
+        tiles,
+        num_workers,
+        initargs=(ray_tracer_main, None)
+    )
+
+
+def yield_rendered_frames_in_parallel(sequence_renderer, frames, num_workers):
+    """Render frames of an animation on num_workers processes, yielding each
+    frame number as its png is written
+    """
+    return _yield_results_in_parallel(
+        _render_frame,
+        frames,
+        num_workers,
+        initargs=(None, sequence_renderer)
+    )
+
+
+def _yield_results_in_parallel(function, items, num_workers, initargs):
+    pool = multiprocessing.Pool(
+        num_workers,
+        initializer=_initialize_worker,
+        initargs=initargs
+    )
+    try:
+        for result in pool.imap_unordered(function, items):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _initialize_worker(ray_tracer_main, sequence_renderer):
+    global _ray_tracer_main
+    global _sequence_renderer
+    _ray_tracer_main = ray_tracer_main
+    _sequence_renderer = sequence_renderer
+
+
+def _trace_tile(tile):
+    num_samples = _ray_tracer_main.trace_region(*tile)
+    return num_samples, _ray_tracer_main.take_statistics()
+
+
+def _render_frame(frame):
+    _sequence_renderer.render_frame(frame)
+    return frame
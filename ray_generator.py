@@ -1,3 +1,5 @@
+import itertools
+
 import numpy
 
 from util import normalize
@@ -12,25 +14,36 @@ class RayGenerator(object):
         num_vertical_steps,
         num_horizontal_steps,
         horiz_fov_angle=numpy.pi/6.0,
-        vert_fov_angle=numpy.pi/6.0
+        vert_fov_angle=None,
+        dtype=float
     ):
+        """dtype is the precision of the rays built"""
+        self.dtype = numpy.dtype(dtype)
         self.num_vertical_steps = num_vertical_steps
         self.num_horizontal_steps = num_horizontal_steps
 
-        vertical_step_size = 2*numpy.sin(vert_fov_angle/2)/self.num_vertical_steps
         horizontal_step_size = 2*numpy.sin(horiz_fov_angle/2)/self.num_horizontal_steps
+        if vert_fov_angle is None:
+            # keep pixels square, so the vertical field of view follows from
+            # the screen's aspect ratio rather than being stretched to match
+            # the horizontal one
+            vertical_step_size = horizontal_step_size
+        else:
+            vertical_step_size = 2*numpy.sin(vert_fov_angle/2)/self.num_vertical_steps
 
         # make sure direction is a unit vector and then find right and up vectors
         direction = normalize(direction)
         right_vector, up_vector = self.find_right_and_up_vectors(direction)
 
-        self.horizontal_increment = right_vector * horizontal_step_size
-        self.vertical_increment = up_vector * vertical_step_size
+        self.horizontal_increment = (right_vector * horizontal_step_size).astype(self.dtype)
+        self.vertical_increment = (up_vector * vertical_step_size).astype(self.dtype)
+
+        # TODO: keep d as a unit vector and set step size = 2*d*tan(fov_angle/2)
+        self.direction = (direction * numpy.cos(horiz_fov_angle)).astype(self.dtype)
 
-        # TODO: support non-square screen (keep d as a unit vector and set
-        # step size = 2*d*tan(fov_angle/2).  But unclear how strictly to tie
-        # screen aspect ratio to fov angle ratio
-        self.direction = direction * numpy.cos(vert_fov_angle)
+    def find_pixel_angle(self):
+        """The angle a pixel at the center of the screen spans"""
+        return numpy.linalg.norm(self.horizontal_increment)/numpy.linalg.norm(self.direction)
 
     def find_right_and_up_vectors(self, direction_unit_vector):
         right_unit_vector = numpy.cross(direction_unit_vector, Z_UNIT_VECTOR)
@@ -39,17 +52,51 @@ class RayGenerator(object):
 
     def yield_primary_rays(self):
         # Note that this does not return unit vectors
-        for i in xrange(self.num_horizontal_steps):
-            self.maybe_log_progress(i)
-            for j in xrange(self.num_vertical_steps):
-                coords = (i, j)
-                yield coords, self.create_ray_for_step_numbers(i, j)
+        xs, ys, rays = self.build_primary_rays()
+        for x, y, ray in itertools.izip(xs, ys, rays):
+            yield (x, y), ray
+
+    def build_primary_rays(self, min_x=0, max_x=None, min_y=0, max_y=None):
+        """Build the primary rays for every pixel in the half-open rectangle
+        [min_x, max_x) x [min_y, max_y) (the whole screen by default) at once.
+
+        Returns (xs, ys, rays) where xs and ys are the pixel coordinates and
+        rays is an (N, 3) array.  Pixels are ordered column by column, the same
+        order yield_primary_rays has always used.  Like create_ray_for_step_numbers,
+        this does not return unit vectors.
+        """
+        xs, ys = self.build_pixel_coordinates(min_x, max_x, min_y, max_y)
+        return xs, ys, self.build_rays_through_screen_points(xs, ys)
+
+    def build_pixel_coordinates(self, min_x=0, max_x=None, min_y=0, max_y=None):
+        """The xs and ys of build_primary_rays without the rays"""
+        if max_x is None:
+            max_x = self.num_horizontal_steps
+        if max_y is None:
+            max_y = self.num_vertical_steps
+
+        column_numbers = numpy.arange(min_x, max_x)
+        row_numbers = numpy.arange(min_y, max_y)
+        xs = numpy.repeat(column_numbers, len(row_numbers))
+        ys = numpy.tile(row_numbers, len(column_numbers))
+        return xs, ys
+
+    def build_rays_through_screen_points(self, xs, ys):
+        """Build rays through arrays of (possibly fractional) screen
+        coordinates, where integer coordinates give the pixels' primary rays.
+        Used to sample within a pixel for anti-aliasing.
+        """
+        horizontal_offsets = (
+            self.horizontal_increment *
+            (xs - self.num_horizontal_steps/2).astype(self.dtype)[:, numpy.newaxis]
+        )
+        vertical_offsets = (
+            self.vertical_increment *
+            (ys - self.num_vertical_steps/2).astype(self.dtype)[:, numpy.newaxis]
+        )
+        return self.direction + horizontal_offsets + vertical_offsets
 
     def create_ray_for_step_numbers(self, horizontal_step_number, vertical_step_number):
         horizontal_offset = self.horizontal_increment * (horizontal_step_number - self.num_horizontal_steps/2)
         vertical_offset = self.vertical_increment * (vertical_step_number - self.num_vertical_steps/2)
         return self.direction + horizontal_offset + vertical_offset
-
-    def maybe_log_progress(self, column_number):
-        if column_number % (self.num_horizontal_steps/10) == 0:
-            print '%d percent' % round(100.0*column_number/self.num_horizontal_steps)
@@ -1,20 +1,93 @@
+import bisect
+import random
+
 import numpy
 import png
 
+from area_lights import build_light_samples
+from area_lights import find_occluded_samples
 from util import normalize
 
 
+# reflections and refractions contributing less than this fraction of full
+# intensity can't change an 8 bit pixel
+DEFAULT_MIN_THROUGHPUT = 1/255.0
+
+
 class RayTracer(object):
 
-    def __init__(self, scene):
+    def __init__(
+        self,
+        scene,
+        depth=3,
+        min_throughput=DEFAULT_MIN_THROUGHPUT,
+        russian_roulette=False,
+        seed=None,
+        light_samples=None
+    ):
+        """Reflections and refractions are traced up to depth bounces deep,
+        but not once the product of the weights (specular or transparency)
+        along the path, its throughput, falls below min_throughput.  With
+        russian_roulette such branches are traced with probability
+        throughput/min_throughput instead, and weighted up to make up for the
+        ones that aren't.
+
+        light_samples traces shadow rays to only that many of the lights
+        lighting a point, picked at random in proportion to their unshadowed
+        contributions and weighted to keep the expected shading the same.
+        None traces them to every light.
+        """
         self.scene = scene
+        self.depth = depth
+        self.min_throughput = min_throughput
+        self.russian_roulette = russian_roulette
+        self.light_samples = light_samples
+        self.random = random.Random(seed)
+        # a RenderStatistics when instrumentation is on
+        self.statistics = None
+        # ShadowMaps to look shadows up in instead of tracing shadow rays
+        self.shadow_maps = None
+        # the angle a pixel spans, for textures to filter over, see
+        # find_footprint
+        self.pixel_angle = None
 
-    def find_pixel_color_for_ray(self, ray, position, depth=3):
-        intersection, shape = self.find_closest_intersection_and_shape(ray, position)
+    def find_pixel_color_for_ray(self, ray, position, depth=None, throughput=1):
+        if depth is None:
+            depth = self.depth
+        if self.statistics is not None:
+            self.statistics.record_depth(self.depth - depth)
+        intersection, shape, part_index = self.find_closest_intersection_and_shape(ray, position)
         if not shape:
             return self.scene.background_color
 
-        surface_normal = shape.build_surface_normal_at_point_for_ray(intersection, ray)
+        surface_normal = shape.build_surface_normal_at_hit(intersection, ray, part_index)
+        return self.shade_intersection(
+            ray,
+            shape,
+            intersection,
+            surface_normal,
+            depth,
+            throughput,
+            part_index
+        )
+
+    def shade_intersection(
+        self,
+        ray,
+        shape,
+        intersection,
+        surface_normal,
+        depth=None,
+        throughput=1,
+        part_index=None
+    ):
+        """The color seen along ray where it hits shape at intersection.  This
+        is where find_pixel_color_for_ray goes once it has found the hit, and
+        can be called directly to re-shade a cached hit.  part_index is the
+        part of shape hit, see Shape.find_intersection_and_part.
+        """
+        if depth is None:
+            depth = self.depth
         incident_ray_unit = normalize(ray)
 
         lambert_shaded_color = self.get_lambert_shaded_color(
@@ -27,14 +100,17 @@ class RayTracer(object):
             intersection,
             surface_normal,
             incident_ray_unit,
-            depth
+            depth,
+            throughput
         )
         refraction_color = self.get_refraction_color(
             shape,
             intersection,
             surface_normal,
             incident_ray_unit,
-            depth
+            depth,
+            throughput,
+            part_index
         )
 
         # TODO: more physical way to combine these?
@@ -45,21 +121,8 @@ class RayTracer(object):
         # TODO: is there a smarter way to do this?
         return numpy.array([min(255, element) for element in pixel_color])
 
-    def find_closest_intersection_and_shape(self, ray, position):
-        best_distance_to_intersection = None
-        # maybe should keep these two together in an object (namedtuple?)
-        closest_intersection = None
-        closest_shape = None
-        for intersection, shape in self.scene.yield_intersections_and_shapes(ray, position):
-            distance_to_intersection = numpy.linalg.norm(intersection - position)
-            if (
-                best_distance_to_intersection is None
-                or distance_to_intersection < best_distance_to_intersection
-            ):
-                best_distance_to_intersection = distance_to_intersection
-                closest_intersection = intersection
-                closest_shape = shape
-        return closest_intersection, closest_shape
+    def find_closest_intersection_and_shape(self, ray, position, culling=None):
+        return self.scene.find_closest_intersection_and_shape(ray, position, culling)
 
     def get_lambert_shaded_color(self, shape, intersection, surface_normal):
         normalized_lambert_factor = self.generate_lambert_factor(
@@ -67,37 +130,136 @@ class RayTracer(object):
             surface_normal
         )
         shaded_color = (
-            shape.get_color_at_point(intersection) *
+            shape.get_color_at_point(intersection, self.find_footprint(intersection)) *
             normalized_lambert_factor *
             (1 - shape.transparency)
         )
         return shaded_color
 
+    def find_footprint(self, point):
+        """Roughly how wide a pixel's footprint is at point: its distance
+        from the camera times pixel_angle, as though reflections and
+        refractions didn't spread rays any further.  None without a
+        pixel_angle.
+        """
+        if self.pixel_angle is None:
+            return None
+        return numpy.linalg.norm(point - self.scene.position)*self.pixel_angle
+
     def generate_lambert_factor(self, point, surface_normal):
-        lambert_factor = 0
-        for path in self.scene.yield_paths_to_light_sources_from_point(point):
-            if not self.is_path_obstructed(point, path):
+        # (light index, path, lambert contribution, area light samples or
+        # None) of the lights facing point
+        lights = []
+        for light_index, path, intensity in self.scene.yield_lights_for_point(point):
+            samples = None
+            # shadow maps treat area lights as points at their centers
+            if self.scene.light_sources[light_index].num_samples > 1 and self.shadow_maps is None:
+                samples = build_light_samples(
+                    self.scene,
+                    point[numpy.newaxis],
+                    surface_normal[numpy.newaxis],
+                    numpy.array([light_index]),
+                    self.random_sample
+                )
+                lambert_contribution = samples[3].sum()
+            else:
                 path_normal = normalize(path)
-                lambert_contribution = numpy.dot(surface_normal, path_normal)
-                if lambert_contribution > 0:
-                    lambert_factor += lambert_contribution
+                lambert_contribution = numpy.dot(surface_normal, path_normal)*intensity
+            if lambert_contribution > 0:
+                lights.append((light_index, path, lambert_contribution, samples))
+        if self.light_samples is not None and len(lights) > self.light_samples:
+            lights = self.sample_lights(lights)
+        if self.shadow_maps is not None and lights:
+            # looked up for just the lights kept, by light index
+            light_indices = [light_index for light_index, _, _, _ in lights]
+            occluded = dict(zip(light_indices, self.shadow_maps.find_occluded(
+                point[numpy.newaxis],
+                surface_normal[numpy.newaxis],
+                numpy.zeros(len(light_indices), dtype=int),
+                numpy.array(light_indices)
+            )))
+
+        lambert_factor = 0
+        for light_index, path, lambert_contribution, samples in lights:
+            if samples is not None:
+                lambert_factor += lambert_contribution*self.find_area_light_visibility(point, samples)
+                continue
+            if self.shadow_maps is not None:
+                obstructed = occluded[light_index]
+            else:
+                if self.statistics is not None:
+                    self.statistics.count_rays('shadow')
+                obstructed = self.is_path_obstructed(path, point)
+            if not obstructed:
+                lambert_factor += lambert_contribution
         return min(lambert_factor, 1)
 
+    def find_area_light_visibility(self, point, samples):
+        """The unshadowed fraction of an area light's lambert contribution,
+        given its samples for point from build_light_samples.  The samples'
+        shadow rays are traced in batches.
+        """
+        _, sample_indices, paths, lambert_contributions = samples
+        occluded = find_occluded_samples(
+            self.scene,
+            numpy.tile(point, (len(paths), 1)),
+            paths,
+            numpy.zeros(len(paths), dtype=int),
+            sample_indices,
+            self.statistics
+        )
+        return lambert_contributions[~occluded].sum()/lambert_contributions.sum()
+
+    def sample_lights(self, lights):
+        """Pick light_samples of the (light index, path, lambert contribution,
+        samples) lights, with replacement and in proportion to their
+        contributions, each picked light contributing the lights' total over
+        light_samples
+        """
+        cumulative_contributions = []
+        total_contribution = 0
+        for _, _, lambert_contribution, _ in lights:
+            total_contribution += lambert_contribution
+            cumulative_contributions.append(total_contribution)
+
+        picked_lights = []
+        for _ in xrange(self.light_samples):
+            picked = bisect.bisect_right(
+                cumulative_contributions,
+                self.random.random()*total_contribution
+            )
+            light_index, path, _, samples = lights[min(picked, len(lights) - 1)]
+            picked_lights.append((light_index, path, total_contribution/self.light_samples, samples))
+        return picked_lights
+
+    def random_sample(self, shape):
+        """numpy.random.random_sample, drawn from self.random"""
+        return numpy.array([
+            self.random.random() for _ in xrange(int(numpy.prod(shape)))
+        ]).reshape(shape)
+
     def get_specular_color(
         self,
         shape,
         intersection,
         surface_normal,
         incident_ray_unit,
-        depth
+        depth,
+        throughput=1
     ):
         if not shape.specular or depth == 0:
             return numpy.array([0,0,0])
+        weight = self.find_branch_weight(shape.specular, throughput)
+        if not weight:
+            return numpy.array([0,0,0])
 
-        specular_contribution = shape.specular * self.find_pixel_color_for_ray(
+        if self.statistics is not None:
+            self.statistics.count_rays('reflection')
+        specular_contribution = weight * self.find_pixel_color_for_ray(
             self.generate_reflected_ray(incident_ray_unit, surface_normal),
             intersection,
-            depth-1
+            depth-1,
+            throughput*weight
         )
         return specular_contribution
 
@@ -115,12 +277,19 @@ class RayTracer(object):
         intersection,
         surface_normal,
         incident_ray_unit,
-        depth
+        depth,
+        throughput=1,
+        part_index=None
     ):
         if not shape.transparency or depth == 0:
             return numpy.array([0,0,0])
+        weight = self.find_branch_weight(shape.transparency, throughput)
+        if not weight:
+            return numpy.array([0,0,0])
 
-        if shape.ray_originates_inside(intersection, incident_ray_unit):
+        if self.statistics is not None:
+            self.statistics.count_rays('refraction')
+        if shape.ray_originates_inside_at_hit(intersection, incident_ray_unit, part_index):
             n1 = shape.index_of_refraction
             n2 = 1  # for now only allowing refraction with air and shape
         else:
@@ -132,13 +301,28 @@ class RayTracer(object):
             n1,
             n2
         )
-        refraction_contribution = shape.transparency * self.find_pixel_color_for_ray(
+        refraction_contribution = weight * self.find_pixel_color_for_ray(
             refracted_ray_unit,
             intersection,
-            depth-1
+            depth-1,
+            throughput*weight
         )
         return refraction_contribution
 
+    def find_branch_weight(self, weight, throughput):
+        """The weight to give a reflected or refracted ray of the given weight
+        spawned by a ray of the given throughput, or 0 not to trace it
+        """
+        branch_throughput = throughput*weight
+        if branch_throughput >= self.min_throughput:
+            return weight
+        if not self.russian_roulette:
+            return 0
+        survival_probability = branch_throughput/self.min_throughput
+        if self.random.random() >= survival_probability:
+            return 0
+        return weight/survival_probability
+
     def generate_refracted_ray(self, incident_ray_unit, surface_normal, n1, n2):
         # Snell's law says sin(incident_angle)/sin(refreacted_angle) =
         # (index_of_refraction1)/(index_of_refraction)
@@ -162,9 +346,4 @@ class RayTracer(object):
         Note that ray describes the entire path, not just the direction of the
         path, so the obstruction must occur along the length of the ray.
         """
-        path_length = numpy.linalg.norm(ray)
-        for obstruction_point, _ in self.scene.yield_intersections_and_shapes(ray, position):
-            dist_to_obstruction = numpy.linalg.norm(obstruction_point - position)
-            if dist_to_obstruction <= path_length:
-                return True
-        return False
+        return self.scene.is_segment_occluded(position, ray, max_distance=1)
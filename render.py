@@ -0,0 +1,95 @@
+"""Renders a single scene file to a png:
+
+    python render.py scenes/complex_scene.json --width 700 --height 700 --output test.png
+"""
+import argparse
+
+import numpy
+
+from anti_aliasing import AdaptiveSupersampler
+from distributed import RenderCoordinator
+from distributed import start_local_workers
+from instrumentation import RenderStatistics
+from main import RayTracerMain
+from scene_file import load_scene
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Render a scene file to a png')
+    parser.add_argument('scene_file')
+    parser.add_argument('--output', default='out.png')
+    parser.add_argument('--width', type=int, default=100)
+    parser.add_argument('--height', type=int, default=100)
+    parser.add_argument('--wavefront', action='store_true',
+                        help='trace each bounce depth as one batch')
+    parser.add_argument('--num-workers', type=int, default=1,
+                        help='number of processes to trace tiles on, 0 for every CPU')
+    parser.add_argument('--tile-size', type=int, default=32)
+    parser.add_argument('--listen', metavar='HOST:PORT',
+                        help='trace tiles on workers started with distributed.py HOST PORT')
+    parser.add_argument('--local-workers', type=int, default=0,
+                        help='start this many distributed workers on this machine')
+    parser.add_argument('--band-height', type=int,
+                        help='only hold this many rows in memory, streaming them to the png')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--float32', action='store_true',
+                        help='trace in single precision (needs --wavefront)')
+    parser.add_argument('--anti-aliasing', action='store_true')
+    parser.add_argument('--shadow-maps', type=int, metavar='RESOLUTION',
+                        help='look shadows up in cube shadow maps of this resolution, for previews')
+    parser.add_argument('--light-samples', type=int,
+                        help='trace shadow rays to only this many lights per point, picked at random')
+    parser.add_argument('--frustum-culling', dest='frustum_culling', action='store_true', default=None,
+                        help='test primary rays only against the shapes in their tile (default with --wavefront)')
+    parser.add_argument('--no-frustum-culling', dest='frustum_culling', action='store_false',
+                        help='test primary rays against every shape instead of those in their tile')
+    parser.add_argument('--region', type=int, nargs=4, metavar=('MIN_X', 'MAX_X', 'MIN_Y', 'MAX_Y'),
+                        help='only trace this rectangle of pixels, from the top left corner')
+    parser.add_argument('--progressive', action='store_true',
+                        help='trace from coarse to fine, rewriting the png after every pass')
+    parser.add_argument('--statistics', action='store_true',
+                        help='print ray counts and stage timings')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    coordinator = None
+    if args.listen or args.local_workers:
+        host, _, port = (args.listen or 'localhost:0').rpartition(':')
+        coordinator = RenderCoordinator(host, int(port))
+        print 'listening for workers on %s:%d' % coordinator.address
+        start_local_workers(coordinator.address, args.local_workers)
+
+    program = RayTracerMain(
+        load_scene(args.scene_file),
+        args.width,
+        args.height,
+        wavefront=args.wavefront,
+        num_workers=args.num_workers,
+        tile_size=args.tile_size,
+        band_height=args.band_height,
+        depth=args.depth,
+        anti_aliasing=AdaptiveSupersampler() if args.anti_aliasing else None,
+        shadow_map_resolution=args.shadow_maps,
+        precision=numpy.float32 if args.float32 else numpy.float64,
+        statistics=RenderStatistics() if args.statistics else None,
+        coordinator=coordinator,
+        region=args.region,
+        light_samples=args.light_samples,
+        frustum_culling=args.frustum_culling
+    )
+    try:
+        if args.progressive:
+            program.trace_scene_progressively(
+                lambda screen, block_size: screen.dump_to_png(args.output)
+            )
+        else:
+            program.trace_scene_to_png(args.output)
+    finally:
+        if coordinator is not None:
+            coordinator.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,14 @@
+import numpy
+
+from bvh import BoundingVolumeHierarchy
 from colors import BLACK
+from instrumentation import timed_stage
+from util import dot_rows
+
+
+# lights are culled where their intensity falls below this, since they can
+# barely change an 8 bit pixel there
+MIN_LIGHT_CONTRIBUTION = 1/255.0
 
 
 class Scene(object):
@@ -9,13 +19,161 @@ class Scene(object):
         direction,
         background_color=BLACK,
         shapes=None,
-        light_sources=None
+        light_sources=None,
+        min_light_contribution=MIN_LIGHT_CONTRIBUTION
     ):
         self.position = position
         self.direction = direction
         self.background_color = background_color
         self.shapes = shapes or []
         self.light_sources = light_sources or []
+        self.min_light_contribution = min_light_contribution
+        # a RenderStatistics when instrumentation is on
+        self.statistics = None
+        # the precision of the shapes and of batched queries, see set_precision
+        self.dtype = numpy.dtype(float)
+        self.build_acceleration_structure()
+        self.build_light_hierarchy()
+
+    def __getstate__(self):
+        # statistics stay with the process collecting them when the scene is
+        # sent to another
+        state = dict(self.__dict__)
+        state['statistics'] = None
+        return state
+
+    def set_precision(self, dtype):
+        """Convert the shapes' vectors and colors and the bounding volume
+        hierarchies to dtype, so that batched queries on rays of that dtype
+        run in it.  Converting back to float64 restores the original values
+        exactly.  Shapes changed afterwards (e.g. moved Instances) need to
+        be converted again.
+        """
+        self.dtype = numpy.dtype(dtype)
+        for shape in self.shapes:
+            shape.set_precision(self.dtype)
+        self.bvh.set_precision(self.dtype)
+
+    def build_acceleration_structure(self):
+        """Build a bounding volume hierarchy over the bounded shapes.  Shapes
+        without a bounding box (e.g. planes) are kept in a list that every ray
+        is tested against.  This must be called again after changing the
+        scene's shapes.
+        """
+        self.unbounded_shape_indices = []
+        bounded_shape_indices = []
+        lower_bounds = []
+        upper_bounds = []
+        for shape_index, shape in enumerate(self.shapes):
+            bounding_box = shape.get_bounding_box()
+            if bounding_box is None:
+                self.unbounded_shape_indices.append(shape_index)
+            else:
+                bounded_shape_indices.append(shape_index)
+                lower_bounds.append(bounding_box[0])
+                upper_bounds.append(bounding_box[1])
+
+        self.bounded_shape_indices = numpy.array(bounded_shape_indices, dtype=int)
+        self.bvh = BoundingVolumeHierarchy(lower_bounds, upper_bounds)
+        self.bvh.set_precision(self.dtype)
+
+    def build_light_hierarchy(self):
+        """Build a bounding volume hierarchy over the boxes around the reach
+        of the light sources that fade with distance, so that each point only
+        considers the lights that can light it by at least
+        min_light_contribution.  Lights that don't fade are kept in a list
+        that every point considers.  This must be called again after changing
+        the scene's light sources.
+        """
+        self.light_positions = numpy.array(
+            [light_source.position for light_source in self.light_sources],
+            dtype=float
+        ).reshape(-1, 3)
+        self.light_intensities = numpy.array(
+            [light_source.intensity for light_source in self.light_sources],
+            dtype=float
+        )
+        self.light_num_samples = numpy.array(
+            [light_source.num_samples for light_source in self.light_sources],
+            dtype=int
+        )
+        self.light_falloff_distances = numpy.array([
+            numpy.inf if light_source.falloff_distance is None else light_source.falloff_distance
+            for light_source in self.light_sources
+        ], dtype=float)
+
+        self.unbounded_light_indices = []
+        bounded_light_indices = []
+        self.light_ranges = numpy.full(len(self.light_sources), numpy.inf)
+        for light_index, light_source in enumerate(self.light_sources):
+            light_range = light_source.find_range(self.min_light_contribution)
+            if light_range is None:
+                self.unbounded_light_indices.append(light_index)
+            else:
+                bounded_light_indices.append(light_index)
+                self.light_ranges[light_index] = light_range
+
+        self.bounded_light_indices = numpy.array(bounded_light_indices, dtype=int)
+        bounded_positions = self.light_positions[self.bounded_light_indices]
+        bounded_ranges = self.light_ranges[self.bounded_light_indices, numpy.newaxis]
+        self.light_bvh = BoundingVolumeHierarchy(
+            bounded_positions - bounded_ranges,
+            bounded_positions + bounded_ranges
+        )
+
+    def yield_lights_for_point(self, point):
+        """Yield (light index, path, intensity) for each light source that
+        can light point, in the order of self.light_sources, where path runs
+        from point to the light and intensity is the light's there
+        """
+        light_indices = self.unbounded_light_indices
+        if len(self.bounded_light_indices):
+            light_indices = sorted(light_indices + [
+                self.bounded_light_indices[primitive_index]
+                for primitive_index in self.light_bvh.find_primitives_near_point(point)
+            ])
+        for light_index in light_indices:
+            light_source = self.light_sources[light_index]
+            path = light_source.position - point
+            if light_source.falloff_distance is None:
+                yield light_index, path, light_source.intensity
+                continue
+            distance = numpy.linalg.norm(path)
+            if distance <= self.light_ranges[light_index]:
+                yield light_index, path, light_source.find_attenuation(distance)
+
+    def find_lights_for_points(self, points):
+        """Batched version of yield_lights_for_point for an (N, 3) array of
+        points.  Returns arrays (point_indices, light_indices, paths,
+        intensities) with a row for every point and light that can light it,
+        sorted by point and then light.
+        """
+        num_points = len(points)
+        unbounded_light_indices = numpy.array(self.unbounded_light_indices, dtype=int)
+        near_point_indices, near_primitive_indices = self.light_bvh.find_primitives_near_points(points)
+        point_indices = numpy.concatenate([
+            numpy.repeat(numpy.arange(num_points), len(unbounded_light_indices)),
+            near_point_indices
+        ])
+        light_indices = numpy.concatenate([
+            numpy.tile(unbounded_light_indices, num_points),
+            self.bounded_light_indices[near_primitive_indices]
+        ])
+        if len(near_point_indices):
+            order = numpy.lexsort((light_indices, point_indices))
+            point_indices = point_indices[order]
+            light_indices = light_indices[order]
+
+        paths = self.light_positions[light_indices].astype(points.dtype) - points[point_indices]
+        distances = numpy.sqrt(dot_rows(paths, paths))
+        in_range = distances <= self.light_ranges[light_indices]
+        point_indices = point_indices[in_range]
+        light_indices = light_indices[in_range]
+        paths = paths[in_range]
+        intensities = self.light_intensities[light_indices]/(
+            1 + (distances[in_range]/self.light_falloff_distances[light_indices])**2
+        )
+        return point_indices, light_indices, paths, intensities.astype(points.dtype)
 
     def yield_intersections_and_shapes(self, ray, position):
         for shape in self.shapes:
@@ -23,6 +181,196 @@ class Scene(object):
             if intersection is not None:
                 yield intersection, shape
 
-    def yield_paths_to_light_sources_from_point(self, point):
-        for light_source in self.light_sources:
-            yield light_source.position - point
+    def cull_to_frustum(self, frustum):
+        """Find what rays inside frustum (a Frustum) might hit, for the
+        culling argument of the closest intersection queries.  Returns
+        (unbounded_shape_indices, node_mask): the unbounded shapes that
+        might intersect it and a boolean array of the hierarchy's nodes that
+        might overlap it.
+        """
+        unbounded_shape_indices = [
+            shape_index for shape_index in self.unbounded_shape_indices
+            if self.shapes[shape_index].may_intersect_frustum(frustum)
+        ]
+        node_mask = frustum.find_overlapping_boxes(
+            self.bvh.node_lower_bounds,
+            self.bvh.node_upper_bounds
+        )
+        return unbounded_shape_indices, node_mask
+
+    @timed_stage('intersection')
+    def find_closest_intersection_and_shape(self, ray, position, culling=None):
+        """Return the closest intersection along ray starting from position,
+        the shape it's on and the part of the shape hit (see
+        Shape.find_intersection_and_part), or (None, None, None) if the ray
+        doesn't hit anything.  culling is the cull_to_frustum result for a
+        frustum the ray lies in, to only test the shapes in it.
+        """
+        ray_length = numpy.linalg.norm(ray)
+        closest = {'intersection': None, 'shape': None, 'part_index': None}
+        statistics = self.statistics
+
+        def find_closest_in(shape_indices, max_distance):
+            closest_distance, closest_shape_index = max_distance, None
+            for shape_index in shape_indices:
+                shape = self.shapes[shape_index]
+                if statistics is not None:
+                    statistics.count_intersection_tests(shape)
+                intersection, part_index = shape.find_intersection_and_part(position, ray)
+                if intersection is None:
+                    continue
+                distance = numpy.linalg.norm(intersection - position)/ray_length
+                if distance < closest_distance:
+                    closest_distance, closest_shape_index = distance, shape_index
+                    closest['intersection'], closest['shape'] = intersection, shape
+                    closest['part_index'] = part_index
+            return closest_distance, closest_shape_index
+
+        unbounded_shape_indices, node_mask = culling or (self.unbounded_shape_indices, None)
+        closest_distance, _ = find_closest_in(unbounded_shape_indices, numpy.inf)
+        self.bvh.find_closest_hit(
+            position,
+            ray,
+            lambda primitive_indices, max_distance: find_closest_in(
+                self.bounded_shape_indices[primitive_indices],
+                max_distance
+            ),
+            max_distance=closest_distance,
+            node_mask=node_mask
+        )
+        if statistics is not None and closest['shape'] is not None:
+            statistics.count_hits(closest['shape'])
+        return closest['intersection'], closest['shape'], closest['part_index']
+
+    @timed_stage('intersection')
+    def is_segment_occluded(self, ray_pos, ray_dir, max_distance=1):
+        """Determine if any shape lies along ray_dir starting from ray_pos
+        within max_distance (in units of ray_dir, so the default of 1 checks
+        the segment from ray_pos to ray_pos + ray_dir).  Stops at the first
+        occluder found.
+        """
+        statistics = self.statistics
+
+        def is_occluded_by_any_of(shape_indices, max_distance):
+            for shape_index in shape_indices:
+                shape = self.shapes[shape_index]
+                if statistics is not None:
+                    statistics.count_intersection_tests(shape)
+                if shape.occludes_segment(ray_pos, ray_dir, max_distance):
+                    return True
+            return False
+
+        return is_occluded_by_any_of(self.unbounded_shape_indices, max_distance) or self.bvh.find_any_hit(
+            ray_pos,
+            ray_dir,
+            max_distance,
+            lambda primitive_indices, max_distance: is_occluded_by_any_of(
+                self.bounded_shape_indices[primitive_indices],
+                max_distance
+            )
+        )
+
+    @timed_stage('intersection')
+    def find_occluded_segments(self, ray_positions, ray_dirs, max_distances=1):
+        """Batched version of is_segment_occluded for (N, 3) arrays of ray
+        positions and directions, returning a boolean array.  Each ray is
+        dropped from further testing as soon as an occluder is found for it.
+        """
+        max_distances = numpy.resize(numpy.asarray(max_distances, dtype=float), len(ray_positions))
+        occluded = self._find_segments_occluded_by(
+            self.unbounded_shape_indices,
+            ray_positions,
+            ray_dirs,
+            max_distances
+        )
+        unoccluded = numpy.flatnonzero(~occluded)
+        occluded[unoccluded] = self.bvh.find_any_hits(
+            ray_positions[unoccluded],
+            ray_dirs[unoccluded],
+            max_distances[unoccluded],
+            lambda primitive_indices, ray_positions, ray_dirs, max_distances: (
+                self._find_segments_occluded_by(
+                    self.bounded_shape_indices[primitive_indices],
+                    ray_positions,
+                    ray_dirs,
+                    max_distances
+                )
+            )
+        )
+        return occluded
+
+    def _find_segments_occluded_by(self, shape_indices, ray_positions, ray_dirs, max_distances):
+        occluded = numpy.zeros(len(ray_positions), dtype=bool)
+        for shape_index in shape_indices:
+            unoccluded = numpy.flatnonzero(~occluded)
+            if not len(unoccluded):
+                break
+            shape = self.shapes[shape_index]
+            if self.statistics is not None:
+                self.statistics.count_intersection_tests(shape, len(unoccluded))
+            occluded[unoccluded] = shape.occludes_segments(
+                ray_positions[unoccluded],
+                ray_dirs[unoccluded],
+                max_distances[unoccluded]
+            )
+        return occluded
+
+    @timed_stage('intersection')
+    def find_closest_intersections(self, ray_positions, ray_dirs, culling=None):
+        """Batched closest-hit query for (N, 3) arrays of ray positions and
+        directions.  Returns (distances, shape_indices, part_indices): the
+        distance d along each ray (so the intersection is ray_pos + d*ray_dir),
+        the index into self.shapes of the shape hit and the part of it hit
+        (see Shape.find_intersections_and_parts), with inf, -1 and -1 for
+        rays that hit nothing or shapes without parts.  culling is as for
+        find_closest_intersection_and_shape.
+        """
+        unbounded_shape_indices, node_mask = culling or (self.unbounded_shape_indices, None)
+        closest_distances, closest_shape_indices, closest_part_indices = self._find_closest_intersections_with(
+            unbounded_shape_indices,
+            ray_positions,
+            ray_dirs
+        )
+        # the hierarchy passes on whatever index the leaf callback reports,
+        # which here is already the shape index
+        distances, shape_indices, part_indices = self.bvh.find_closest_hits(
+            ray_positions,
+            ray_dirs,
+            lambda primitive_indices, ray_positions, ray_dirs, max_distances: (
+                self._find_closest_intersections_with(
+                    self.bounded_shape_indices[primitive_indices],
+                    ray_positions,
+                    ray_dirs
+                )
+            ),
+            max_distances=closest_distances,
+            node_mask=node_mask,
+            with_parts=True
+        )
+        hit_in_bvh = shape_indices >= 0
+        closest_distances[hit_in_bvh] = distances[hit_in_bvh]
+        closest_shape_indices[hit_in_bvh] = shape_indices[hit_in_bvh]
+        closest_part_indices[hit_in_bvh] = part_indices[hit_in_bvh]
+        if self.statistics is not None:
+            hit_shape_indices, num_hits = numpy.unique(
+                closest_shape_indices[closest_shape_indices >= 0],
+                return_counts=True
+            )
+            for shape_index, num_shape_hits in zip(hit_shape_indices, num_hits):
+                self.statistics.count_hits(self.shapes[shape_index], num_shape_hits)
+        return closest_distances, closest_shape_indices, closest_part_indices
+
+    def _find_closest_intersections_with(self, shape_indices, ray_positions, ray_dirs):
+        closest_distances = numpy.full(len(ray_positions), numpy.inf, dtype=self.dtype)
+        closest_shape_indices = numpy.full(len(ray_positions), -1, dtype=int)
+        closest_part_indices = numpy.full(len(ray_positions), -1, dtype=int)
+        for shape_index in shape_indices:
+            shape = self.shapes[shape_index]
+            if self.statistics is not None:
+                self.statistics.count_intersection_tests(shape, len(ray_positions))
+            distances, part_indices = shape.find_intersections_and_parts(ray_positions, ray_dirs)
+            closer = distances < closest_distances
+            closest_distances[closer] = distances[closer]
+            closest_shape_indices[closer] = shape_index
+            closest_part_indices[closer] = -1 if part_indices is None else part_indices[closer]
+        return closest_distances, closest_shape_indices, closest_part_indices
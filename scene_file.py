@@ -0,0 +1,112 @@
+"""Loads scenes from json files.
+
+A scene file is a json object with Scene's arguments as keys.  Shapes and
+light sources are objects naming their class as "type", with the rest of
+their keys passed to its constructor:
+
+    {
+        "position": [-13, 0, 0],
+        "direction": [1, 0, 0],
+        "background_color": "BLACK",
+        "shapes": [
+            {"type": "Sphere", "center": [9, -1, 0], "radius": 2, "color": "BLUE"},
+            {"type": "TriangleMesh", "obj_file": "bunny.obj", "color": [200, 200, 200]},
+            {"type": "TriangleMesh", "vertices": {"array": "vertices"},
+             "indices": {"array": "indices"}, "color": "RED"},
+            {"type": "Instance", "shape": {"type": "Box", ...}, "translation": [1, 2, 3]},
+            {"type": "Plane", "center": [0, 0, -3], "normal": [0, 0, 1], "color": "WHITE",
+             "texture": {"type": "ImageTexture", "filename": "tiles.png", "size": 4}}
+        ],
+        "light_sources": [{"type": "LightSource", "position": [0, 0, 0]}]
+    }
+
+Lists become numpy arrays, and colors may be given by their name in colors.
+Large arrays can be kept in a binary sidecar, a .npz file written with
+numpy.savez and named by the scene's "arrays" key, and referred to as
+{"array": name}.  Relative paths are relative to the scene file.
+"""
+import json
+import os
+
+import numpy
+
+import colors
+from area_lights import RectangleLight
+from area_lights import SphereLight
+from scene import Scene
+from shapes import Box
+from shapes import Instance
+from shapes import LightSource
+from shapes import Plane
+from shapes import Sphere
+from shapes import TriangleMesh
+from textures import CheckerTexture
+from textures import GradientTexture
+from textures import ImageTexture
+
+
+SCENE_OBJECT_TYPES = dict(
+    (object_type.__name__, object_type)
+    for object_type in [
+        Box,
+        CheckerTexture,
+        GradientTexture,
+        ImageTexture,
+        Instance,
+        LightSource,
+        Plane,
+        RectangleLight,
+        Sphere,
+        SphereLight,
+        TriangleMesh
+    ]
+)
+COLOR_KEYS = frozenset(['color', 'background_color', 'color_1', 'color_2'])
+# paths given relative to the scene file
+FILENAME_KEYS = frozenset(['filename'])
+
+
+def load_scene(filename):
+    with open(filename) as scene_file:
+        description = json.load(scene_file)
+    directory = os.path.dirname(os.path.abspath(filename))
+
+    arrays = {}
+    arrays_filename = description.pop('arrays', None)
+    if arrays_filename is not None:
+        arrays = numpy.load(os.path.join(directory, arrays_filename))
+
+    return Scene(**_convert_arguments(description, arrays, directory))
+
+
+def _convert_arguments(description, arrays, directory):
+    return dict(
+        (str(key), _convert_value(key, value, arrays, directory))
+        for key, value in description.iteritems()
+    )
+
+
+def _convert_value(key, value, arrays, directory):
+    if key in COLOR_KEYS and isinstance(value, basestring):
+        return getattr(colors, value)
+    if key in FILENAME_KEYS:
+        return os.path.join(directory, value)
+    if isinstance(value, dict):
+        if 'array' in value:
+            return arrays[value['array']]
+        return _build_scene_object(value, arrays, directory)
+    if isinstance(value, list):
+        if value and isinstance(value[0], dict):
+            return [_convert_value(key, item, arrays, directory) for item in value]
+        return numpy.array(value)
+    return value
+
+
+def _build_scene_object(description, arrays, directory):
+    description = dict(description)
+    object_type = SCENE_OBJECT_TYPES[description.pop('type')]
+    obj_filename = description.pop('obj_file', None)
+    arguments = _convert_arguments(description, arrays, directory)
+    if obj_filename is not None:
+        return object_type.from_obj_file(os.path.join(directory, obj_filename), **arguments)
+    return object_type(**arguments)
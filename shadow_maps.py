@@ -0,0 +1,113 @@
+"""Cube shadow maps: an approximate but much cheaper alternative to tracing a
+shadow ray from every shaded point to every light source, meant for quick
+previews.
+
+Each light source's map holds the distance to the closest surface in each
+of a grid of directions through the six faces of a cube around the light,
+all found with one batched intersection query when the map is built.  A
+point is then in shadow if the map's distance in its direction is shorter
+than its own distance from the light, less a bias that keeps surfaces from
+shadowing themselves where a texel covers a stretch of surface sloping away
+from the light.
+"""
+import numpy
+
+from util import dot_rows
+from util import normalize_rows
+
+
+DEFAULT_RESOLUTION = 256
+DEFAULT_BIAS = 0.01
+# limits the slope scaled part of the bias for surfaces seen edge on
+MAX_SLOPE = 10
+
+
+class ShadowMaps(object):
+    """Cube shadow maps for all of a scene's light sources, looked up
+    together
+    """
+
+    def __init__(self, scene, resolution=DEFAULT_RESOLUTION, bias=DEFAULT_BIAS):
+        """bias is the distance (in world units) a surface has to be behind
+        the one in a map to be in its shadow, on top of a texel's worth of the
+        surface's slope
+        """
+        self.resolution = resolution
+        self.bias = bias
+        self.light_positions = numpy.array(
+            [light_source.position for light_source in scene.light_sources],
+            dtype=float
+        ).reshape(-1, 3)
+        self.depths = numpy.array([
+            self.render_depths(scene, light_position)
+            for light_position in self.light_positions
+        ]).reshape(-1, 6, resolution, resolution)
+
+    def render_depths(self, scene, light_position):
+        """The distance from light_position to the closest surface through
+        the center of every texel, as a (6, resolution, resolution) array
+        indexed by face, u and v
+        """
+        num_texels = self.resolution*self.resolution
+        texel_centers = (numpy.arange(self.resolution) + 0.5)*2.0/self.resolution - 1
+        us, vs = numpy.meshgrid(texel_centers, texel_centers, indexing='ij')
+        directions = numpy.empty((6, num_texels, 3))
+        for face in xrange(6):
+            axis, u_axis, v_axis = _find_face_axes(face)
+            directions[face, :, axis] = -1 if face % 2 else 1
+            directions[face, :, u_axis] = us.ravel()
+            directions[face, :, v_axis] = vs.ravel()
+        directions = normalize_rows(directions.reshape(-1, 3))
+
+        if scene.statistics is not None:
+            scene.statistics.count_rays('shadow_map', len(directions))
+        distances, _, _ = scene.find_closest_intersections(
+            numpy.tile(light_position, (len(directions), 1)),
+            directions
+        )
+        return distances.reshape(6, self.resolution, self.resolution)
+
+    def find_occluded(self, points, surface_normals, point_indices, light_indices):
+        """Given (N, 3) arrays of points and their surface normals, and arrays
+        of (point index, light index) pairs, return a boolean array of
+        whether each pair's point is in shadow from its light.  Only the
+        pairs' texels are looked up, so lights culled for a point cost
+        nothing.
+        """
+        offsets = points[point_indices] - self.light_positions[light_indices]
+        surface_normals = surface_normals[point_indices]
+        distances = numpy.sqrt(dot_rows(offsets, offsets))
+        rows = numpy.arange(len(offsets))
+
+        # the face an offset falls on is the one its largest component points at
+        axes = numpy.argmax(numpy.abs(offsets), axis=1)
+        faces = 2*axes + (offsets[rows, axes] < 0)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            major_offsets = numpy.abs(offsets[rows, axes])
+            us = offsets[rows, (axes + 1) % 3]/major_offsets
+            vs = offsets[rows, (axes + 2) % 3]/major_offsets
+            cosines = numpy.abs(dot_rows(surface_normals, offsets))/distances
+            slopes = numpy.sqrt(1 - numpy.minimum(cosines, 1)**2)/cosines
+        slopes = numpy.minimum(numpy.nan_to_num(slopes), MAX_SLOPE)
+        depths = self.depths[
+            light_indices,
+            faces,
+            self._find_texel_indices(us),
+            self._find_texel_indices(vs)
+        ]
+
+        # a texel spans about 2/resolution of the distance to the light
+        texel_sizes = distances*2.0/self.resolution
+        return depths < distances - self.bias - texel_sizes*slopes
+
+    def _find_texel_indices(self, coordinates):
+        indices = numpy.floor((numpy.nan_to_num(coordinates) + 1)*self.resolution/2.0)
+        return numpy.clip(indices, 0, self.resolution - 1).astype(int)
+
+
+def _find_face_axes(face):
+    """Faces come in pairs looking along +/- x, y and z; return the axis a
+    face looks along and the axes of its u and v coordinates
+    """
+    axis = face // 2
+    return axis, (axis + 1) % 3, (axis + 2) % 3
@@ -1,16 +1,23 @@
 import numpy
 
 import colors
-from util import change_basis
+from bvh import BoundingVolumeHierarchy
+from obj_loader import load_obj
+from textures import CheckerTexture
+from util import build_rotation_matrix
+from util import dot_rows
 from util import normalize
-from util import rotate
-from util import BASE_BASIS
+from util import normalize_rows
+from util import transform_bounding_box
 from util import X_UNIT_VECTOR
 from util import Z_UNIT_VECTOR
 
 
 # to avoid floating point errors
 FLOATING_POINT_ERROR_THRESHOLD = 1e-10
+# float32 only keeps about 7 significant digits, so batched queries on float32
+# rays need a much looser threshold to keep surfaces from hitting themselves
+FLOAT32_ERROR_THRESHOLD = 1e-4
 
 
 # TODO: should standardize this interface more -- should guarantee that everything
@@ -18,29 +25,180 @@ FLOATING_POINT_ERROR_THRESHOLD = 1e-10
 
 class Shape(object):
 
+    # array attributes that hold indices rather than coordinates or colors
+    INDEX_ATTRIBUTES = frozenset()
+    # a Texture to color the shape with instead of color, for shapes that
+    # implement get_uvs_at_points
+    texture = None
+
+    def set_precision(self, dtype):
+        """Convert the shape's vectors and color to dtype, so that batched
+        queries on rays of that dtype run in it instead of being upcast.  The
+        arrays are converted as copies, and float64 restores the originals
+        rather than converting back from their rounded values.
+        """
+        # (original, converted) arrays by name
+        converted_arrays = self.__dict__.pop('_converted_arrays', {})
+        for name, (original, converted) in converted_arrays.items():
+            # unless it was replaced since
+            if getattr(self, name) is converted:
+                setattr(self, name, original)
+        if numpy.dtype(dtype) == numpy.float64:
+            return
+
+        converted_arrays = {}
+        for name, value in self.__dict__.items():
+            if isinstance(value, numpy.ndarray) and name not in self.INDEX_ATTRIBUTES:
+                converted = value.astype(dtype, copy=False)
+                setattr(self, name, converted)
+                converted_arrays[name] = (value, converted)
+        self._converted_arrays = converted_arrays
+
     def find_intersection(self, ray_pos, ray_dir):
         """Should return a tuple of (intersection point, surface normal)"""
         raise NotImplementedError
 
+    def find_intersections(self, ray_positions, ray_dirs):
+        """Batched version of find_intersection: given (N, 3) arrays of ray
+        positions and directions, return an array of the N distances d (in
+        units of ray_dir, so the intersection is ray_pos + d*ray_dir) to the
+        closest intersections, with inf where a ray misses.
+
+        This falls back to calling find_intersection for every ray; shapes
+        should override it with a vectorized kernel.
+        """
+        distances = numpy.full(len(ray_positions), numpy.inf)
+        for i, (ray_pos, ray_dir) in enumerate(zip(ray_positions, ray_dirs)):
+            intersection = self.find_intersection(ray_pos, ray_dir)
+            if intersection is not None:
+                distances[i] = numpy.dot(intersection - ray_pos, ray_dir)/numpy.dot(ray_dir, ray_dir)
+        return distances
+
+    def find_intersection_and_part(self, ray_pos, ray_dir):
+        """find_intersection, along with which part of the shape (e.g. which
+        of a mesh's triangles) was hit, or None for shapes without parts.
+        The part is handed back to the *_at_hit methods so that they don't
+        have to find it again.
+        """
+        return self.find_intersection(ray_pos, ray_dir), None
+
+    def find_intersections_and_parts(self, ray_positions, ray_dirs):
+        """Batched version of find_intersection_and_part, returning the
+        find_intersections distances and an array of the parts hit, or None
+        for shapes without parts
+        """
+        return self.find_intersections(ray_positions, ray_dirs), None
+
+    def occludes_segment(self, ray_pos, ray_dir, max_distance):
+        """Determine whether the shape lies along ray_dir starting from ray_pos
+        within max_distance (in units of ray_dir).  Unlike find_intersection,
+        this doesn't need to build the intersection point.
+        """
+        return self.find_intersections(
+            ray_pos[numpy.newaxis],
+            ray_dir[numpy.newaxis]
+        )[0] <= max_distance
+
+    def occludes_segments(self, ray_positions, ray_dirs, max_distances):
+        """Batched version of occludes_segment"""
+        return self.find_intersections(ray_positions, ray_dirs) <= max_distances
+
+    def get_bounding_box(self):
+        """Return the (lower, upper) corners of an axis aligned box containing
+        the shape, or None if the shape is unbounded
+        """
+        return None
+
+    def may_intersect_frustum(self, frustum):
+        """Whether any ray inside frustum (a Frustum) might hit the shape.
+        Only asked of unbounded shapes; bounded ones are culled by their
+        bounding boxes.
+        """
+        return True
+
     def build_surface_normal_at_point_for_ray(self, point, ray):
         raise NotImplementedError
 
-    def get_color_at_point(self, point):
-        return self.color
+    def build_surface_normals_at_points_for_rays(self, points, rays):
+        """Batched version of build_surface_normal_at_point_for_ray"""
+        return numpy.array([
+            self.build_surface_normal_at_point_for_ray(point, ray)
+            for point, ray in zip(points, rays)
+        ])
+
+    def build_surface_normal_at_hit(self, point, ray, part_index):
+        """build_surface_normal_at_point_for_ray for a hit on the given part
+        (see find_intersection_and_part)
+        """
+        return self.build_surface_normal_at_point_for_ray(point, ray)
+
+    def build_surface_normals_at_hits(self, points, rays, part_indices):
+        """Batched version of build_surface_normal_at_hit"""
+        return self.build_surface_normals_at_points_for_rays(points, rays)
+
+    def get_color_at_point(self, point, footprint=None):
+        """footprint is the width of the pixel's footprint around point, for
+        textures to filter over, or None if it is unknown
+        """
+        if self.texture is None:
+            return self.color
+        footprints = None if footprint is None else numpy.array([footprint])
+        return self.get_colors_at_points(point[numpy.newaxis], footprints)[0]
+
+    def get_colors_at_points(self, points, footprints=None):
+        """Batched version of get_color_at_point.  Shapes that override
+        get_color_at_point should override this as well.
+        """
+        if self.texture is None:
+            return numpy.tile(self.color, (len(points), 1))
+        return self.texture.get_colors_at_uvs(self.get_uvs_at_points(points), footprints)
+
+    def get_uvs_at_points(self, points):
+        """Texture coordinates of an (N, 3) array of points on the shape, as
+        an (N, 2) array in world units along its surface
+        """
+        raise NotImplementedError
 
     def ray_originates_inside(self, intersection_point, ray):
         raise NotImplementedError
 
+    def rays_originate_inside(self, intersection_points, rays):
+        """Batched version of ray_originates_inside"""
+        return numpy.array([
+            self.ray_originates_inside(point, ray)
+            for point, ray in zip(intersection_points, rays)
+        ], dtype=bool)
+
+    def ray_originates_inside_at_hit(self, intersection_point, ray, part_index):
+        """ray_originates_inside for a hit on the given part (see
+        find_intersection_and_part)
+        """
+        return self.ray_originates_inside(intersection_point, ray)
+
+    def rays_originate_inside_at_hits(self, intersection_points, rays, part_indices):
+        """Batched version of ray_originates_inside_at_hit"""
+        return self.rays_originate_inside(intersection_points, rays)
+
 
 class Sphere(Shape):
 
-    def __init__(self, center, radius, color, specular=0, transparency=0, index_of_refraction=1):
+    def __init__(
+        self,
+        center,
+        radius,
+        color,
+        specular=0,
+        transparency=0,
+        index_of_refraction=1,
+        texture=None
+    ):
         self.center = center
         self.radius = radius
         self.color = color
         self.specular = specular
         self.transparency = transparency
         self.index_of_refraction = index_of_refraction
+        self.texture = texture
 
     def find_intersection(self, ray_pos, ray_dir):
         """There will be an intersection if norm(ray_pos + d*ray_dir - center) = r
@@ -78,38 +236,102 @@ class Sphere(Shape):
             intersection = ray_pos + best_d*ray_dir
             return intersection
 
+    def occludes_segment(self, ray_pos, ray_dir, max_distance):
+        center_to_ray_pos = ray_pos - self.center
+        a = numpy.dot(ray_dir, ray_dir)
+        b = 2*numpy.dot(ray_dir, center_to_ray_pos)
+        c = numpy.dot(center_to_ray_pos, center_to_ray_pos) - self.radius**2
+
+        discriminant = b**2 - 4*a*c
+        if discriminant < 0:
+            return False
+        sqrt_discriminant = numpy.sqrt(discriminant)
+        d = (-b - sqrt_discriminant)/(2*a)
+        if d < FLOATING_POINT_ERROR_THRESHOLD:
+            d = (-b + sqrt_discriminant)/(2*a)
+        return FLOATING_POINT_ERROR_THRESHOLD <= d <= max_distance
+
+    def get_bounding_box(self):
+        return self.center - self.radius, self.center + self.radius
+
+    def find_intersections(self, ray_positions, ray_dirs):
+        """Same quadratic as find_intersection, solved for every ray at once"""
+        center_to_ray_pos = ray_positions - self.center
+        a = numpy.sum(ray_dirs*ray_dirs, axis=1)
+        b = 2*numpy.sum(ray_dirs*center_to_ray_pos, axis=1)
+        c = numpy.sum(center_to_ray_pos*center_to_ray_pos, axis=1) - self.radius**2
+
+        discriminant = b**2 - 4*a*c
+        hits = discriminant >= 0
+        sqrt_discriminant = numpy.sqrt(numpy.where(hits, discriminant, 0))
+        d1 = (-b - sqrt_discriminant)/(2*a)
+        d2 = (-b + sqrt_discriminant)/(2*a)
+
+        # d1 <= d2, so take d1 unless it is behind the ray's starting point
+        threshold = _find_error_threshold(ray_dirs)
+        distances = numpy.where(d1 >= threshold, d1, d2)
+        hits &= distances >= threshold
+        return numpy.where(hits, distances, numpy.inf)
+
     def build_surface_normal_at_point_for_ray(self, point, ray):
         # Surface normal should point in the opposite direction of the incoming
         # ray
         base_surface_normal = normalize(point - self.center)
         return -1*numpy.sign(numpy.dot(base_surface_normal, ray)) * base_surface_normal
 
+    def build_surface_normals_at_points_for_rays(self, points, rays):
+        base_surface_normals = normalize_rows(points - self.center)
+        signs = -1*numpy.sign(dot_rows(base_surface_normals, rays))
+        return signs[:, numpy.newaxis] * base_surface_normals
+
     # TODO: this is actually the same for all shapes: if dot(normal, ray) > 0 then
     # we're inside...
     def ray_originates_inside(self, intersection_point, ray):
         # Note that in this case, the ray ENDS at intersection point
         return numpy.dot(intersection_point - self.center, ray) > 0
 
+    def rays_originate_inside(self, intersection_points, rays):
+        return dot_rows(intersection_points - self.center, rays) > 0
+
+    def get_uvs_at_points(self, points):
+        """Arc lengths around the z axis from the x axis and down from the
+        top, so u runs up to 2*pi*radius and v up to pi*radius
+        """
+        offsets = points - self.center
+        longitudes = numpy.arctan2(offsets[:, 1], offsets[:, 0]) % (2*numpy.pi)
+        colatitudes = numpy.arccos(numpy.clip(offsets[:, 2]/self.radius, -1, 1))
+        return self.radius*numpy.column_stack([longitudes, colatitudes])
+
 
 class Plane(Shape):
 
-    def __init__(self, center, normal, color, specular=0, transparency=0, checkered=False):
+    def __init__(
+        self,
+        center,
+        normal,
+        color,
+        specular=0,
+        transparency=0,
+        checkered=False,
+        texture=None
+    ):
+        """checkered is short for a texture of squares of color and black"""
         self.center = center
         self.normal = normalize(normal)
         self.color = color
         self.specular = specular
         self.transparency = transparency
         self.checkered = checkered
-
         if checkered:
-            self.basis_vector_1 = numpy.cross(self.normal, Z_UNIT_VECTOR)
-            if numpy.linalg.norm(self.basis_vector_1) == 0:
-                self.basis_vector_1 = numpy.cross(self.normal, X_UNIT_VECTOR)
-            self.basis_vector_1 = normalize(self.basis_vector_1)
-            self.basis_vector_2 = numpy.cross(self.normal, self.basis_vector_1)
-        else:
-            self.basis_vector_1 = None
-            self.basis_vector_2 = None
+            texture = CheckerTexture(color, colors.BLACK)
+        self.texture = texture
+
+        # the texture coordinates' axes
+        self.basis_vector_1 = numpy.cross(self.normal, Z_UNIT_VECTOR)
+        if numpy.linalg.norm(self.basis_vector_1) == 0:
+            self.basis_vector_1 = numpy.cross(self.normal, X_UNIT_VECTOR)
+        self.basis_vector_1 = normalize(self.basis_vector_1)
+        self.basis_vector_2 = numpy.cross(self.normal, self.basis_vector_1)
 
     def find_intersection(self, ray_pos, ray_dir):
         """A plane is defined as all points p such that, for an arbitrary point
@@ -126,30 +348,48 @@ class Plane(Shape):
         d = numerator/denominator
         return ray_pos + d*ray_dir if d > FLOATING_POINT_ERROR_THRESHOLD else None
 
+    def occludes_segment(self, ray_pos, ray_dir, max_distance):
+        denominator = numpy.dot(ray_dir, self.normal)
+        if denominator == 0:
+            return False
+        d = numpy.dot(self.center - ray_pos, self.normal)/denominator
+        return FLOATING_POINT_ERROR_THRESHOLD < d <= max_distance
+
+    def find_intersections(self, ray_positions, ray_dirs):
+        denominators = ray_dirs.dot(self.normal)
+        numerators = (self.center - ray_positions).dot(self.normal)
+        parallel = denominators == 0
+        distances = numerators/numpy.where(parallel, 1, denominators)
+        hits = ~parallel & (distances > _find_error_threshold(ray_dirs))
+        return numpy.where(hits, distances, numpy.inf)
+
+    def may_intersect_frustum(self, frustum):
+        # the rays inside are blends of the corner rays, so they all head away
+        # from the plane if the corner rays do
+        numerator = numpy.dot(self.center - frustum.apex, self.normal)
+        return numpy.any(frustum.corner_rays.dot(self.normal)*numerator >= 0)
+
     def build_surface_normal_at_point_for_ray(self, point, ray):
         return -1*numpy.sign(numpy.dot(self.normal, ray)) * self.normal
 
-    def get_color_at_point(self, point):
-        # TODO: implement a class for textures
-        if not self.checkered:
-            return self.color
-
-        vector_to_point = point - self.center
+    def build_surface_normals_at_points_for_rays(self, points, rays):
+        signs = -1*numpy.sign(rays.dot(self.normal))
+        return signs[:, numpy.newaxis] * self.normal
 
-        vector_component_1 = numpy.dot(self.basis_vector_1, vector_to_point)
-        vector_component_2 = numpy.dot(self.basis_vector_2, vector_to_point)
-        coord_1_is_even = numpy.floor(vector_component_1) % 2 == 0
-        coord_2_is_even = numpy.floor(vector_component_2) % 2 == 0
-
-        if coord_1_is_even == coord_2_is_even:
-            return self.color
-        else:
-            return colors.BLACK
+    def get_uvs_at_points(self, points):
+        vectors_to_points = points - self.center
+        return numpy.column_stack([
+            vectors_to_points.dot(self.basis_vector_1),
+            vectors_to_points.dot(self.basis_vector_2)
+        ])
 
     def ray_originates_inside(self, intersection_point, ray):
         # This is a 2-D object and has no inside
         return False
 
+    def rays_originate_inside(self, intersection_points, rays):
+        return numpy.zeros(len(intersection_points), dtype=bool)
+
 
 class Box(Shape):
 
@@ -161,122 +401,569 @@ class Box(Shape):
         rotation=numpy.array([0,0,0]),
         specular=0,
         transparency=0,
-        index_of_refraction=1
+        index_of_refraction=1,
+        texture=None
     ):
         self.color = color
         self.specular = specular
         self.transparency = transparency
         self.index_of_refraction = index_of_refraction
+        self.texture = texture
+
+        # rotation_matrix takes vectors in the box's own (rotated) basis to the
+        # scene's basis, and its inverse (just its transpose, since it's a
+        # rotation) takes them back
+        self.rotation_matrix = build_rotation_matrix(rotation)
+        self.inverse_rotation_matrix = self.rotation_matrix.T
+
+        center = self.inverse_rotation_matrix.dot(center)
+        self.lower_bound = center - numpy.asarray(size)/2.0
+        self.upper_bound = center + numpy.asarray(size)/2.0
+        self._bounds_as_lists = zip(self.lower_bound.tolist(), self.upper_bound.tolist())
+
+    def set_precision(self, dtype):
+        super(Box, self).set_precision(dtype)
+        self._bounds_as_lists = zip(self.lower_bound.tolist(), self.upper_bound.tolist())
+
+    def find_intersection(self, ray_pos, ray_dir):
+        """Slab method: in the box's basis, each pair of opposite faces bounds
+        the range of d for which ray_pos + d*ray_dir lies between them.  The ray
+        hits the box if the three ranges overlap, entering at the largest near
+        distance and leaving at the smallest far distance.
+        """
+        d = self._find_slab_distance(
+            self.inverse_rotation_matrix.dot(ray_pos).tolist(),
+            self.inverse_rotation_matrix.dot(ray_dir).tolist()
+        )
+        if d is None:
+            return None
+        return ray_pos + d*ray_dir
+
+    def _find_slab_distance(self, ray_pos, ray_dir):
+        """find_intersection's slab test for a single ray in the box's basis,
+        given as lists of floats since numpy's per-call overhead would dominate
+        """
+        d_near = -numpy.inf
+        d_far = numpy.inf
+        for (lower, upper), position, direction in zip(self._bounds_as_lists, ray_pos, ray_dir):
+            if direction == 0:
+                if (
+                    lower - position > FLOATING_POINT_ERROR_THRESHOLD
+                    or position - upper > FLOATING_POINT_ERROR_THRESHOLD
+                ):
+                    return None
+                continue
+            d_lower = (lower - position)/direction
+            d_upper = (upper - position)/direction
+            d_near = max(d_near, min(d_lower, d_upper))
+            d_far = min(d_far, max(d_lower, d_upper))
+
+        if d_near - d_far >= FLOATING_POINT_ERROR_THRESHOLD:
+            return None
+        # a ray starting inside the box (or on its surface) exits at d_far
+        d = d_near if d_near > FLOATING_POINT_ERROR_THRESHOLD else d_far
+        return d if d > FLOATING_POINT_ERROR_THRESHOLD else None
+
+    def find_intersections(self, ray_positions, ray_dirs):
+        """Batched version of the slab test in find_intersection"""
+        ray_positions = ray_positions.dot(self.inverse_rotation_matrix.T)
+        ray_dirs = ray_dirs.dot(self.inverse_rotation_matrix.T)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            d_lower = (self.lower_bound - ray_positions)/ray_dirs
+            d_upper = (self.upper_bound - ray_positions)/ray_dirs
+
+        # fmin/fmax skip the nans from rays lying exactly in a face's plane
+        d_near = numpy.fmax.reduce(numpy.fmin(d_lower, d_upper), axis=1)
+        d_far = numpy.fmin.reduce(numpy.fmax(d_lower, d_upper), axis=1)
+
+        threshold = _find_error_threshold(ray_dirs)
+        distances = numpy.where(d_near > threshold, d_near, d_far)
+        hits = (d_near - d_far < threshold) & (distances > threshold)
+        return numpy.where(hits, distances, numpy.inf)
+
+    def get_bounding_box(self):
+        return transform_bounding_box(self.lower_bound, self.upper_bound, self.rotation_matrix)
+
+    def _build_surface_normal_at_point(self, point):
+        return self._build_surface_normals_at_points(point[numpy.newaxis])[0]
+
+    def _build_surface_normals_at_points(self, points):
+        points = points.dot(self.inverse_rotation_matrix.T)
+
+        threshold = _find_error_threshold(points)
+        normals = numpy.zeros(points.shape, dtype=points.dtype)
+        normals[numpy.abs(points - self.lower_bound) < threshold] = -1
+        normals[numpy.abs(points - self.upper_bound) < threshold] = 1
+
+        normals = normalize_rows(normals)
+        return normals.dot(self.rotation_matrix.T)
+
+    def build_surface_normal_at_point_for_ray(self, point, ray):
+        base_surface_normal = self._build_surface_normal_at_point(point)
+        return -1*numpy.sign(numpy.dot(base_surface_normal, ray)) * base_surface_normal
 
-        # create a rotated basis set and a representation of the base basis
-        # vectors in the new basis
-        self.basis = tuple(
-            rotate(basis_vector, rotation) for basis_vector in BASE_BASIS
+    def build_surface_normals_at_points_for_rays(self, points, rays):
+        base_surface_normals = self._build_surface_normals_at_points(points)
+        signs = -1*numpy.sign(dot_rows(base_surface_normals, rays))
+        return signs[:, numpy.newaxis] * base_surface_normals
+
+    # TODO: find a way around recalculating the surface normal
+    def ray_originates_inside(self, intersection_point, ray):
+        base_surface_normal = self._build_surface_normal_at_point(intersection_point)
+        return numpy.dot(base_surface_normal, ray) > 0
+
+    def rays_originate_inside(self, intersection_points, rays):
+        base_surface_normals = self._build_surface_normals_at_points(intersection_points)
+        return dot_rows(base_surface_normals, rays) > 0
+
+    def get_uvs_at_points(self, points):
+        """The coordinates along the other two axes of the face each point is
+        on, in the box's basis and from its lower corner
+        """
+        points = points.dot(self.inverse_rotation_matrix.T) - self.lower_bound
+        distances_to_faces = numpy.minimum(
+            numpy.abs(points),
+            numpy.abs(points - (self.upper_bound - self.lower_bound))
         )
-        self.base_basis_in_rotated_basis = tuple(
-            change_basis(basis_vector, self.basis)
-            for basis_vector in BASE_BASIS
+        face_axes = numpy.argmin(distances_to_faces, axis=1)
+        rows = numpy.arange(len(points))
+        return numpy.column_stack([
+            points[rows, (face_axes + 1) % 3],
+            points[rows, (face_axes + 2) % 3]
+        ])
+
+
+class TriangleMesh(Shape):
+    """A mesh of triangles stored as a (V, 3) array of vertices and a (T, 3)
+    array of the vertex indices of each triangle.  The triangles are kept in
+    their own bounding volume hierarchy and intersected with the
+    Moller-Trumbore algorithm, vectorized over the rays and triangles in each
+    leaf.  Triangles are flat shaded, and their vertices should be wound
+    counterclockwise seen from outside the mesh so that the inside can be told
+    apart from the outside.
+    """
+
+    INDEX_ATTRIBUTES = frozenset(['indices'])
+
+    def __init__(
+        self,
+        vertices,
+        indices,
+        color,
+        specular=0,
+        transparency=0,
+        index_of_refraction=1,
+        max_leaf_size=16
+    ):
+        self.color = color
+        self.specular = specular
+        self.transparency = transparency
+        self.index_of_refraction = index_of_refraction
+
+        self.vertices = numpy.asarray(vertices, dtype=float)
+        self.indices = numpy.asarray(indices, dtype=int)
+
+        triangle_vertices = self.vertices[self.indices]
+        # degenerate triangles get nan normals, but they are never hit
+        with numpy.errstate(invalid='ignore'):
+            self.face_normals = normalize_rows(numpy.cross(
+                triangle_vertices[:, 1] - triangle_vertices[:, 0],
+                triangle_vertices[:, 2] - triangle_vertices[:, 0]
+            ))
+        self.bvh = BoundingVolumeHierarchy(
+            triangle_vertices.min(axis=1),
+            triangle_vertices.max(axis=1),
+            max_leaf_size=max_leaf_size
         )
 
-        center = change_basis(center, self.basis)
+    @classmethod
+    def from_obj_file(cls, filename, color, **kwargs):
+        vertices, indices = load_obj(filename)
+        return cls(vertices, indices, color, **kwargs)
 
-        (x_extent, y_extent, z_extent) = size
-        self.x_range = (center[0] - x_extent/2.0, center[0] + x_extent/2.0)
-        self.y_range = (center[1] - y_extent/2.0, center[1] + y_extent/2.0)
-        self.z_range = (center[2] - z_extent/2.0, center[2] + z_extent/2.0)
+    def set_precision(self, dtype):
+        super(TriangleMesh, self).set_precision(dtype)
+        self.bvh.set_precision(dtype)
 
+    def _intersect_triangles(self, triangle_indices, ray_positions, ray_dirs):
+        """Moller-Trumbore: solve ray_pos + d*ray_dir = v0 + u*(v1 - v0) +
+        v*(v2 - v0) for every pair of the given rays and triangles, returning
+        arrays of the distance to and index of the closest triangle each ray
+        hits (inf and -1 for misses)
+        """
+        triangle_vertices = self.vertices[self.indices[triangle_indices]]
+        v0 = triangle_vertices[:, 0]
+        e1x, e1y, e1z = (triangle_vertices[:, 1] - v0).T
+        e2x, e2y, e2z = (triangle_vertices[:, 2] - v0).T
+
+        # Everything below is a (rays, triangles) array.  The cross and dot
+        # products are written out by component since numpy's cross and sums
+        # over an axis of length 3 are much slower.
+        dx, dy, dz = ray_dirs.T[:, :, numpy.newaxis]
+        px = dy*e2z - dz*e2y
+        py = dz*e2x - dx*e2z
+        pz = dx*e2y - dy*e2x
+        determinants = e1x*px + e1y*py + e1z*pz
+        # determinants scale with the triangles' areas, so this only guards
+        # the division whatever the precision
+        parallel = numpy.abs(determinants) < FLOATING_POINT_ERROR_THRESHOLD
+        inverse_determinants = 1.0/numpy.where(parallel, 1, determinants)
+
+        sx, sy, sz = (ray_positions.T[:, :, numpy.newaxis] - v0.T[:, numpy.newaxis])
+        u = (sx*px + sy*py + sz*pz)*inverse_determinants
+        qx = sy*e1z - sz*e1y
+        qy = sz*e1x - sx*e1z
+        qz = sx*e1y - sy*e1x
+        v = (dx*qx + dy*qy + dz*qz)*inverse_determinants
+        distances = (e2x*qx + e2y*qy + e2z*qz)*inverse_determinants
+
+        # a little slack on the barycentric coordinates keeps rays from
+        # slipping through the cracks between neighboring triangles
+        threshold = _find_error_threshold(ray_dirs)
+        hits = (
+            ~parallel
+            & (u >= -threshold)
+            & (v >= -threshold)
+            & (u + v <= 1 + threshold)
+            & (distances > threshold)
+        )
+        distances = numpy.where(hits, distances, numpy.inf)
+        closest = numpy.argmin(distances, axis=1)
+        closest_distances = distances[numpy.arange(len(distances)), closest]
+        closest_triangle_indices = numpy.where(
+            numpy.isfinite(closest_distances),
+            triangle_indices[closest],
+            -1
+        )
+        return closest_distances, closest_triangle_indices
+
+    def _find_closest_triangles(self, ray_positions, ray_dirs):
+        return self.bvh.find_closest_hits(
+            ray_positions,
+            ray_dirs,
+            lambda triangle_indices, ray_positions, ray_dirs, max_distances: (
+                self._intersect_triangles(triangle_indices, ray_positions, ray_dirs)
+            )
+        )
 
     def find_intersection(self, ray_pos, ray_dir):
-        """Basic strategy here is to find where the ray intersects the PLANES
-        of the faces of the box and then determine if the intersection is actually
-        within the box.
-
-        To find the intersections with these planes, we need to find values of d
-        such that ray_pos[i] + d*ray_dir[i] = i_range[j], where i is any
-        coordinate (x, y, z) and j is either 0 or 1 for the min or max value of
-        coordinate i in the box.  Thus d = (i_range[j] - ray_pos[i])/ray_dir[i]
+        return self.find_intersection_and_part(ray_pos, ray_dir)[0]
+
+    def find_intersections(self, ray_positions, ray_dirs):
+        distances, _ = self._find_closest_triangles(ray_positions, ray_dirs)
+        return distances
+
+    def find_intersection_and_part(self, ray_pos, ray_dir):
+        """The part hit is the index of the triangle"""
+        distances, triangle_indices = self._find_closest_triangles(
+            ray_pos[numpy.newaxis],
+            ray_dir[numpy.newaxis]
+        )
+        if distances[0] == numpy.inf:
+            return None, None
+        return ray_pos + distances[0]*ray_dir, triangle_indices[0]
+
+    def find_intersections_and_parts(self, ray_positions, ray_dirs):
+        return self._find_closest_triangles(ray_positions, ray_dirs)
+
+    def occludes_segments(self, ray_positions, ray_dirs, max_distances):
+        return self.bvh.find_any_hits(
+            ray_positions,
+            ray_dirs,
+            max_distances,
+            lambda triangle_indices, ray_positions, ray_dirs, max_distances: (
+                self._intersect_triangles(triangle_indices, ray_positions, ray_dirs)[0]
+                <= max_distances
+            )
+        )
+
+    def get_bounding_box(self):
+        return self.vertices.min(axis=0), self.vertices.max(axis=0)
+
+    def _find_triangles_at_points(self, points, rays):
+        """Find which triangle each intersection point lies on by backing up a
+        little along the ray that found it and intersecting again.  Only
+        needed when the hit's triangle wasn't kept from
+        find_intersections_and_parts.
         """
-        ray_pos = change_basis(ray_pos, self.basis)
-        ray_dir = change_basis(ray_dir, self.basis)
+        backed_up_distance = max(1e-6, 10*_find_error_threshold(rays))
+        _, triangle_indices = self._find_closest_triangles(
+            points - backed_up_distance*rays,
+            rays
+        )
+        return triangle_indices
+
+    def build_surface_normal_at_point_for_ray(self, point, ray):
+        return self.build_surface_normals_at_points_for_rays(
+            point[numpy.newaxis],
+            ray[numpy.newaxis]
+        )[0]
+
+    def build_surface_normals_at_points_for_rays(self, points, rays):
+        return self.build_surface_normals_at_hits(
+            points,
+            rays,
+            self._find_triangles_at_points(points, rays)
+        )
 
-        possible_ds = []
+    def build_surface_normal_at_hit(self, point, ray, part_index):
+        return self.build_surface_normals_at_hits(
+            point[numpy.newaxis],
+            ray[numpy.newaxis],
+            numpy.array([part_index])
+        )[0]
 
-        if ray_dir[0] != 0:
-            possible_ds.append((self.x_range[0] - ray_pos[0])/ray_dir[0])
-            possible_ds.append((self.x_range[1] - ray_pos[0])/ray_dir[0])
+    def build_surface_normals_at_hits(self, points, rays, part_indices):
+        base_surface_normals = self.face_normals[part_indices]
+        signs = -1*numpy.sign(dot_rows(base_surface_normals, rays))
+        return signs[:, numpy.newaxis] * base_surface_normals
 
-        if ray_dir[1] != 0:
-            possible_ds.append((self.y_range[0] - ray_pos[1])/ray_dir[1])
-            possible_ds.append((self.y_range[1] - ray_pos[1])/ray_dir[1])
+    def ray_originates_inside(self, intersection_point, ray):
+        return self.rays_originate_inside(
+            intersection_point[numpy.newaxis],
+            ray[numpy.newaxis]
+        )[0]
+
+    def rays_originate_inside(self, intersection_points, rays):
+        return self.rays_originate_inside_at_hits(
+            intersection_points,
+            rays,
+            self._find_triangles_at_points(intersection_points, rays)
+        )
 
-        if ray_dir[2] != 0:
-            possible_ds.append((self.z_range[0] - ray_pos[2])/ray_dir[2])
-            possible_ds.append((self.z_range[1] - ray_pos[2])/ray_dir[2])
+    def ray_originates_inside_at_hit(self, intersection_point, ray, part_index):
+        return self.rays_originate_inside_at_hits(
+            intersection_point[numpy.newaxis],
+            ray[numpy.newaxis],
+            numpy.array([part_index])
+        )[0]
 
-        possible_intersections = [ray_pos + d*ray_dir for d in possible_ds]
+    def rays_originate_inside_at_hits(self, intersection_points, rays, part_indices):
+        # rays leave the mesh through the front of a triangle
+        return dot_rows(self.face_normals[part_indices], rays) > 0
 
-        best_d = None
-        for possible_d in possible_ds:
-            if (
-                possible_d > FLOATING_POINT_ERROR_THRESHOLD  # TODO: actually need this?
-                and self._is_point_on_box(ray_pos + possible_d*ray_dir)
-            ):
-                if best_d is None:
-                    best_d = possible_d
-                else:
-                    best_d = min(best_d, possible_d)
 
-        if best_d is None:
+class Instance(Shape):
+    """Places another shape in the scene through a transform, so that the same
+    geometry (a mesh, say) can appear many times without being duplicated.
+
+    A point p in the wrapped shape's own space appears in the scene at
+    transform.dot(p) + translation.  transform defaults to rotating by
+    rotation (as for Box) after scaling by scale.  Material properties left
+    as None are taken from the wrapped shape.
+    """
+
+    def __init__(
+        self,
+        shape,
+        translation=numpy.array([0,0,0]),
+        rotation=numpy.array([0,0,0]),
+        scale=1,
+        transform=None,
+        color=None,
+        specular=None,
+        transparency=None,
+        index_of_refraction=None
+    ):
+        self.shape = shape
+        self.color = color
+        self.specular = shape.specular if specular is None else specular
+        self.transparency = shape.transparency if transparency is None else transparency
+        self.index_of_refraction = (
+            getattr(shape, 'index_of_refraction', 1)
+            if index_of_refraction is None
+            else index_of_refraction
+        )
+        self.set_transform(translation, rotation, scale, transform)
+
+    def set_precision(self, dtype):
+        super(Instance, self).set_precision(dtype)
+        self.shape.set_precision(dtype)
+
+    def set_transform(
+        self,
+        translation=numpy.array([0,0,0]),
+        rotation=numpy.array([0,0,0]),
+        scale=1,
+        transform=None
+    ):
+        if transform is None:
+            transform = build_rotation_matrix(rotation) * scale
+        self.translation = numpy.asarray(translation, dtype=float)
+        self.transform = numpy.asarray(transform, dtype=float)
+        self.inverse_transform = numpy.linalg.inv(self.transform)
+        # normals transform by the inverse transpose to stay perpendicular
+        # to the (possibly non-uniformly scaled) surface
+        self.normal_transform = self.inverse_transform.T
+
+    def _points_to_shape_space(self, points):
+        return (points - self.translation).dot(self.inverse_transform.T)
+
+    def _rays_to_shape_space(self, rays):
+        # transforming the ray directions along with their positions leaves
+        # distances along them (in units of the ray) unchanged
+        return rays.dot(self.inverse_transform.T)
+
+    def find_intersection(self, ray_pos, ray_dir):
+        intersection = self.shape.find_intersection(
+            self._points_to_shape_space(ray_pos),
+            self._rays_to_shape_space(ray_dir)
+        )
+        if intersection is None:
             return None
+        return self.transform.dot(intersection) + self.translation
 
-        intersection = ray_pos + best_d*ray_dir
-        return change_basis(intersection, self.base_basis_in_rotated_basis)
+    def find_intersections(self, ray_positions, ray_dirs):
+        return self.shape.find_intersections(
+            self._points_to_shape_space(ray_positions),
+            self._rays_to_shape_space(ray_dirs)
+        )
 
-    # TODO: this is actually checking if the point is IN the box...
-    def _is_point_on_box(self, point):
-        return (
-            self.x_range[0] - point[0] < FLOATING_POINT_ERROR_THRESHOLD
-            and point[0] - self.x_range[1] < FLOATING_POINT_ERROR_THRESHOLD
+    def find_intersection_and_part(self, ray_pos, ray_dir):
+        intersection, part_index = self.shape.find_intersection_and_part(
+            self._points_to_shape_space(ray_pos),
+            self._rays_to_shape_space(ray_dir)
+        )
+        if intersection is None:
+            return None, None
+        return self.transform.dot(intersection) + self.translation, part_index
+
+    def find_intersections_and_parts(self, ray_positions, ray_dirs):
+        return self.shape.find_intersections_and_parts(
+            self._points_to_shape_space(ray_positions),
+            self._rays_to_shape_space(ray_dirs)
+        )
 
-            and self.y_range[0] - point[1] < FLOATING_POINT_ERROR_THRESHOLD
-            and point[1] - self.y_range[1] < FLOATING_POINT_ERROR_THRESHOLD
+    def occludes_segment(self, ray_pos, ray_dir, max_distance):
+        return self.shape.occludes_segment(
+            self._points_to_shape_space(ray_pos),
+            self._rays_to_shape_space(ray_dir),
+            max_distance
+        )
 
-            and self.z_range[0] - point[2] < FLOATING_POINT_ERROR_THRESHOLD
-            and point[2] - self.z_range[1] < FLOATING_POINT_ERROR_THRESHOLD
+    def occludes_segments(self, ray_positions, ray_dirs, max_distances):
+        return self.shape.occludes_segments(
+            self._points_to_shape_space(ray_positions),
+            self._rays_to_shape_space(ray_dirs),
+            max_distances
         )
 
-    def _build_surface_normal_at_point(self, point):
-        point = change_basis(point, self.basis)
-        normal = numpy.array([0,0,0])
-        if numpy.abs(point[0] - self.x_range[0]) < FLOATING_POINT_ERROR_THRESHOLD:
-            normal[0] = -1
-        if numpy.abs(point[0] - self.x_range[1]) < FLOATING_POINT_ERROR_THRESHOLD:
-            normal[0] = 1
-
-        if numpy.abs(point[1] - self.y_range[0]) < FLOATING_POINT_ERROR_THRESHOLD:
-            normal[1] = -1
-        if numpy.abs(point[1] - self.y_range[1]) < FLOATING_POINT_ERROR_THRESHOLD:
-            normal[1] = 1
-
-        if numpy.abs(point[2] - self.z_range[0]) < FLOATING_POINT_ERROR_THRESHOLD:
-            normal[2] = -1
-        if numpy.abs(point[2] - self.z_range[1]) < FLOATING_POINT_ERROR_THRESHOLD:
-            normal[2] = 1
-
-        normal = normalize(normal)
-        return change_basis(normal, self.base_basis_in_rotated_basis)
+    def get_bounding_box(self):
+        bounding_box = self.shape.get_bounding_box()
+        if bounding_box is None:
+            return None
+        lower_bound, upper_bound = bounding_box
+        return transform_bounding_box(lower_bound, upper_bound, self.transform, self.translation)
 
     def build_surface_normal_at_point_for_ray(self, point, ray):
-        base_surface_normal = self._build_surface_normal_at_point(point)
-        return -1*numpy.sign(numpy.dot(base_surface_normal, ray)) * base_surface_normal
+        normal = self.shape.build_surface_normal_at_point_for_ray(
+            self._points_to_shape_space(point),
+            self._rays_to_shape_space(ray)
+        )
+        return normalize(self.normal_transform.dot(normal))
+
+    def build_surface_normals_at_points_for_rays(self, points, rays):
+        normals = self.shape.build_surface_normals_at_points_for_rays(
+            self._points_to_shape_space(points),
+            self._rays_to_shape_space(rays)
+        )
+        return normalize_rows(normals.dot(self.normal_transform.T))
+
+    def build_surface_normal_at_hit(self, point, ray, part_index):
+        normal = self.shape.build_surface_normal_at_hit(
+            self._points_to_shape_space(point),
+            self._rays_to_shape_space(ray),
+            part_index
+        )
+        return normalize(self.normal_transform.dot(normal))
+
+    def build_surface_normals_at_hits(self, points, rays, part_indices):
+        normals = self.shape.build_surface_normals_at_hits(
+            self._points_to_shape_space(points),
+            self._rays_to_shape_space(rays),
+            part_indices
+        )
+        return normalize_rows(normals.dot(self.normal_transform.T))
+
+    def get_color_at_point(self, point, footprint=None):
+        if self.color is not None:
+            return self.color
+        return self.shape.get_color_at_point(
+            self._points_to_shape_space(point),
+            None if footprint is None else footprint/self._find_scale()
+        )
+
+    def get_colors_at_points(self, points, footprints=None):
+        if self.color is not None:
+            return numpy.tile(self.color, (len(points), 1))
+        return self.shape.get_colors_at_points(
+            self._points_to_shape_space(points),
+            None if footprints is None else footprints/self._find_scale()
+        )
+
+    def _find_scale(self):
+        """How much the transform scales lengths by, on average"""
+        return numpy.abs(numpy.linalg.det(self.transform))**(1/3.0)
 
-    # TODO: find a way around recalculating the surface normal
     def ray_originates_inside(self, intersection_point, ray):
-        base_surface_normal = self._build_surface_normal_at_point(intersection_point)
-        return numpy.dot(base_surface_normal, ray) > 0
+        return self.shape.ray_originates_inside(
+            self._points_to_shape_space(intersection_point),
+            self._rays_to_shape_space(ray)
+        )
+
+    def rays_originate_inside(self, intersection_points, rays):
+        return self.shape.rays_originate_inside(
+            self._points_to_shape_space(intersection_points),
+            self._rays_to_shape_space(rays)
+        )
 
+    def ray_originates_inside_at_hit(self, intersection_point, ray, part_index):
+        return self.shape.ray_originates_inside_at_hit(
+            self._points_to_shape_space(intersection_point),
+            self._rays_to_shape_space(ray),
+            part_index
+        )
 
-class LightSource(object):
+    def rays_originate_inside_at_hits(self, intersection_points, rays, part_indices):
+        return self.shape.rays_originate_inside_at_hits(
+            self._points_to_shape_space(intersection_points),
+            self._rays_to_shape_space(rays),
+            part_indices
+        )
+
+
+def _find_error_threshold(array):
+    """The threshold for batched queries on rays given as array"""
+    if array.dtype == numpy.float32:
+        return FLOAT32_ERROR_THRESHOLD
+    return FLOATING_POINT_ERROR_THRESHOLD
 
-    def __init__(self, position):
+
+class LightSource(object):
+    # how many points on the light shadow rays are traced to, see area_lights
+    num_samples = 1
+
+    def __init__(self, position, intensity=1, falloff_distance=None):
+        """A point light, contributing intensity times the cosine of its angle
+        to the surface normal to a point's diffuse shading.  With a
+        falloff_distance that contribution is divided by 1 + (distance from
+        the light/falloff_distance)**2, fading like an inverse square.
+        """
         self.position = position
+        self.intensity = intensity
+        self.falloff_distance = falloff_distance
+
+    def find_attenuation(self, distance):
+        """The light's intensity at the given distance from it"""
+        if self.falloff_distance is None:
+            return self.intensity
+        return self.intensity/(1 + (distance/self.falloff_distance)**2)
+
+    def find_range(self, min_contribution):
+        """The distance beyond which the light's intensity is below
+        min_contribution, or None if it doesn't fade
+        """
+        if self.falloff_distance is None:
+            return None
+        return self.falloff_distance*numpy.sqrt(max(self.intensity/min_contribution - 1, 0))
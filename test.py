@@ -1,6 +1,8 @@
 import numpy
 
 import colors
+from area_lights import RectangleLight
+from area_lights import SphereLight
 from main import RayTracerMain
 from scene import Scene
 from shapes import Box
@@ -145,6 +147,39 @@ rotate_box_test = Scene(
 )
 
 
+area_light_test = Scene(
+    position=numpy.array([-13,0,0]),
+    direction=numpy.array([1,0,0]),
+    background_color=colors.BLACK,
+    shapes=[
+        Sphere(
+            center=numpy.array([5,-1,0]),
+            radius=2,
+            color=colors.RED,
+            specular=0.2
+        ),
+        Box(
+            center=numpy.array([2,2.5,-1]),
+            size=numpy.array([1,1,2]),
+            color=colors.GREEN
+        ),
+        Plane(
+            center=numpy.array([0,0,-2]),
+            normal=numpy.array([0,0,1]),
+            color=colors.WHITE
+        )
+    ],
+    light_sources=[
+        RectangleLight(
+            numpy.array([3,0,6]),
+            numpy.array([3,0,0]),
+            numpy.array([0,3,0])
+        ),
+        SphereLight(numpy.array([-4,6,3]), 1, intensity=0.5)
+    ]
+)
+
+
 if __name__ == '__main__':
     program = RayTracerMain(complex_scene, 700, 700)
     program.trace_scene()
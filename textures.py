@@ -0,0 +1,184 @@
+"""Textures: colors that vary over a shape's surface.
+
+Shapes map points on their surfaces to (u, v) texture coordinates, measured
+in world units along the surface (see Shape.get_uvs_at_points), and a
+texture turns arrays of those into colors.  Lookups can be given the width
+of each pixel's footprint on the surface, which image textures use to pick
+a mipmap level, so that distant textures are averaged rather than aliased.
+
+Image textures only hold their filename.  Their pixels and mipmaps are
+loaded into a TextureCache on first use, which keeps the most recently used
+ones in memory up to a byte budget and loads evicted ones again when they
+are next needed.
+"""
+import collections
+
+import numpy
+import png
+
+
+DEFAULT_CACHE_MAX_BYTES = 256*1024*1024
+
+
+class Texture(object):
+
+    def get_colors_at_uvs(self, uvs, footprints=None):
+        """Given an (N, 2) array of texture coordinates, return an (N, 3)
+        array of colors.  footprints are the widths (in the same units) of
+        the pixels' footprints around them, or None if they are unknown.
+        """
+        raise NotImplementedError()
+
+
+class CheckerTexture(Texture):
+
+    def __init__(self, color_1, color_2, size=1):
+        """Squares of color_1 and color_2, size wide, with color_1 at the
+        origin
+        """
+        self.color_1 = color_1
+        self.color_2 = color_2
+        self.size = size
+
+    def get_colors_at_uvs(self, uvs, footprints=None):
+        squares = numpy.floor(uvs/self.size)
+        in_color_1 = squares[:, 0] % 2 == squares[:, 1] % 2
+        return numpy.where(in_color_1[:, numpy.newaxis], self.color_1, self.color_2)
+
+
+class GradientTexture(Texture):
+
+    def __init__(self, color_1, color_2, length=1, axis=0):
+        """A linear blend from color_1 to color_2 along u (axis 0) or v
+        (axis 1), repeating every length
+        """
+        self.color_1 = color_1
+        self.color_2 = color_2
+        self.length = length
+        self.axis = axis
+
+    def get_colors_at_uvs(self, uvs, footprints=None):
+        fractions = (uvs[:, self.axis]/self.length % 1)[:, numpy.newaxis]
+        return (1 - fractions)*self.color_1 + fractions*self.color_2
+
+
+class ImageTexture(Texture):
+
+    def __init__(self, filename, size=1, cache=None):
+        """An image read from a png, repeating every size in u and v (either
+        one number or a (u, v) pair), with its top left corner at the
+        origin.  Its mipmaps are kept in cache, a TextureCache, or in a cache
+        shared by every texture for None.
+        """
+        self.filename = filename
+        self.size = size
+        self.cache = cache
+
+    def get_mipmaps(self):
+        return (self.cache or _shared_cache).get_mipmaps(self.filename)
+
+    def get_colors_at_uvs(self, uvs, footprints=None):
+        mipmaps = self.get_mipmaps()
+        height, width = mipmaps[0].shape[:2]
+        # where in the image, in texels of the full resolution level, each
+        # point falls, with rows counted down from the top
+        image_coordinates = uvs/self.size % 1
+        xs = image_coordinates[:, 0]*width
+        ys = (1 - image_coordinates[:, 1])*height
+
+        levels = numpy.zeros(len(uvs), dtype=int)
+        if footprints is not None:
+            texels_per_footprint = footprints*width/numpy.max(self.size)
+            with numpy.errstate(divide='ignore'):
+                levels = numpy.floor(numpy.log2(numpy.maximum(texels_per_footprint, 1)))
+            levels = numpy.clip(levels, 0, len(mipmaps) - 1).astype(int)
+
+        point_colors = numpy.empty((len(uvs), 3))
+        for level in numpy.unique(levels):
+            at_level = numpy.flatnonzero(levels == level)
+            image = mipmaps[level]
+            point_colors[at_level] = _sample_bilinearly(
+                image,
+                xs[at_level]*image.shape[1]/width,
+                ys[at_level]*image.shape[0]/height
+            )
+        return point_colors
+
+
+class TextureCache(object):
+    """The mipmaps of the most recently used image textures, loaded on
+    demand and kept under max_bytes by evicting the least recently used
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        # filename: mipmaps, least recently used first
+        self.entries = collections.OrderedDict()
+
+    def __getstate__(self):
+        # other processes load the images they need themselves
+        state = dict(self.__dict__)
+        state['num_bytes'] = 0
+        state['entries'] = collections.OrderedDict()
+        return state
+
+    def get_mipmaps(self, filename):
+        """The image in filename and its mipmaps, each half the width and
+        height of the one before, down to a single texel
+        """
+        mipmaps = self.entries.pop(filename, None)
+        if mipmaps is None:
+            mipmaps = _build_mipmaps(_read_png(filename))
+            self.num_bytes += sum(mipmap.nbytes for mipmap in mipmaps)
+        self.entries[filename] = mipmaps
+        # the texture being looked up stays, even if it alone is too big
+        while self.num_bytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.num_bytes -= sum(mipmap.nbytes for mipmap in evicted)
+        return mipmaps
+
+
+# used by ImageTextures not given a cache of their own
+_shared_cache = TextureCache()
+
+
+def _read_png(filename):
+    """A (height, width, 3) float32 array of a png's colors"""
+    width, height, rows, _ = png.Reader(filename=filename).asRGBA8()
+    pixels = numpy.array([numpy.asarray(row) for row in rows], dtype=numpy.float32)
+    return pixels.reshape(height, width, 4)[:, :, :3]
+
+
+def _build_mipmaps(image):
+    mipmaps = [image]
+    while max(image.shape[:2]) > 1:
+        # average pairs of rows and then of columns, dropping an odd last one
+        height, width = image.shape[:2]
+        if height > 1:
+            image = (image[0:height//2*2:2] + image[1:height//2*2:2])/2
+        if width > 1:
+            image = (image[:, 0:width//2*2:2] + image[:, 1:width//2*2:2])/2
+        mipmaps.append(image)
+    return mipmaps
+
+
+def _sample_bilinearly(image, xs, ys):
+    """Blend the four texels around each (x, y) position (in texels from the
+    top left corner), wrapping around the image's edges
+    """
+    height, width = image.shape[:2]
+    # texel centers are half a texel in from their corners
+    xs = xs - 0.5
+    ys = ys - 0.5
+    left_xs = numpy.floor(xs)
+    top_ys = numpy.floor(ys)
+    x_fractions = (xs - left_xs)[:, numpy.newaxis]
+    y_fractions = (ys - top_ys)[:, numpy.newaxis]
+    left_xs = left_xs.astype(int) % width
+    top_ys = top_ys.astype(int) % height
+    right_xs = (left_xs + 1) % width
+    bottom_ys = (top_ys + 1) % height
+    top_colors = (1 - x_fractions)*image[top_ys, left_xs] + x_fractions*image[top_ys, right_xs]
+    bottom_colors = (1 - x_fractions)*image[bottom_ys, left_xs] + x_fractions*image[bottom_ys, right_xs]
+    return (1 - y_fractions)*top_colors + y_fractions*bottom_colors
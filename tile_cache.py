@@ -0,0 +1,94 @@
+"""A content-addressed cache of rendered tiles on disk.
+
+Each tile is stored as a .npy file named by its key, a hash of the scene, the
+render settings and the tile's coordinates, so a tile is only ever reused for
+exactly the same render and stale entries simply stop being looked up.  The
+cache is kept under max_bytes by deleting the least recently used tiles,
+with file modification times recording use.
+"""
+import hashlib
+import os
+
+import numpy
+
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'ray_tracer', 'tiles')
+DEFAULT_MAX_BYTES = 256*1024*1024
+# part of every key; bump it when a change to the tracers changes their images
+VERSION = 1
+
+
+class TileCache(object):
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # kept up to date with this process's own writes, and recounted from
+        # the directory whenever it looks like the cache has outgrown
+        # max_bytes, since other processes may share the directory
+        self.num_bytes = sum(size for _, size, _ in self._list_entries())
+        if self.num_bytes > self.max_bytes:
+            self.evict()
+
+    def build_key(self, render_fingerprint, min_x, max_x, min_y, max_y):
+        return hashlib.sha1(
+            '%d %s %d %d %d %d' % (VERSION, render_fingerprint, min_x, max_x, min_y, max_y)
+        ).hexdigest()
+
+    def get(self, key):
+        """Return the cached pixels for key, or None"""
+        filename = self._filename_for_key(key)
+        try:
+            pixels = numpy.load(filename)
+            # mark the tile as recently used
+            os.utime(filename, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return pixels
+
+    def put(self, key, pixels):
+        filename = self._filename_for_key(key)
+        # written under another name first, so that other processes never
+        # load a half written tile
+        partial_filename = '%s.%d.partial' % (filename, os.getpid())
+        with open(partial_filename, 'wb') as partial_file:
+            numpy.save(partial_file, pixels)
+        self.num_bytes += os.path.getsize(partial_filename)
+        os.rename(partial_filename, filename)
+        if self.num_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Delete the least recently used tiles until the cache fits in
+        max_bytes
+        """
+        entries = sorted(self._list_entries())
+        self.num_bytes = sum(size for _, size, _ in entries)
+        for _, size, filename in entries:
+            if self.num_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                # already evicted by another process
+                pass
+            self.num_bytes -= size
+
+    def _list_entries(self):
+        """(modification time, size, filename) for every cached tile"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy'):
+                continue
+            filename = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        return entries
+
+    def _filename_for_key(self, key):
+        return os.path.join(self.directory, key + '.npy')
@@ -1,3 +1,6 @@
+import ctypes
+import multiprocessing
+
 import numpy
 
 
@@ -12,6 +15,16 @@ def normalize(vector):
     return vector/numpy.linalg.norm(vector)
 
 
+def normalize_rows(vectors):
+    """Given an (N, 3) array of vectors, return an array of their unit vectors"""
+    return vectors/numpy.sqrt(dot_rows(vectors, vectors))[:, numpy.newaxis]
+
+
+def dot_rows(vectors_1, vectors_2):
+    """Row-by-row dot product of two (N, 3) arrays of vectors"""
+    return numpy.sum(vectors_1*vectors_2, axis=1)
+
+
 def rotate(vector, rotation_vector):
     """Rotate provided vector around rotation_vector by rotation_vector's
     magnitude (radians).
@@ -23,7 +36,6 @@ def rotate(vector, rotation_vector):
     to transform the vector to something like the above form and then easily
     rotate the vector
     """
-    # TODO: make a rotation vector matrix
     v = vector
     radians = numpy.linalg.norm(rotation_vector)
     if not radians:
@@ -42,6 +54,29 @@ def rotate(vector, rotation_vector):
     )
 
 
+def build_rotation_matrix(rotation_vector):
+    """Build the 3x3 matrix that does what rotate does, i.e. rotation_matrix.dot(v)
+    == rotate(v, rotation_vector).  Its columns are the rotated basis vectors.
+    """
+    return numpy.array([
+        rotate(basis_vector, rotation_vector) for basis_vector in BASE_BASIS
+    ]).T
+
+
+def transform_bounding_box(lower_bound, upper_bound, matrix, translation=0):
+    """Given the corners of an axis aligned box, return the corners of the axis
+    aligned box containing it after transforming by matrix and translation
+    """
+    corners = numpy.array([
+        (x, y, z)
+        for x in (lower_bound[0], upper_bound[0])
+        for y in (lower_bound[1], upper_bound[1])
+        for z in (lower_bound[2], upper_bound[2])
+    ])
+    corners = corners.dot(matrix.T) + translation
+    return corners.min(axis=0), corners.max(axis=0)
+
+
 def change_basis(vector, new_basis):
     """Given a vector and a new 3-vector basis set (represented using the
     vector's current basis), return a representation of the vector in the new
@@ -52,3 +87,29 @@ def change_basis(vector, new_basis):
         numpy.dot(vector, new_basis[1]),
         numpy.dot(vector, new_basis[2]),
     ])
+
+
+def yield_tiles(width, height, tile_size, first_y=0, first_x=0):
+    """Split the rows [first_y, height) of a width-wide screen (or just its
+    columns [first_x, width)) into tile_size x tile_size tiles (smaller at the
+    right and top edges), yielding (min_x, max_x, min_y, max_y) for each
+    """
+    for min_x in xrange(first_x, width, tile_size):
+        for min_y in xrange(first_y, height, tile_size):
+            yield (
+                min_x,
+                min(min_x + tile_size, width),
+                min_y,
+                min(min_y + tile_size, height)
+            )
+
+
+def allocate_array(shape, dtype, shared=False):
+    """numpy.empty, optionally backed by shared memory so that worker
+    processes forked after the allocation write directly into it
+    """
+    if not shared:
+        return numpy.empty(shape, dtype=dtype)
+    dtype = numpy.dtype(dtype)
+    shared_buffer = multiprocessing.RawArray(ctypes.c_byte, int(numpy.prod(shape))*dtype.itemsize)
+    return numpy.frombuffer(shared_buffer, dtype=dtype).reshape(shape)
@@ -0,0 +1,483 @@
+import numpy
+
+from area_lights import build_light_samples
+from area_lights import find_occluded_samples
+from ray_tracer import DEFAULT_MIN_THROUGHPUT
+from util import dot_rows
+from util import normalize_rows
+
+
+MAX_PIXEL_INTENSITY = 255
+
+
+class WavefrontRayTracer(object):
+    """Traces whole arrays of rays breadth first rather than one pixel at a
+    time.  Every bounce depth is a single batch: all of the rays at a depth
+    are intersected and shaded together, and the reflected and refracted rays
+    they spawn make up the next depth's batch.
+
+    Each spawned ray remembers the index of the ray that spawned it and the
+    weight (specular or transparency) of its contribution, so once the
+    deepest batch is shaded the colors can be folded back up to the pixels.
+    The folding clamps at every depth exactly like RayTracer's recursion, so
+    the two produce the same images.
+
+    Every ray also carries its throughput, the product of the weights along
+    its path from the camera.  Branches whose throughput would fall below
+    min_throughput are not traced, or with russian_roulette are traced with
+    probability throughput/min_throughput and weighted up to make up for the
+    ones that aren't, which keeps the expected color the same.
+
+    light_samples limits the shadow rays from each point like it does for
+    RayTracer.
+    """
+
+    def __init__(
+        self,
+        scene,
+        depth=3,
+        min_throughput=DEFAULT_MIN_THROUGHPUT,
+        russian_roulette=False,
+        seed=None,
+        light_samples=None
+    ):
+        self.scene = scene
+        self.depth = depth
+        self.min_throughput = min_throughput
+        self.russian_roulette = russian_roulette
+        self.light_samples = light_samples
+        self.random_state = numpy.random.RandomState(seed)
+        # a RenderStatistics when instrumentation is on
+        self.statistics = None
+        # ShadowMaps to look shadows up in instead of tracing shadow rays
+        self.shadow_maps = None
+        # the angle a pixel spans, see RayTracer.find_footprint
+        self.pixel_angle = None
+
+    def find_pixel_colors_for_rays(self, rays, positions, primary_geometry=None):
+        """Given (N, 3) arrays of rays and their starting positions, return an
+        (N, 3) array of their pixel colors.  primary_geometry is the
+        find_geometry result for the rays if it is already known.
+
+        Everything is computed in the scene's precision (see
+        Scene.set_precision).
+        """
+        dtype = self.scene.dtype
+        rays = rays.astype(dtype, copy=False)
+        positions = positions.astype(dtype, copy=False)
+        materials = _Materials(self.scene.shapes, dtype)
+
+        levels = []
+        geometry = primary_geometry
+        throughputs = numpy.ones(len(rays), dtype=dtype)
+        for remaining_depth in xrange(self.depth, -1, -1):
+            if self.statistics is not None:
+                self.statistics.record_depth(self.depth - remaining_depth, len(rays))
+            level = self.trace_level(
+                rays,
+                positions,
+                materials,
+                spawn_children=remaining_depth > 0,
+                geometry=geometry,
+                throughputs=throughputs
+            )
+            geometry = None
+            levels.append(level)
+            if not len(level.child_rays):
+                break
+            if self.statistics is not None:
+                self.statistics.count_rays('reflection', level.num_reflected)
+                self.statistics.count_rays('refraction', len(level.child_rays) - level.num_reflected)
+            rays = level.child_rays
+            positions = level.child_positions
+            throughputs = level.child_throughputs
+
+        return self.fold_levels(levels)
+
+    def find_geometry(self, rays, positions, culling=None):
+        """Find what (N, 3) arrays of rays starting from positions hit,
+        returning (shape_indices, intersections, surface_normals,
+        part_indices).  Rays that miss get a shape index of -1 (and
+        meaningless intersections and normals).  culling is as for
+        Scene.find_closest_intersections.
+        """
+        distances, shape_indices, part_indices = self.scene.find_closest_intersections(
+            positions,
+            rays,
+            culling
+        )
+        hit_indices = numpy.flatnonzero(shape_indices >= 0)
+        intersections = numpy.zeros(rays.shape, dtype=rays.dtype)
+        intersections[hit_indices] = (
+            positions[hit_indices] +
+            distances[hit_indices, numpy.newaxis]*rays[hit_indices]
+        )
+
+        surface_normals = numpy.zeros(rays.shape, dtype=rays.dtype)
+        for shape_index in numpy.unique(shape_indices[hit_indices]):
+            on_shape = numpy.flatnonzero(shape_indices == shape_index)
+            surface_normals[on_shape] = self.scene.shapes[shape_index].build_surface_normals_at_hits(
+                intersections[on_shape],
+                rays[on_shape],
+                part_indices[on_shape]
+            )
+        return shape_indices, intersections, surface_normals, part_indices
+
+    def trace_level(
+        self,
+        rays,
+        positions,
+        materials,
+        spawn_children,
+        geometry=None,
+        throughputs=None
+    ):
+        level = _Level(len(rays), self.scene.background_color, rays.dtype)
+
+        if geometry is None:
+            geometry = self.find_geometry(rays, positions)
+        shape_indices, intersections, surface_normals, part_indices = geometry
+        level.hit_indices = numpy.flatnonzero(shape_indices >= 0)
+        if not len(level.hit_indices):
+            level.set_children()
+            return level
+
+        rays = rays[level.hit_indices]
+        shape_indices = shape_indices[level.hit_indices]
+        intersections = intersections[level.hit_indices]
+        surface_normals = surface_normals[level.hit_indices]
+        part_indices = part_indices[level.hit_indices]
+        incident_rays_unit = normalize_rows(rays)
+
+        footprints = self.find_footprints(intersections)
+        surface_colors = numpy.empty(intersections.shape, dtype=intersections.dtype)
+        rays_originate_inside = numpy.zeros(len(rays), dtype=bool)
+        for shape_index in numpy.unique(shape_indices):
+            shape = self.scene.shapes[shape_index]
+            on_shape = shape_indices == shape_index
+            surface_colors[on_shape] = shape.get_colors_at_points(
+                intersections[on_shape],
+                None if footprints is None else footprints[on_shape]
+            )
+            if shape.transparency:
+                rays_originate_inside[on_shape] = shape.rays_originate_inside_at_hits(
+                    intersections[on_shape],
+                    incident_rays_unit[on_shape],
+                    part_indices[on_shape]
+                )
+
+        lambert_factors = self.generate_lambert_factors(intersections, surface_normals)
+        level.colors[level.hit_indices] = (
+            surface_colors *
+            lambert_factors[:, numpy.newaxis] *
+            (1 - materials.transparency[shape_indices])[:, numpy.newaxis]
+        )
+        if not spawn_children:
+            level.set_children()
+            return level
+
+        if throughputs is None:
+            throughputs = numpy.ones(len(level.colors), dtype=rays.dtype)
+        hit_throughputs = throughputs[level.hit_indices]
+
+        reflecting = numpy.flatnonzero(materials.specular[shape_indices] != 0)
+        reflecting, reflection_weights = self.select_branches(
+            reflecting,
+            materials.specular[shape_indices[reflecting]],
+            hit_throughputs[reflecting]
+        )
+        reflected_rays = self.generate_reflected_rays(
+            incident_rays_unit[reflecting],
+            surface_normals[reflecting]
+        )
+
+        refracting = numpy.flatnonzero(materials.transparency[shape_indices] != 0)
+        refracting, refraction_weights = self.select_branches(
+            refracting,
+            materials.transparency[shape_indices[refracting]],
+            hit_throughputs[refracting]
+        )
+        indices_of_refraction = materials.index_of_refraction[shape_indices[refracting]]
+        inside = rays_originate_inside[refracting]
+        # for now only allowing refraction with air and shape
+        n1 = numpy.where(inside, indices_of_refraction, 1)
+        n2 = numpy.where(inside, 1, indices_of_refraction)
+        refracted_rays = self.generate_refracted_rays(
+            incident_rays_unit[refracting],
+            surface_normals[refracting],
+            n1,
+            n2
+        )
+
+        level.set_children(
+            rays=numpy.concatenate([reflected_rays, refracted_rays]),
+            positions=numpy.concatenate([
+                intersections[reflecting],
+                intersections[refracting]
+            ]),
+            parent_indices=numpy.concatenate([
+                level.hit_indices[reflecting],
+                level.hit_indices[refracting]
+            ]),
+            weights=numpy.concatenate([reflection_weights, refraction_weights]),
+            throughputs=numpy.concatenate([
+                hit_throughputs[reflecting]*reflection_weights,
+                hit_throughputs[refracting]*refraction_weights
+            ]),
+            num_reflected=len(reflecting)
+        )
+        return level
+
+    def find_footprints(self, points):
+        """Batched version of RayTracer.find_footprint"""
+        if self.pixel_angle is None:
+            return None
+        offsets = points - self.scene.position
+        return numpy.sqrt(dot_rows(offsets, offsets))*self.pixel_angle
+
+    def select_branches(self, branch_indices, weights, parent_throughputs):
+        """Given the indices of the hits that would spawn a reflected (or
+        refracted) ray, the weights of those rays and the throughputs of the
+        rays that hit, return the indices of the branches to trace and their
+        weights
+        """
+        branch_throughputs = parent_throughputs*weights
+        selected = branch_throughputs >= self.min_throughput
+        if self.russian_roulette:
+            survival_probabilities = branch_throughputs/self.min_throughput
+            survived = ~selected & (
+                self.random_state.random_sample(len(weights)) < survival_probabilities
+            )
+            weights = weights.copy()
+            weights[survived] /= survival_probabilities[survived]
+            selected |= survived
+        return branch_indices[selected], weights[selected]
+
+    def generate_lambert_factors(self, points, surface_normals):
+        # one shadow ray from every point to every light that faces it and
+        # reaches it (see Scene.build_light_hierarchy), or to the samples of
+        # area lights, tested in batched occlusion queries.  The paths run all
+        # the way to the light sources, so only occluders within distance 1
+        # along them count
+        point_indices, light_indices, paths, intensities = self.scene.find_lights_for_points(points)
+        lambert_contributions = dot_rows(
+            surface_normals[point_indices],
+            normalize_rows(paths)
+        )*intensities
+        area = numpy.empty(0, dtype=int)
+        if self.shadow_maps is None:
+            # shadow maps treat area lights as points at their centers
+            area = numpy.flatnonzero(self.scene.light_num_samples[light_indices] > 1)
+        samples = build_light_samples(
+            self.scene,
+            points[point_indices[area]],
+            surface_normals[point_indices[area]],
+            light_indices[area],
+            self.random_state.random_sample
+        )
+        lambert_contributions[area] = numpy.bincount(samples[0], samples[3], minlength=len(area))
+
+        lit = numpy.flatnonzero(lambert_contributions > 0)
+        if self.light_samples is not None:
+            picked, lambert_contributions = self.sample_lights(
+                point_indices[lit],
+                lambert_contributions[lit],
+                len(points)
+            )
+            lit = lit[picked]
+        else:
+            lambert_contributions = lambert_contributions[lit]
+        is_area = numpy.zeros(len(point_indices), dtype=bool)
+        is_area[area] = True
+        lit_area = is_area[lit]
+        lambert_contributions[lit_area] *= self.find_area_light_visibilities(
+            points,
+            point_indices[area],
+            numpy.searchsorted(area, lit[lit_area]),
+            samples
+        )
+
+        point_lights = lit[~lit_area]
+        if self.shadow_maps is not None:
+            occluded = self.shadow_maps.find_occluded(
+                points,
+                surface_normals,
+                point_indices[point_lights],
+                light_indices[point_lights]
+            )
+        else:
+            if self.statistics is not None:
+                self.statistics.count_rays('shadow', len(point_lights))
+            occluded = self.scene.find_occluded_segments(
+                points[point_indices[point_lights]],
+                paths[point_lights],
+                max_distances=1
+            )
+        lambert_contributions[numpy.flatnonzero(~lit_area)[occluded]] = 0
+
+        lambert_factors = numpy.bincount(
+            point_indices[lit],
+            lambert_contributions,
+            minlength=len(points)
+        )
+        return numpy.minimum(lambert_factors, 1).astype(points.dtype)
+
+    def find_area_light_visibilities(self, points, area_point_indices, area_pairs, samples):
+        """The unshadowed fraction of the lambert contribution of each of
+        area_pairs, indices of the area light and point pairs sampled by
+        build_light_samples, which can repeat
+        """
+        sample_pairs, sample_indices, paths, lambert_contributions = samples
+        traced_pairs, visibility_indices = numpy.unique(area_pairs, return_inverse=True)
+        traced = numpy.flatnonzero(numpy.in1d(sample_pairs, traced_pairs))
+        traced_sample_pairs = numpy.searchsorted(traced_pairs, sample_pairs[traced])
+        occluded = find_occluded_samples(
+            self.scene,
+            points[area_point_indices[sample_pairs[traced]]],
+            paths[traced],
+            traced_sample_pairs,
+            sample_indices[traced],
+            self.statistics
+        )
+        lambert_contributions = lambert_contributions[traced]
+        visibilities = numpy.bincount(
+            traced_sample_pairs,
+            numpy.where(occluded, 0, lambert_contributions),
+            minlength=len(traced_pairs)
+        )/numpy.bincount(traced_sample_pairs, lambert_contributions, minlength=len(traced_pairs))
+        return visibilities[visibility_indices]
+
+    def sample_lights(self, point_indices, lambert_contributions, num_points):
+        """Batched version of RayTracer.sample_lights, given the point index
+        (in sorted order) and lambert contribution of every light lighting
+        every point.  Points lit by at most light_samples lights keep them
+        all.  Returns the indices of the picked lights, which can repeat, and
+        their weighted contributions.
+        """
+        num_lights = numpy.bincount(point_indices, minlength=num_points)
+        kept = numpy.flatnonzero(num_lights[point_indices] <= self.light_samples)
+        sampled_points = numpy.flatnonzero(num_lights > self.light_samples)
+        if not len(sampled_points):
+            return kept, lambert_contributions[kept]
+
+        # each point's lights are a run of the cumulative contributions, and
+        # picking a uniform point along the run picks them in proportion
+        total_contributions = numpy.bincount(
+            point_indices,
+            lambert_contributions,
+            minlength=num_points
+        )[sampled_points]
+        first_lights = numpy.searchsorted(point_indices, sampled_points)
+        last_lights = first_lights + num_lights[sampled_points] - 1
+        cumulative_contributions = numpy.cumsum(lambert_contributions, dtype=float)
+        run_starts = cumulative_contributions[first_lights] - lambert_contributions[first_lights]
+        picks = (
+            run_starts[:, numpy.newaxis] +
+            self.random_state.random_sample((len(sampled_points), self.light_samples)) *
+            total_contributions[:, numpy.newaxis]
+        )
+        picked = numpy.searchsorted(cumulative_contributions, picks, side='right')
+        # floating point error can land a pick just outside its run
+        picked = numpy.clip(
+            picked,
+            first_lights[:, numpy.newaxis],
+            last_lights[:, numpy.newaxis]
+        ).ravel()
+
+        return (
+            numpy.concatenate([kept, picked]),
+            numpy.concatenate([
+                lambert_contributions[kept],
+                numpy.repeat(total_contributions/self.light_samples, self.light_samples)
+            ]).astype(lambert_contributions.dtype)
+        )
+
+    def generate_reflected_rays(self, incident_rays_unit, surface_normals):
+        components_to_reverse = (
+            dot_rows(surface_normals, incident_rays_unit)[:, numpy.newaxis] *
+            surface_normals
+        )
+        return incident_rays_unit - 2*components_to_reverse
+
+    def generate_refracted_rays(self, incident_rays_unit, surface_normals, n1, n2):
+        """Batched version of RayTracer.generate_refracted_ray"""
+        cos_incident = -1*dot_rows(incident_rays_unit, surface_normals)
+        sin_incident = numpy.sqrt(1 - cos_incident**2)
+        sin_refracted = n1*sin_incident/n2
+
+        total_internal_reflection = sin_refracted > 1
+        cos_refracted = numpy.sqrt(1 - numpy.minimum(sin_refracted, 1)**2)
+        a = cos_incident - cos_refracted
+        refracted_rays = normalize_rows(
+            a[:, numpy.newaxis]*surface_normals + incident_rays_unit
+        )
+
+        refracted_rays[total_internal_reflection] = self.generate_reflected_rays(
+            incident_rays_unit[total_internal_reflection],
+            surface_normals[total_internal_reflection]
+        )
+        return refracted_rays
+
+    def fold_levels(self, levels):
+        """Starting from the deepest level, add each level's weighted colors
+        into the colors of the rays that spawned them.
+        """
+        child_colors = None
+        for level in reversed(levels):
+            colors = level.colors
+            if child_colors is not None:
+                weighted_child_colors = level.child_weights[:, numpy.newaxis]*child_colors
+                # each ray spawns at most one reflected and one refracted ray,
+                # and the reflections are added first as in RayTracer
+                for children in (
+                    slice(None, level.num_reflected),
+                    slice(level.num_reflected, None)
+                ):
+                    numpy.add.at(
+                        colors,
+                        level.child_parent_indices[children],
+                        weighted_child_colors[children]
+                    )
+            # rays that miss everything just get the background color
+            colors[level.hit_indices] = numpy.minimum(
+                colors[level.hit_indices],
+                MAX_PIXEL_INTENSITY
+            )
+            child_colors = colors
+        return child_colors
+
+
+class _Materials(object):
+    """Material properties of the scene's shapes, indexable by shape index"""
+
+    def __init__(self, shapes, dtype=float):
+        self.specular = numpy.array([shape.specular for shape in shapes], dtype=dtype)
+        self.transparency = numpy.array([shape.transparency for shape in shapes], dtype=dtype)
+        self.index_of_refraction = numpy.array([
+            getattr(shape, 'index_of_refraction', 1) for shape in shapes
+        ], dtype=dtype)
+
+
+class _Level(object):
+    """The rays traced at a single bounce depth"""
+
+    def __init__(self, num_rays, background_color, dtype=float):
+        self.colors = numpy.empty((num_rays, 3), dtype=dtype)
+        self.colors[:] = background_color
+        self.hit_indices = None
+
+    def set_children(
+        self,
+        rays=numpy.empty((0, 3)),
+        positions=numpy.empty((0, 3)),
+        parent_indices=numpy.empty(0, dtype=int),
+        weights=numpy.empty(0),
+        throughputs=numpy.empty(0),
+        num_reflected=0
+    ):
+        self.child_rays = rays
+        self.child_positions = positions
+        self.child_parent_indices = parent_indices
+        self.child_weights = weights
+        self.child_throughputs = throughputs
+        self.num_reflected = num_reflected